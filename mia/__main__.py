@@ -15,16 +15,26 @@ Usage:
     mia --help
 
 Global options:
-    --commands  Displays a list of available commands or sub-commands.
-    --options   Displays a list of global or command specific options.
-    --help      Show this screen.
-    --version   Show version.
+    --commands                Displays a list of available commands or sub-commands.
+    --options                 Displays a list of global or command specific options.
+    --profile                 Display the time spent in each phase of the command.
+    --profile-dump=<file>     Save the cProfile statistics of the command to a file.
+    --metrics-json=<file>     Save the time spent in each phase to a JSON file.
+    --timeout=<seconds>       Abort external commands (wget, adb) taking longer.
+    --trace-commands          Display a summary of the external commands at exit.
+    --help                    Show this screen.
+    --version                 Show version.
 
 Available commands:
     build       Build an update.zip file.
+    cache       Export or import the workspace caches as a single pack file.
     clean       Cleanup the current workspace.
+    daemon      Run the workspace commands in a long-running process.
     definition  Create and configure a definition for a new update.zip file.
+    deploy      Build and install, pushing the OS while the update.zip is built.
     install     Install the OS and the built update.zip file onto the device.
+    make        Run the stages of a definition which are not up to date.
+    plan        Display the actions needed to update the build and the device.
 
 
 Notes:
@@ -33,6 +43,7 @@ Notes:
 
 """
 
+import cProfile
 import re
 import os
 import sys
@@ -42,10 +53,13 @@ import sys
 from docopt import docopt
 
 # Import custom helpers.
+# NOTE: The commands are imported when needed, loading them takes most of the
+# startup time, which is too slow for the shell completion.
 from mia import (__version__)
-from mia.commands import available_commands
-from mia.handler import MiaHandler
-from mia.utils import DocParserError
+from mia.completion import MiaCompletion
+from mia.daemon import MiaDaemon
+from mia.profiler import MiaProfiler
+from mia.runner import CommandTimeoutError, MiaRunner
 
 # Get the current directory.
 WORKSPACE = os.getcwd()
@@ -59,6 +73,9 @@ def delegate_command(command_name, command_args):
     """
     Main command handler.
     """
+    from mia.commands import available_commands
+    from mia.handler import MiaHandler
+
     if not command_name:
         # Display a list of commands and exit.
         if MiaHandler.global_args['--commands']:
@@ -105,6 +122,7 @@ def get_doc_section(doc, section):
     """
     :return: A string with the available commands or options from the section.
     """
+    from mia.utils import DocParserError
 
     if section == 'global-options':
         section_name = 'Global options'
@@ -130,12 +148,50 @@ def get_doc_section(doc, section):
 
 
 def main():
+    # Answer the shell completion, eg: `mia _complete definition lock ''`.
+    if sys.argv[1:2] == ['_complete']:
+        return MiaCompletion.main(WORKSPACE, __doc__, sys.argv[2:])
+
+    # Let the daemon run the command, if it is running for this workspace.
+    exit_code = MiaDaemon.forward(sys.argv[1:], WORKSPACE)
+    if exit_code is not None:
+        return exit_code
+
+    return run(sys.argv[1:], WORKSPACE)
+
+
+def run(argv, workspace_path):
+    """
+    Run a command in the current process, eg: in the daemon.
+    :return: The exit code.
+    """
+    from mia.handler import MiaHandler
+
     # Read the CLI arguments.
     # Use options_first to force reading the global options only.
-    global_args = docopt(__doc__, version=__version__, options_first=True)
+    global_args = docopt(__doc__, argv=argv, version=__version__, options_first=True)
 
     # Set the MiaHandler class variables.
-    MiaHandler(ROOT, WORKSPACE, global_args)
+    MiaHandler(ROOT, workspace_path, global_args)
+
+    # Forget the state of the previous command, when running in the daemon.
+    MiaHandler.args = {}
+    MiaHandler.set_definition(None)
+    MiaProfiler.disable()
+    MiaRunner.reset()
+
+    # Enable the timing instrumentation.
+    if global_args['--profile'] or global_args['--metrics-json']:
+        MiaProfiler.enable()
+
+    # Set the timeout for the external commands.
+    if global_args['--timeout']:
+        MiaRunner.timeout = float(global_args['--timeout'])
+
+    profile = None
+    if global_args['--profile-dump']:
+        profile = cProfile.Profile()
+        profile.enable()
 
     try:
         # Execute the command and exit the program.
@@ -145,6 +201,25 @@ def main():
         )
     except KeyboardInterrupt:
         print('\n' + 'Exiting...')
+    except CommandTimeoutError as e:
+        print('ERROR: %s' % e)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(global_args['--profile-dump'])
+            print('Saved the cProfile statistics to:\n - %s' % global_args['--profile-dump'])
+
+        if global_args['--profile']:
+            MiaProfiler.print_tree()
+
+        if global_args['--trace-commands']:
+            MiaRunner.print_summary()
+
+        if global_args['--metrics-json']:
+            MiaProfiler.save_metrics(global_args['--metrics-json'], {
+                'command': [global_args['<command>']] + global_args['<command_args_and_opts>'],
+                'external_commands': MiaRunner.get_records(),
+            })
 
     # The program did not finish successfully.
     return 1
@@ -3,23 +3,30 @@ Provides helper function for interfacing with devices using ADB or getting
 information about the software or device.
 """
 
+import json
 import re
 import os
-import sys
 import subprocess
+import sys
+import threading
+import time
 from tempfile import mkstemp
 
 # Import custom helpers.
 from mia.handler import MiaHandler
+from mia.profiler import MiaProfiler
+from mia.runner import MiaRunner
 from mia.utils import MiaUtils
 
 
 class MiaAndroid(object):
+    lock = threading.Lock()
+
     @staticmethod
     def adb_get_version():
         # The `adb version` command returns a string in the following format:
         # Android Debug Bridge version 1.0.31
-        std_output = str(subprocess.check_output(['adb', 'version']))
+        std_output = str(MiaRunner.check_output(['adb', 'version']))
 
         # Get the version string.
         match_instance = re.search('(\d+\.\d+\.\d+)', std_output)
@@ -28,6 +35,23 @@ class MiaAndroid(object):
 
         return None
 
+    @staticmethod
+    def get_device_serial():
+        """
+        :return: The serial number of the device, or of the emulator, or None
+          if it is not connected.
+        """
+        adb_arguments = ['adb', 'get-serialno']
+        if MiaHandler.args.get('--emulator'):
+            adb_arguments.insert(1, '-e')
+
+        try:
+            serial = MiaRunner.check_output(adb_arguments).decode('utf-8', 'replace').strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+        return serial if serial and serial != 'unknown' else None
+
     @staticmethod
     def adb_check_device():
         # TODO: Check if `adb` sees the device.
@@ -70,10 +94,10 @@ class MiaAndroid(object):
         if mode == 'bootloader' or mode == 'recovery':
             if MiaHandler.args['--emulator']:
                 # Restart the emulator.
-                adb_exit_code = subprocess.call(['adb', '-e', 'reboot', mode])
+                adb_exit_code = MiaRunner.call(['adb', '-e', 'reboot', mode])
             else:
                 # Restart the device.
-                adb_exit_code = subprocess.call(['adb', 'reboot', mode])
+                adb_exit_code = MiaRunner.call(['adb', 'reboot', mode])
 
             if adb_exit_code != 0:
                 raise RuntimeError('Could not reboot the device!')
@@ -89,16 +113,16 @@ class MiaAndroid(object):
         command = 'su root cp /sdcard/openrecoveryscript /cache/recovery/openrecoveryscript'
         if MiaHandler.args['--emulator']:
             # Run the command on the emulator.
-            adb_exit_code = subprocess.call(['adb', '-e', 'shell', command])
+            adb_exit_code = MiaRunner.call(['adb', '-e', 'shell', command])
         else:
             # Run the command on the device.
-            adb_exit_code = subprocess.call(['adb', 'shell', command])
+            adb_exit_code = MiaRunner.call(['adb', 'shell', command])
 
         if adb_exit_code != 0:
             raise RuntimeError('Could not set the open recovery script!')
 
     @classmethod
-    def push_file(cls, source_type, source, destination):
+    def push_file(cls, source_type, source, destination, progress=True):
         # Get the file size.
         file_size = os.path.getsize(source)
 
@@ -109,10 +133,12 @@ class MiaAndroid(object):
         adb_arguments = [source, destination]
 
         # Display progress bar on newer versions of ADB.
-        if MiaUtils.version_compare(cls.adb_get_version(), '1.0.32', 'ge'):
-            adb_arguments.insert(0, '-p')
-        else:
-            print('Please wait...')
+        # NOTE: The progress bar is garbled when pushing files concurrently.
+        if progress:
+            if MiaUtils.version_compare(cls.adb_get_version(), '1.0.32', 'ge'):
+                adb_arguments.insert(0, '-p')
+            else:
+                print('Please wait...')
 
         # Add the `push` command before the `push` specific arguments and options.
         adb_arguments.insert(0, 'push')
@@ -122,12 +148,14 @@ class MiaAndroid(object):
             adb_arguments.insert(0, '-e')
 
         # Push file to the device.
-        adb_exit_code = subprocess.call(['adb'] + adb_arguments)
+        with MiaProfiler.span('adb push') as span:
+            span.add('bytes', file_size)
+            adb_exit_code = MiaRunner.call(['adb'] + adb_arguments)
         if adb_exit_code != 0:
             raise RuntimeError('Could not push to the device!')
 
     @classmethod
-    def push_hash_for_file(cls, hash_type, source, destination):
+    def push_hash_for_file(cls, hash_type, source, destination, progress=True):
         source_path = '.'.join((source, hash_type))
         destination_path = '.'.join((destination, hash_type))
 
@@ -156,8 +184,74 @@ class MiaAndroid(object):
             sys.exit(1)
 
         # Push the file onto the devices.
-        cls.push_file('hash file', temp_file_path, destination_path)
+        cls.push_file('hash file', temp_file_path, destination_path, progress)
 
         # Delete the temporary file.
         if os.path.exists(temp_file_path):
             os.unlink(temp_file_path)
+
+        # The file and it's hash are on the device.
+        cls.save_pushed_file(source, destination, hash_type, source_content.split()[0])
+
+    @staticmethod
+    def get_devices_file_path():
+        return os.path.join(MiaHandler.get_workspace_path(), 'resources', 'devices.json')
+
+    @classmethod
+    def load_pushed_files(cls, serial=None):
+        """
+        :param serial: The serial number of the device, the connected device
+          or emulator if None.
+        :return: The last files pushed onto the device, mapped by their path
+          on the device. None are known when no device is connected.
+        """
+        file_path = cls.get_devices_file_path()
+        if not os.path.isfile(file_path):
+            return {}
+
+        if serial is None:
+            serial = cls.get_device_serial()
+            if serial is None:
+                return {}
+
+        try:
+            with open(file_path, 'r') as fd:
+                devices = json.load(fd)
+        except ValueError:
+            return {}
+
+        return devices.get(serial, {})
+
+    @classmethod
+    def save_pushed_file(cls, source, destination, hash_type, hash_value):
+        """
+        Remember the files pushed onto the device, eg: to skip pushing them
+        again. The devices are identified by their serial number, the files
+        pushed onto another device are not on this one.
+        """
+        file_path = cls.get_devices_file_path()
+        serial = cls.get_device_serial()
+        if serial is None:
+            return
+
+        with cls.lock:
+            devices = {}
+            if os.path.isfile(file_path):
+                try:
+                    with open(file_path, 'r') as fd:
+                        devices = json.load(fd)
+                except ValueError:
+                    pass
+
+            devices.setdefault(serial, {})[destination] = {
+                'source': os.path.relpath(source, MiaHandler.get_workspace_path()).replace(os.sep, '/'),
+                'size': os.path.getsize(source),
+                'hash_type': hash_type,
+                'hash': hash_value,
+                'time': time.time(),
+            }
+
+            # Write the file atomically.
+            with open(file_path + '.tmp', 'w') as fd:
+                json.dump(devices, fd, indent=2, sort_keys=True)
+            os.rename(file_path + '.tmp', file_path)
@@ -0,0 +1,293 @@
+"""
+Inspection of the APK files, without extracting them.
+
+Only the zip central directory and the binary AndroidManifest.xml member are
+read, to find the package id, the version code and the native code ABIs of an
+APK. The results are cached by the file digest in the workspace resources
+folder, as `apk-info.json`.
+"""
+
+import json
+import os
+import struct
+import threading
+import zipfile
+
+from mia.handler import MiaHandler
+from mia.profiler import MiaProfiler
+from mia.utils import MiaUtils
+
+
+class MiaApkError(Exception):
+    pass
+
+
+class MiaApk(object):
+    # Increase when changing the inspection results.
+    format_version = 1
+
+    # The binary XML chunk types, from the Android ResourceTypes.h.
+    RES_STRING_POOL_TYPE = 0x0001
+    RES_XML_TYPE = 0x0003
+    RES_XML_RESOURCE_MAP_TYPE = 0x0180
+    RES_XML_START_ELEMENT_TYPE = 0x0102
+    UTF8_FLAG = 0x100
+
+    # The typed values of the attributes.
+    TYPE_STRING = 0x03
+    TYPE_INT_DEC = 0x10
+    TYPE_INT_HEX = 0x11
+
+    # The resource ids of the android: attributes, used when the attribute
+    # names are stripped from the string pool.
+    attribute_ids = {
+        0x0101021b: 'versionCode',
+        0x0101021c: 'versionName',
+    }
+
+    # The ABIs supported by each CPU architecture, best first.
+    compatible_abis = {
+        'armeabi': ('armeabi',),
+        'armeabi-v7a': ('armeabi-v7a', 'armeabi'),
+        'arm64-v8a': ('arm64-v8a', 'armeabi-v7a', 'armeabi'),
+        'x86': ('x86',),
+        'x86_64': ('x86_64', 'x86'),
+        'mips': ('mips',),
+        'mips64': ('mips64', 'mips'),
+    }
+
+    # Maps the file digests to the inspection results.
+    __infos = None
+    lock = threading.Lock()
+
+    @staticmethod
+    def get_cache_file_path():
+        return os.path.join(MiaHandler.get_workspace_path(), 'resources', 'apk-info.json')
+
+    @classmethod
+    def load_cache(cls):
+        if cls.__infos is not None:
+            return cls.__infos
+
+        cls.__infos = {}
+        file_path = cls.get_cache_file_path()
+        if os.path.isfile(file_path):
+            try:
+                with open(file_path, 'r') as fd:
+                    data = json.load(fd)
+                if data.get('version') == cls.format_version:
+                    cls.__infos = data['apks']
+            except ValueError:
+                pass
+
+        return cls.__infos
+
+    @classmethod
+    def save_cache(cls):
+        if cls.__infos is None:
+            return
+
+        file_path = cls.get_cache_file_path()
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path), mode=0o755)
+
+        # Write the file atomically.
+        with cls.lock:
+            temp_path = file_path + '.tmp'
+            with open(temp_path, 'w') as fd:
+                json.dump({'version': cls.format_version, 'apks': cls.__infos}, fd, indent=0, sort_keys=True)
+            os.rename(temp_path, file_path)
+
+    @classmethod
+    def clear_cache(cls):
+        cls.__infos = {}
+
+    @classmethod
+    def get_cached_info(cls, hash_type, hash_value):
+        """
+        :return: The inspection results of an APK by it's digest, or None.
+        """
+        with cls.lock:
+            return cls.load_cache().get('%s:%s' % (hash_type, hash_value))
+
+    @classmethod
+    def inspect(cls, apk_path, hash_type='sha256', hash_value=None):
+        """
+        Inspect an APK, or reuse the results of an APK with the same digest.
+        :param hash_value: The digest of the APK, if already known.
+        :return: A dictionary with the package id, the version code, the
+          version name and the native code ABIs.
+        :raise MiaApkError: If the APK could not be read.
+        """
+        if hash_value is None:
+            hash_value = MiaUtils.get_file_hash(apk_path, hash_type)
+
+        info = cls.get_cached_info(hash_type, hash_value)
+        if info is not None:
+            return info
+
+        with MiaProfiler.span('apk inspect') as span:
+            try:
+                zf = zipfile.ZipFile(apk_path, mode='r')
+            except (zipfile.BadZipfile, IOError) as e:
+                raise MiaApkError('Could not read %s: %s' % (os.path.basename(apk_path), e))
+
+            try:
+                manifest = zf.read('AndroidManifest.xml')
+                abis = set()
+                for name in zf.namelist():
+                    # eg: lib/armeabi-v7a/libfoo.so
+                    parts = name.split('/')
+                    if len(parts) == 3 and parts[0] == 'lib' and parts[2].endswith('.so'):
+                        abis.add(parts[1])
+            except (KeyError, zipfile.BadZipfile) as e:
+                raise MiaApkError('Could not read the manifest of %s: %s' % (os.path.basename(apk_path), e))
+            finally:
+                zf.close()
+
+            span.add('bytes', len(manifest))
+            attributes = cls.parse_manifest(manifest)
+
+        try:
+            info = {
+                'package': attributes['package'],
+                'versioncode': int(attributes['versionCode']),
+                'versionname': attributes.get('versionName'),
+                'abis': sorted(abis),
+            }
+        except (KeyError, ValueError):
+            raise MiaApkError('Missing package or versionCode in the manifest of %s' % os.path.basename(apk_path))
+
+        with cls.lock:
+            cls.load_cache()['%s:%s' % (hash_type, hash_value)] = info
+
+        return info
+
+    @classmethod
+    def parse_manifest(cls, data):
+        """
+        Read the attributes of the <manifest> element of a binary XML file.
+        :return: A dictionary mapping the attribute names to their values.
+        """
+        try:
+            chunk_type, header_size, size = struct.unpack_from('<HHI', data, 0)
+            if chunk_type != cls.RES_XML_TYPE:
+                raise MiaApkError('Not a binary XML file')
+
+            strings = []
+            resource_ids = []
+            offset = header_size
+            while offset + 8 <= len(data):
+                chunk_type, header_size, size = struct.unpack_from('<HHI', data, offset)
+                if size < 8:
+                    break
+
+                if chunk_type == cls.RES_STRING_POOL_TYPE:
+                    strings = cls.parse_string_pool(data, offset)
+                elif chunk_type == cls.RES_XML_RESOURCE_MAP_TYPE:
+                    count = (size - header_size) // 4
+                    resource_ids = struct.unpack_from('<%dI' % count, data, offset + header_size)
+                elif chunk_type == cls.RES_XML_START_ELEMENT_TYPE:
+                    # The manifest is the root element.
+                    return cls.parse_attributes(data, offset + header_size, strings, resource_ids)
+
+                offset += size
+        except (struct.error, IndexError, UnicodeDecodeError):
+            raise MiaApkError('Corrupted binary XML file')
+
+        raise MiaApkError('Missing manifest element')
+
+    @classmethod
+    def parse_string_pool(cls, data, offset):
+        string_count, style_count, flags, strings_start = struct.unpack_from('<IIII', data, offset + 8)
+        header_size = struct.unpack_from('<H', data, offset + 2)[0]
+        string_offsets = struct.unpack_from('<%dI' % string_count, data, offset + header_size)
+        utf8 = flags & cls.UTF8_FLAG
+
+        strings = []
+        for string_offset in string_offsets:
+            position = offset + strings_start + string_offset
+            if utf8:
+                # The UTF-16 length, then the UTF-8 length, of one or two bytes.
+                for index in range(2):
+                    length = struct.unpack_from('<B', data, position)[0]
+                    position += 1
+                    if length & 0x80:
+                        length = ((length & 0x7f) << 8) | struct.unpack_from('<B', data, position)[0]
+                        position += 1
+                strings.append(data[position:position + length].decode('utf-8'))
+            else:
+                length = struct.unpack_from('<H', data, position)[0]
+                position += 2
+                if length & 0x8000:
+                    length = ((length & 0x7fff) << 16) | struct.unpack_from('<H', data, position)[0]
+                    position += 2
+                strings.append(data[position:position + length * 2].decode('utf-16-le'))
+
+        return strings
+
+    @classmethod
+    def parse_attributes(cls, data, offset, strings, resource_ids):
+        attribute_start, attribute_size, attribute_count = struct.unpack_from('<HHH', data, offset + 8)
+
+        attributes = {}
+        for index in range(attribute_count):
+            position = offset + attribute_start + index * attribute_size
+            name, raw_value, data_type, value = struct.unpack_from('<4xIIxxxBI', data, position)
+
+            attribute_name = strings[name]
+            if name < len(resource_ids) and resource_ids[name] in cls.attribute_ids:
+                attribute_name = cls.attribute_ids[resource_ids[name]]
+
+            if data_type == cls.TYPE_STRING:
+                attributes[attribute_name] = strings[value]
+            elif data_type in (cls.TYPE_INT_DEC, cls.TYPE_INT_HEX):
+                attributes[attribute_name] = value
+            elif raw_value != 0xffffffff:
+                attributes[attribute_name] = strings[raw_value]
+
+        return attributes
+
+    @classmethod
+    def is_compatible(cls, info, cpu):
+        """
+        :return: Whether an APK runs on a CPU architecture. The APKs without
+          native code run on all of them.
+        """
+        if not info['abis']:
+            return True
+
+        return bool(set(info['abis']) & set(cls.compatible_abis.get(cpu, (cpu,))))
+
+    @classmethod
+    def check(cls, apk_info, apk_path, cpu, verified=False):
+        """
+        Check that an APK matches it's lock information and the CPU.
+        :param verified: Whether the hash of the file was already verified.
+        :return: The inspection results.
+        :raise MiaApkError: If the APK does not match.
+        """
+        hash_type = apk_info.get('hash_type', 'sha256')
+        if verified:
+            hash_value = apk_info['hash']
+        else:
+            hash_value = MiaUtils.get_file_hash(apk_path, hash_type)
+
+        errors = []
+        if apk_info.get('hash', hash_value) != hash_value:
+            errors.append('file hash')
+
+        info = cls.inspect(apk_path, hash_type, hash_value)
+        if info['package'] != apk_info['id']:
+            errors.append('package %s instead of %s' % (info['package'], apk_info['id']))
+        # NOTE: The apps downloaded from an URL have no known versioncode.
+        if apk_info.get('package_versioncode') is not None \
+                and str(info['versioncode']) != str(apk_info['package_versioncode']):
+            errors.append('versioncode %s instead of %s' % (info['versioncode'], apk_info['package_versioncode']))
+        if not cls.is_compatible(info, cpu):
+            errors.append('native code for %s, not %s' % (', '.join(info['abis']), cpu))
+
+        if errors:
+            raise MiaApkError('Unexpected %s' % ', '.join(errors))
+
+        return info
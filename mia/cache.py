@@ -0,0 +1,294 @@
+"""
+Tracking of the workspace cached artifacts, with LRU garbage collection.
+
+The cached artifacts are the files from the workspace `resources` folder, eg:
+the repository indexes, the OS zip files and the `<cpu>-apps` caches, and the
+builds. The last access time of an artifact is saved when it is used, because
+the file system access times are not reliable (eg: noatime mounts).
+"""
+
+import json
+import os
+import re
+import threading
+import time
+
+import yaml
+
+from mia.handler import MiaHandler
+from mia.settings import MiaSettings
+from mia.trash import MiaTrash
+
+
+class MiaCache(object):
+    # The cache metadata files, never evicted.
+    metadata_files = (
+        'apk-info.json', 'apk-signatures.json', 'cache-access.json', 'devices.json', 'mirrors.json', 'packs.json'
+    )
+
+    # Files belonging to the same artifact, eg: the checksum of an OS zip, the
+    # search index of a repository index or the manifest of a build.
+    companion_suffixes = (
+        '.part.json', '.part', '.md5', '.sha1', '.sha256', '.sha512', '.search', '.manifest.json'
+    )
+
+    size_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+    lock = threading.Lock()
+
+    @staticmethod
+    def get_access_file_path():
+        return os.path.join(MiaHandler.get_workspace_path(), 'resources', 'cache-access.json')
+
+    @classmethod
+    def load_access_times(cls):
+        file_path = cls.get_access_file_path()
+        if not os.path.isfile(file_path):
+            return {}
+
+        try:
+            with open(file_path, 'r') as fd:
+                return json.load(fd)
+        except ValueError:
+            return {}
+
+    @classmethod
+    def save_access_times(cls, access_times):
+        file_path = cls.get_access_file_path()
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path), mode=0o755)
+
+        # Write the file atomically.
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w') as fd:
+            json.dump(access_times, fd, indent=0, sort_keys=True)
+        os.rename(temp_path, file_path)
+
+    @classmethod
+    def touch(cls, *paths):
+        """
+        Record the access time of cached artifacts.
+        """
+        workspace_path = MiaHandler.get_workspace_path()
+        now = time.time()
+
+        with cls.lock:
+            access_times = cls.load_access_times()
+            for path in paths:
+                key = cls.get_artifact_key(os.path.relpath(path, workspace_path))
+                access_times[key] = now
+            cls.save_access_times(access_times)
+
+    @classmethod
+    def get_artifact_key(cls, relative_path):
+        """
+        :return: The relative path of the artifact a file belongs to.
+        """
+        relative_path = relative_path.replace(os.sep, '/')
+
+        stripped = True
+        while stripped:
+            stripped = False
+            for suffix in cls.companion_suffixes:
+                if relative_path.endswith(suffix):
+                    relative_path = relative_path[:-len(suffix)]
+                    stripped = True
+
+        return relative_path
+
+    @classmethod
+    def get_artifacts(cls):
+        """
+        :return: A dictionary of artifacts by key, with the paths, the size and
+          the last access time of each.
+        """
+        workspace_path = MiaHandler.get_workspace_path()
+        access_times = cls.load_access_times()
+        artifacts = {}
+
+        for relative_path, size, mtime in cls.get_cached_entries():
+            key = cls.get_artifact_key(relative_path)
+            artifact = artifacts.setdefault(key, {
+                'key': key,
+                'paths': [],
+                'size': 0,
+                'last_access': access_times.get(key, 0),
+            })
+            artifact['paths'].append(os.path.join(workspace_path, relative_path))
+            artifact['size'] += size
+
+            # Fallback to the modification time of the untracked artifacts.
+            if key not in access_times:
+                artifact['last_access'] = max(artifact['last_access'], mtime)
+
+        return artifacts
+
+    @classmethod
+    def get_cached_entries(cls):
+        """
+        List the cached entries, as (relative path, size, modification time).
+        The `<cpu>-apps` caches are listed by file, the rest by folder entry.
+        """
+        workspace_path = MiaHandler.get_workspace_path()
+        entries = []
+
+        for folder in ('resources', 'builds'):
+            folder_path = os.path.join(workspace_path, folder)
+            if not os.path.isdir(folder_path):
+                continue
+
+            for name in os.listdir(folder_path):
+                path = os.path.join(folder_path, name)
+                if folder == 'resources' and name in cls.metadata_files:
+                    continue
+
+                if not os.path.isdir(path):
+                    stat = os.stat(path)
+                    entries.append(('/'.join((folder, name)), stat.st_size, stat.st_mtime))
+                elif folder == 'resources' and name.endswith('-apps'):
+                    for file_name in os.listdir(path):
+                        file_path = os.path.join(path, file_name)
+                        if os.path.isdir(file_path):
+                            size, mtime = cls.get_directory_info(file_path)
+                        else:
+                            stat = os.stat(file_path)
+                            size, mtime = stat.st_size, stat.st_mtime
+                        entries.append(('/'.join((folder, name, file_name)), size, mtime))
+                else:
+                    size, mtime = cls.get_directory_info(path)
+                    entries.append(('/'.join((folder, name)), size, mtime))
+
+        return entries
+
+    @staticmethod
+    def get_directory_info(directory_path):
+        """
+        :return: A (total size, latest modification time) tuple.
+        """
+        size = 0
+        mtime = os.path.getmtime(directory_path)
+        for root, dirs, files in os.walk(directory_path):
+            for file_name in files:
+                stat = os.lstat(os.path.join(root, file_name))
+                size += stat.st_size
+                mtime = max(mtime, stat.st_mtime)
+
+        return size, mtime
+
+    @classmethod
+    def get_referenced_keys(cls):
+        """
+        :return: A set of the artifact keys used by the workspace definitions,
+          and a set of the APK names referenced by their lock files, or None
+          if the files of a definition are not valid.
+        """
+        workspace_path = MiaHandler.get_workspace_path()
+        keys = set()
+        apk_names = set()
+
+        for definition in MiaHandler.get_definition_names():
+            definition_path = os.path.join(workspace_path, 'definitions', definition)
+            try:
+                definition_keys, definition_apk_names = cls.get_definition_references(definition_path)
+            except yaml.YAMLError as e:
+                print('WARNING: Invalid YAML file in the %s definition, the artifacts it uses are not known:\n%s' % (
+                    definition, e
+                ))
+                return None
+
+            keys.update(definition_keys)
+            apk_names.update(definition_apk_names)
+
+        return keys, apk_names
+
+    @staticmethod
+    def get_definition_references(definition_path):
+        """
+        :return: The artifact keys and the APK names used by a definition.
+        :raise yaml.YAMLError: If the settings or the lock file is not valid.
+        """
+        keys = set()
+        apk_names = set()
+
+        settings = MiaSettings.load(os.path.join(definition_path, 'settings.yaml'))
+        if not settings:
+            return keys, apk_names
+
+        for repo_info in settings.get('repositories') or []:
+            keys.add('resources/%s.index-v1.jar' % repo_info['id'])
+            keys.add('resources/%s.index.xml' % repo_info['id'])
+
+        try:
+            keys.add('resources/%s' % MiaHandler.get_os_zip_filename(settings))
+        except KeyError:
+            # The OS zip file name is not known.
+            pass
+
+        lock_file_path = os.path.join(definition_path, 'apps_lock.yaml')
+        if os.path.isfile(lock_file_path):
+            for apk_info in MiaSettings.load(lock_file_path) or []:
+                apk_names.add(apk_info['package_name'])
+
+        return keys, apk_names
+
+    @classmethod
+    def collect_garbage(cls, max_size):
+        """
+        Evict the least recently used artifacts, which are not referenced by
+        any definition, until the cache fits in the size budget.
+        :return: A (evicted artifacts, cache size) tuple, the evicted artifacts
+          are None if the artifacts used by the definitions are not known.
+        """
+        artifacts = cls.get_artifacts()
+        cache_size = sum(artifact['size'] for artifact in artifacts.values())
+
+        # Never evict the artifacts of a definition which can not be read.
+        referenced = cls.get_referenced_keys()
+        if referenced is None:
+            return None, cache_size
+
+        referenced_keys, referenced_apks = referenced
+        candidates = sorted(
+            (artifact for artifact in artifacts.values()
+             if artifact['key'] not in referenced_keys and not cls.is_referenced_apk(artifact, referenced_apks)),
+            key=lambda artifact: artifact['last_access']
+        )
+
+        evicted = []
+        for artifact in candidates:
+            if cache_size <= max_size:
+                break
+
+            # The files are deleted when the trash is emptied.
+            for path in artifact['paths']:
+                if os.path.lexists(path):
+                    MiaTrash.move(path)
+
+            cache_size -= artifact['size']
+            evicted.append(artifact)
+
+        if evicted:
+            with cls.lock:
+                access_times = cls.load_access_times()
+                for artifact in evicted:
+                    access_times.pop(artifact['key'], None)
+                cls.save_access_times(access_times)
+
+        return evicted, cache_size
+
+    @staticmethod
+    def is_referenced_apk(artifact, referenced_apks):
+        folders = artifact['key'].split('/')
+        return len(folders) == 3 and folders[1].endswith('-apps') and folders[2] in referenced_apks
+
+    @classmethod
+    def parse_size(cls, value):
+        """
+        Parse a size, eg: 512M, 20G or 1.5T.
+        :return: The size in bytes, or None if invalid.
+        """
+        match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', str(value), re.IGNORECASE)
+        if match is None:
+            return None
+
+        return int(float(match.group(1)) * cls.size_units[match.group(2).upper()])
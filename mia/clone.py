@@ -0,0 +1,286 @@
+"""
+Copy-on-write cloning of the templates into definitions.
+
+The definition files are cloned from the template files:
+ - using reflinks when the file system supports them (eg: Btrfs, XFS), the
+   clones share the data until one of them is modified;
+ - otherwise using regular copies.
+
+Hard links are not copy-on-write, modifying one modifies all of them, and they
+share the permissions of the linked file. They are only used for the files
+which are replaced but never modified in place, eg: the cached APKs, through
+read-only objects in a content addressed store in the workspace resources.
+
+The settings files at the root of the definition are always copied, since
+they are modified in place when configuring the definition.
+"""
+
+import errno
+import json
+import os
+import shutil
+import stat
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows.
+    fcntl = None
+
+from mia.handler import MiaHandler
+from mia.utils import MiaUtils
+
+# The Linux ioctl request cloning a file, from linux/fs.h
+FICLONE = 0x40049409
+
+
+class MiaClone(object):
+    # Whether the workspace file system supports reflinks, None if unknown.
+    reflink_supported = None
+
+    # Maps template file paths to (size, modification time, digest) tuples.
+    __digests = None
+
+    @staticmethod
+    def get_store_path():
+        return os.path.join(MiaHandler.get_workspace_path(), 'resources', 'objects')
+
+    @classmethod
+    def get_digests_path(cls):
+        return os.path.join(cls.get_store_path(), 'digests.json')
+
+    @classmethod
+    def load_digests(cls):
+        if cls.__digests is None:
+            cls.__digests = {}
+
+            digests_path = cls.get_digests_path()
+            if os.path.isfile(digests_path):
+                try:
+                    with open(digests_path, 'r') as fd:
+                        cls.__digests = json.load(fd)
+                except ValueError:
+                    pass
+
+        return cls.__digests
+
+    @classmethod
+    def save_digests(cls):
+        if cls.__digests is None:
+            return
+
+        digests_path = cls.get_digests_path()
+        if not os.path.isdir(os.path.dirname(digests_path)):
+            os.makedirs(os.path.dirname(digests_path), mode=0o755)
+
+        temp_path = digests_path + '.tmp'
+        with open(temp_path, 'w') as fd:
+            json.dump(cls.load_digests(), fd)
+        os.rename(temp_path, digests_path)
+
+    @classmethod
+    def get_file_digest(cls, file_path):
+        """
+        Get the digest of a template file, only hashing new or changed files.
+        """
+        file_stat = os.stat(file_path)
+        digests = cls.load_digests()
+
+        cached = digests.get(file_path)
+        if cached is not None and cached[0] == file_stat.st_size and cached[1] == file_stat.st_mtime:
+            return cached[2]
+
+        digest = MiaUtils.get_file_hash(file_path, 'sha1')
+        digests[file_path] = (file_stat.st_size, file_stat.st_mtime, digest)
+
+        return digest
+
+    @classmethod
+    def get_object_path(cls, file_path):
+        digest = cls.get_file_digest(file_path)
+        return os.path.join(cls.get_store_path(), digest[:2], digest)
+
+    @classmethod
+    def add_to_store(cls, file_path):
+        """
+        :return: The path of the read-only copy of the file in the store.
+        """
+        object_path = cls.get_object_path(file_path)
+        if not os.path.isfile(object_path):
+            if not os.path.isdir(os.path.dirname(object_path)):
+                os.makedirs(os.path.dirname(object_path), mode=0o755)
+
+            temp_path = object_path + '.tmp'
+            shutil.copyfile(file_path, temp_path)
+            os.chmod(temp_path, 0o444)
+            os.rename(temp_path, object_path)
+
+        return object_path
+
+    @classmethod
+    def clone_file(cls, source, destination, file_mode, mode='auto'):
+        """
+        Clone a file, replacing an existing destination atomically.
+        :param file_mode: The permissions of the reflinks and copies.
+        :param mode: One of auto, shared, reflink, hardlink or copy. Both auto
+          and shared prefer reflinks, shared falls back to hard links, for the
+          immutable files only, and then both fall back to copies.
+        :return: The used method: reflink, hardlink or copy.
+        """
+        # NOTE: A new definition file is cloned in place, an interrupted clone
+        # differs from the template and is replaced when updating the
+        # definition. The shared files may be read concurrently, eg: the APKs.
+        temp_path = destination
+        if mode in ('shared', 'hardlink') or os.path.lexists(destination):
+            temp_path = os.path.join(os.path.dirname(destination), '.%s.tmp' % os.path.basename(destination))
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+
+        method = 'copy'
+        if mode in ('auto', 'shared', 'reflink') and cls.reflink_supported is not False and fcntl is not None:
+            try:
+                cls.reflink(source, temp_path)
+                cls.reflink_supported = True
+                method = 'reflink'
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                    raise
+                cls.reflink_supported = False
+
+        if method == 'copy' and mode in ('shared', 'hardlink'):
+            try:
+                os.link(source, temp_path)
+                method = 'hardlink'
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    raise
+
+        if method == 'copy':
+            shutil.copyfile(source, temp_path)
+
+        # NOTE: The hard links share the mode of the source, eg: read-only.
+        if method != 'hardlink':
+            os.chmod(temp_path, file_mode)
+
+        if temp_path != destination:
+            os.rename(temp_path, destination)
+
+        return method
+
+    @staticmethod
+    def reflink(source, destination):
+        with open(source, 'rb') as source_fd:
+            with open(destination, 'wb') as destination_fd:
+                try:
+                    fcntl.ioctl(destination_fd.fileno(), FICLONE, source_fd.fileno())
+                except (IOError, OSError):
+                    destination_fd.close()
+                    os.remove(destination)
+                    raise
+
+    @staticmethod
+    def is_shareable(relative_path):
+        """
+        The settings files of the definition are modified in place.
+        """
+        return os.sep in relative_path or not relative_path.endswith('.yaml')
+
+    @staticmethod
+    def walk_files(directory_path):
+        """
+        :return: The relative paths of the files in a directory, recursively.
+        """
+        for root, directories, files in os.walk(directory_path):
+            directories.sort()
+            for file_name in sorted(files):
+                yield os.path.relpath(os.path.join(root, file_name), directory_path)
+
+    @classmethod
+    def clone_tree(cls, template_path, destination_path, mode='auto'):
+        """
+        Clone a template into a new definition.
+        :return: A dictionary with the number of files per used method, and
+          the number of shared bytes.
+        """
+        stats = {'reflink': 0, 'hardlink': 0, 'copy': 0, 'shared_bytes': 0}
+
+        created_paths = set()
+        for relative_path in cls.walk_files(template_path):
+            source = os.path.join(template_path, relative_path)
+            destination = os.path.join(destination_path, relative_path)
+            if os.path.dirname(destination) not in created_paths:
+                if not os.path.isdir(os.path.dirname(destination)):
+                    os.makedirs(os.path.dirname(destination), mode=0o755)
+                created_paths.add(os.path.dirname(destination))
+
+            method = cls.clone_template_file(source, destination, relative_path, mode)
+            stats[method] += 1
+            if method != 'copy':
+                stats['shared_bytes'] += os.path.getsize(destination)
+
+        cls.save_digests()
+
+        return stats
+
+    @classmethod
+    def sync_tree(cls, template_path, destination_path, mode='auto'):
+        """
+        Update a definition from it's template, only replacing the files with
+        a different content. Files missing from the template are kept.
+        :return: A dictionary with the number of added, updated and unchanged files.
+        """
+        stats = {'added': 0, 'updated': 0, 'unchanged': 0}
+
+        for relative_path in cls.walk_files(template_path):
+            source = os.path.join(template_path, relative_path)
+            destination = os.path.join(destination_path, relative_path)
+
+            if not os.path.exists(destination):
+                if not os.path.isdir(os.path.dirname(destination)):
+                    os.makedirs(os.path.dirname(destination), mode=0o755)
+                cls.clone_template_file(source, destination, relative_path, mode)
+                stats['added'] += 1
+            elif cls.is_same_content(source, destination) and (
+                mode in ('shared', 'hardlink') or not cls.is_store_link(source, destination)
+            ):
+                stats['unchanged'] += 1
+            else:
+                cls.clone_template_file(source, destination, relative_path, mode)
+                stats['updated'] += 1
+
+        cls.save_digests()
+
+        return stats
+
+    @classmethod
+    def clone_template_file(cls, source, destination, relative_path, mode):
+        file_mode = stat.S_IMODE(os.stat(source).st_mode)
+        if not cls.is_shareable(relative_path):
+            mode = 'copy'
+
+        # NOTE: Only the hard links require a read-only object in the store,
+        # the reflinks and the copies are cloned from the template itself.
+        if mode in ('shared', 'hardlink'):
+            source = cls.add_to_store(source)
+
+        return cls.clone_file(source, destination, file_mode, mode)
+
+    @classmethod
+    def is_store_link(cls, source, destination):
+        """
+        :return: Whether the destination is a hard link to the store object of
+          the template file, eg: created by the older versions. They are
+          replaced when updating the definition.
+        """
+        object_path = cls.get_object_path(source)
+        return os.path.exists(object_path) and os.path.samefile(object_path, destination)
+
+    @classmethod
+    def is_same_content(cls, source, destination):
+        if cls.is_store_link(source, destination):
+            return True
+
+        if os.path.getsize(destination) != os.path.getsize(source):
+            return False
+
+        return MiaUtils.get_file_hash(destination, 'sha1') == cls.get_file_digest(source)
@@ -7,6 +7,11 @@ available_commands = {}
 
 # Populate the available commands with classes and help information.
 from mia.commands.build import Build
+from mia.commands.cache import Cache
 from mia.commands.clean import Clean
+from mia.commands.daemon import Daemon
 from mia.commands.definition import Definition
+from mia.commands.deploy import Deploy
 from mia.commands.install import Install
+from mia.commands.make import Make
+from mia.commands.plan import Plan
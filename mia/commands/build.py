@@ -4,33 +4,129 @@ from a definition.
 
 Usage:
     mia build [--no-hash] <definition>
+    mia build [--no-hash] --all
+    mia build [--no-hash] --watch [--push [--emulator]] <definition>
     mia build --help
 
 Command options:
-    --no-hash  Build faster, skip hash computation.
+    --all       Build all the definitions from the workspace.
+    --no-hash   Build faster, skip hash computation.
+    --watch     Update the build when the archive files change, until
+                interrupted.
+    --push      Push the updated build onto the device after each change.
+    --emulator  Use running emulator instead of a real device.
 
 
 WARNING:
   Skipping the hash computation will allow you to install incomplete or broken
   builds onto your device.
 
+Notes:
+  In watch mode only the changed, added or removed files of the archive are
+  compressed again, the other members are copied as they are from the
+  previous build. The changes are detected using inotify on Linux, and by
+  checking the files regularly on the other platforms.
+
+  The signatures of the applications of the lock file are verified before
+  building, their signer certificates must match the pinned certificates.
+
+  The size and modification time of the archive files are saved with each
+  build, in a `.manifest.json` file next to it, see: mia plan
+
 
 """
 
 import glob
+import json
 import os
+import struct
 import sys
+import time
 import zipfile
 
+import yaml
+
 # Import custom helpers.
 from mia.commands import available_commands
+from mia.cache import MiaCache
 from mia.handler import MiaHandler
+from mia.profiler import MiaProfiler
+from mia.schema import MiaSchema
+from mia.settings import MiaSettings
 from mia.utils import MiaUtils
+from mia.watcher import MiaWatcher
 
 
 class Build(object):
     @classmethod
     def main(cls):
+        if MiaHandler.args['--all']:
+            return cls.build_all()
+
+        if MiaHandler.args['--watch']:
+            return cls.watch(not MiaHandler.args['--no-hash'])
+
+        zip_path = cls.build_update_zip(not MiaHandler.args['--no-hash'])
+
+        print('Build finished successfully:\n - {}'.format(zip_path))
+
+        return None
+
+    @classmethod
+    def build_all(cls):
+        definitions = MiaHandler.get_definition_names()
+        if not definitions:
+            print('ERROR: No definitions found in the workspace!')
+            sys.exit(1)
+
+        # Validate all the definitions before building any of them.
+        valid = True
+        for definition in definitions:
+            settings_file = os.path.join(
+                MiaHandler.get_workspace_path(), 'definitions', definition, 'settings.yaml'
+            )
+
+            try:
+                errors = MiaSchema.validate(MiaSettings.load(settings_file))
+            except yaml.YAMLError:
+                errors = ['Could not read configuration file!']
+
+            if errors:
+                MiaHandler.print_settings_errors(settings_file, errors)
+                valid = False
+
+        if not valid:
+            sys.exit(1)
+
+        zip_paths = []
+        for definition in definitions:
+            print('Building the "{}" definition:'.format(definition))
+            MiaHandler.set_definition(definition)
+            zip_paths.append(cls.build_update_zip(not MiaHandler.args['--no-hash']))
+            print('')
+
+        print('Build finished successfully:')
+        for zip_path in zip_paths:
+            print(' - {}'.format(zip_path))
+
+        return None
+
+    @staticmethod
+    def get_update_zip_path():
+        zip_name = '.'.join((
+            MiaHandler.args['<definition>'],
+            'mia-update.zip',
+        ))
+
+        return os.path.join(MiaHandler.get_workspace_path(), 'builds', zip_name)
+
+    @classmethod
+    def build_update_zip(cls, create_hash=True):
+        """
+        Build the update.zip file of the current definition.
+        :param create_hash: Whether to compute the md5 hash file of the build.
+        :return: The path to the built update.zip file.
+        """
         definition_path = MiaHandler.get_definition_path()
 
         # Create the builds directory.
@@ -38,11 +134,10 @@ class Build(object):
         if not os.path.isdir(builds_path):
             os.makedirs(builds_path, mode=0o755)
 
-        zip_name = '.'.join((
-            MiaHandler.args['<definition>'],
-            'mia-update.zip',
-        ))
-        zip_path = os.path.join(MiaHandler.get_workspace_path(), 'builds', zip_name)
+        # Do not build with APKs from unexpected signers.
+        cls.verify_signatures()
+
+        zip_path = cls.get_update_zip_path()
         if os.path.exists(zip_path):
             print('Deleting current build: {}'.format(zip_path))
             os.remove(zip_path)
@@ -52,6 +147,7 @@ class Build(object):
 
         # Build the ZIP file.
         archive_root_directory_path = os.path.join(definition_path, 'archive')
+        snapshot = cls.get_archive_snapshot(archive_root_directory_path)
         for entry in glob.glob(archive_root_directory_path + '/*'):
             # Allow only directories at the root of the generated update.zip
             if not os.path.isdir(entry):
@@ -59,11 +155,13 @@ class Build(object):
 
             destination = os.path.basename(entry)
             print('Adding "{}" directory to the archive:'.format(destination))
-            cls.add_directory_to_zip(zf, entry, destination)
+            with MiaProfiler.span('zip compression'):
+                cls.add_directory_to_zip(zf, entry, destination)
 
         # Make sure the created file is valid.
         print('Verifying built mia-update.zip file...')
-        bad_file = zf.testzip()
+        with MiaProfiler.span('zip test'):
+            bad_file = zf.testzip()
         zf.close()
         if bad_file:
             os.remove(zip_path)
@@ -71,7 +169,7 @@ class Build(object):
 
         # Only generate hash upon successful build. Keeping the old hash
         # will help prevent installing broken update.zip files.
-        if not MiaHandler.args['--no-hash']:
+        if create_hash:
             # NOTE: For now the TWRP OpenRecoveryScript only supports md5.
             # @see https://github.com/TeamWin/Team-Win-Recovery-Project/issues/450
             MiaUtils.create_hash_file(zip_path, 'md5')
@@ -81,10 +179,247 @@ class Build(object):
             if os.path.exists(hash_file_path):
                 os.remove(hash_file_path)
 
-        print('Build finished successfully:\n - {}'.format(zip_path))
+        cls.save_manifest(zip_path, snapshot)
+        MiaCache.touch(zip_path)
+
+        return zip_path
+
+    @staticmethod
+    def get_manifest_path(zip_path):
+        return zip_path + '.manifest.json'
+
+    @staticmethod
+    def get_archive_snapshot(archive_path):
+        """
+        :return: A dictionary mapping the files of the archive folders, by
+          their path in the update.zip file, to their size and modification
+          time.
+        """
+        snapshot = {}
+        for entry in glob.glob(archive_path + '/*'):
+            if not os.path.isdir(entry):
+                continue
+
+            for path, directories, files in os.walk(entry):
+                for file_name in files:
+                    file_stat = os.stat(os.path.join(path, file_name))
+                    path_in_zip = os.path.relpath(os.path.join(path, file_name), archive_path)
+                    snapshot[path_in_zip.replace(os.sep, '/')] = [file_stat.st_size, file_stat.st_mtime]
+
+        return snapshot
+
+    @classmethod
+    def save_manifest(cls, zip_path, snapshot):
+        """
+        Save the state of the archive files used by a build.
+        """
+        manifest_path = cls.get_manifest_path(zip_path)
+        with open(manifest_path + '.tmp', 'w') as fd:
+            json.dump({'files': snapshot, 'size': os.path.getsize(zip_path)}, fd, indent=0, sort_keys=True)
+        os.rename(manifest_path + '.tmp', manifest_path)
+
+    @classmethod
+    def load_manifest(cls, zip_path):
+        """
+        :return: The manifest of the build, or None if not found.
+        """
+        manifest_path = cls.get_manifest_path(zip_path)
+        if not os.path.isfile(manifest_path):
+            return None
+
+        try:
+            with open(manifest_path, 'r') as fd:
+                return json.load(fd)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def verify_signatures():
+        """
+        Verify the signatures of the downloaded APKs of the lock file, if any.
+        """
+        from mia.commands.definition import Definition
+
+        if not os.path.isfile(os.path.join(MiaHandler.get_definition_path(), 'apps_lock.yaml')):
+            return
+
+        lock_data = MiaHandler.get_definition_apps_lock_data() or []
+        report = Definition.verify_signatures(lock_data)
+
+        unpinned = len([apk_info for apk_info in lock_data if not apk_info.get('signer')])
+        if unpinned:
+            print('WARNING: %d apps without a pinned signer, see: mia definition dl-apps' % unpinned)
+
+        if report['errors']:
+            print('ERROR: Signature verification failed!')
+            sys.exit(1)
+        print('')
+
+    @classmethod
+    def watch(cls, create_hash=True):
+        """
+        Build the update.zip file, then update it when the archive changes.
+        """
+        archive_path = os.path.join(MiaHandler.get_definition_path(), 'archive')
+        watcher = MiaWatcher(archive_path)
+
+        zip_path = cls.build_update_zip(create_hash)
+        if MiaHandler.args['--push']:
+            cls.push_update_zip()
+
+        print('\n' + 'Watching for changes (%s), press Ctrl+C to stop:\n - %s' % (
+            'polling' if watcher.is_polling() else 'inotify', archive_path
+        ))
+
+        try:
+            while True:
+                changes = watcher.wait()
+
+                start_time = time.time()
+                if changes is None:
+                    print('Too many changes, building again:')
+                    cls.build_update_zip(create_hash)
+                else:
+                    cls.update_zip(zip_path, archive_path, changes, create_hash)
+                print('Updated the build in %.2fs.' % (time.time() - start_time))
+
+                if MiaHandler.args['--push']:
+                    cls.push_update_zip()
+        except KeyboardInterrupt:
+            print('\n' + 'Exiting...')
+        finally:
+            watcher.close()
 
         return None
 
+    @staticmethod
+    def push_update_zip():
+        # NOTE: Imported here, the install command depends on this command.
+        from mia.commands.install import Install
+
+        try:
+            Install.push_update_zip(False)
+        except (RuntimeError, SystemExit) as e:
+            # Keep watching, the device may be connected later.
+            print('WARNING: Could not push the build: %s' % e)
+
+    @staticmethod
+    def get_archive_members(archive_path, changes):
+        """
+        :param changes: The changed paths, relative to the archive folder.
+        :return: A (files, removed) tuple, the files to add to the update.zip
+          file mapped to their path in the archive, and the paths removed from
+          the archive.
+        """
+        files = {}
+        removed = set()
+        for change in changes:
+            change_path = os.path.join(archive_path, change)
+            if os.path.isfile(change_path):
+                change_files = [change_path]
+            elif os.path.isdir(change_path):
+                change_files = [
+                    os.path.join(path, file_name)
+                    for path, directories, file_names in os.walk(change_path) for file_name in file_names
+                ]
+            else:
+                removed.add(change.replace(os.sep, '/'))
+                continue
+
+            for file_path in change_files:
+                path_in_zip = os.path.relpath(file_path, archive_path)
+                # Allow only directories at the root of the generated update.zip
+                if os.sep in path_in_zip:
+                    files[path_in_zip.replace(os.sep, '/')] = file_path
+
+        return files, removed
+
+    @classmethod
+    def update_zip(cls, zip_path, archive_path, changes, create_hash=True):
+        """
+        Update the members of the update.zip file changed in the archive.
+        """
+        snapshot = cls.get_archive_snapshot(archive_path)
+        files, removed = cls.get_archive_members(archive_path, changes)
+        if not files and not removed:
+            print(' - no changes to the build.')
+            return
+
+        # Do not build with APKs from unexpected signers, as in a full build.
+        cls.verify_signatures()
+
+        temp_path = zip_path + '.tmp'
+        zin = zipfile.ZipFile(zip_path, mode='r')
+        zout = zipfile.ZipFile(temp_path, mode='w', compression=zipfile.ZIP_DEFLATED)
+
+        updated = []
+        with MiaProfiler.span('zip update'):
+            for info in zin.infolist():
+                if info.filename in files:
+                    # Replace the member, keeping it's position.
+                    print(' - updated {}'.format(info.filename))
+                    zout.write(files.pop(info.filename), info.filename)
+                    updated.append(info.filename)
+                elif info.filename in removed or any(info.filename.startswith(path + '/') for path in removed):
+                    print(' - removed {}'.format(info.filename))
+                else:
+                    cls.copy_zip_member(zin, zout, info)
+
+            for path_in_zip in sorted(files):
+                print(' - added {}'.format(path_in_zip))
+                zout.write(files[path_in_zip], path_in_zip)
+                updated.append(path_in_zip)
+
+        zin.close()
+        zout.close()
+
+        # Make sure the updated members are valid.
+        with MiaProfiler.span('zip test'):
+            zf = zipfile.ZipFile(temp_path, mode='r')
+            try:
+                for path_in_zip in updated:
+                    zf.read(path_in_zip)
+            except zipfile.BadZipfile:
+                os.remove(temp_path)
+                sys.exit('Updated zip file is corrupted: {!r}'.format(path_in_zip))
+            finally:
+                zf.close()
+
+        os.rename(temp_path, zip_path)
+
+        if create_hash:
+            MiaUtils.create_hash_file(zip_path, 'md5')
+
+        cls.save_manifest(zip_path, snapshot)
+        MiaCache.touch(zip_path)
+
+    @staticmethod
+    def copy_zip_member(zin, zout, info):
+        """
+        Copy a member between two zip files without compressing it again.
+        NOTE: The zipfile module does not support this, the member is copied
+          by hand, then registered in the central directory of the new file.
+        """
+        # The size of the data descriptors is not known, uncommon in builds.
+        if info.flag_bits & 0x08:
+            zout.writestr(info, zin.read(info.filename))
+            return
+
+        # The local file header ends with the name and the extra field lengths.
+        zin.fp.seek(info.header_offset)
+        header = zin.fp.read(30)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        data = zin.fp.read(name_length + extra_length + info.compress_size)
+
+        zout.fp.seek(getattr(zout, 'start_dir', zout.fp.tell()))
+        info.header_offset = zout.fp.tell()
+        zout.fp.write(header + data)
+
+        zout.filelist.append(info)
+        zout.NameToInfo[info.filename] = info
+        zout.start_dir = zout.fp.tell()
+        zout._didModify = True
+
     @staticmethod
     def add_directory_to_zip(zf, source, destination):
         for path, directories, files in os.walk(source):
@@ -96,7 +431,9 @@ class Build(object):
                     path_in_zip = os.path.join(destination, file_name)
 
                 print(' - {}'.format(path_in_zip))
-                zf.write(os.path.join(path, file_name), path_in_zip)
+                with MiaProfiler.span('zip member') as span:
+                    span.add('bytes', os.path.getsize(os.path.join(path, file_name)))
+                    zf.write(os.path.join(path, file_name), path_in_zip)
 
 
 # Add command to the list of available commands.
@@ -0,0 +1,139 @@
+"""
+Export the workspace caches to a single pack file, or import them from one,
+eg: to build on hosts without network access.
+
+Usage:
+    mia cache export [--force] <pack>
+    mia cache import [--mount] [--force] <pack>
+    mia cache --help
+
+Available sub-commands:
+    export  Save the repository indexes, the APKs and the OS zip files from the
+            workspace resources folder to a pack file.
+    import  Verify the files of a pack, and extract them into the workspace.
+
+Command options:
+    --force  Overwrite the existing pack file, or the existing workspace files.
+    --mount  Do not extract the files now, extract the missing workspace files
+             from the pack when first needed instead.
+
+
+Notes:
+  The hash of every file of the pack is verified when importing, and when
+  extracting the files of a mounted pack. Only the files of the workspace
+  resources folder, as exported, are accepted. The mounted packs are listed in the
+  `resources/packs.json` file of the workspace.
+
+
+"""
+
+import os
+import sys
+
+# Import custom helpers.
+from mia.commands import available_commands
+from mia.cache import MiaCache
+from mia.handler import MiaHandler
+from mia.pack import MiaPack, MiaPackError
+from mia.tasks import MiaTaskError, MiaTaskGroup
+from mia.utils import MiaUtils
+
+
+class Cache(object):
+    @classmethod
+    def main(cls):
+        if MiaHandler.args['export']:
+            cls.export_pack()
+        else:
+            cls.import_pack()
+
+    @staticmethod
+    def export_pack():
+        pack_path = MiaHandler.args['<pack>']
+        if os.path.exists(pack_path) and not MiaHandler.args['--force']:
+            print('ERROR: The pack file already exists, use --force to overwrite it:\n - %s' % pack_path)
+            sys.exit(1)
+
+        relative_paths = MiaPack.get_workspace_files()
+        if not relative_paths:
+            print('ERROR: The workspace resources folder is empty!')
+            sys.exit(1)
+
+        print('Packing %d files:' % len(relative_paths))
+        toc = MiaPack.create(pack_path, relative_paths, Cache.print_entry)
+
+        print('\nSaved the pack file, %s:\n - %s' % (
+            MiaUtils.format_file_size(sum(entry['size'] for entry in toc['entries'])),
+            os.path.abspath(pack_path)
+        ))
+
+    @classmethod
+    def import_pack(cls):
+        try:
+            pack = MiaPack(MiaHandler.args['<pack>'])
+        except (IOError, MiaPackError) as e:
+            print('ERROR: %s' % e)
+            sys.exit(1)
+
+        workspace_path = MiaHandler.get_workspace_path()
+        mount = MiaHandler.args['--mount']
+
+        # Verify all the entries, then extract each one as soon as it is verified.
+        group = MiaTaskGroup(fail_fast=False)
+        imported_paths = []
+        for entry in pack.toc['entries']:
+            try:
+                file_path = MiaPack.get_file_path(entry['path'])
+            except MiaPackError as e:
+                print('ERROR: %s' % e)
+                sys.exit(1)
+
+            if not mount and not MiaHandler.args['--force'] and cls.is_extracted(entry, file_path):
+                continue
+
+            verify = group.add('verify %s' % entry['path'], pack.verify, (entry,), 'hash')
+            if not mount:
+                group.add('extract %s' % entry['path'], pack.extract, (entry, file_path), 'disk', [verify])
+                imported_paths.append(file_path)
+
+        print('Verifying %d of the %d files of the pack...' % (
+            len(group.tasks) if mount else len(imported_paths), len(pack.entries)
+        ))
+        try:
+            group.run()
+        except MiaTaskError as e:
+            print('ERROR: %s' % e)
+            sys.exit(1)
+
+        if mount:
+            MiaPack.mount(pack.path)
+            print('Mounted the pack file:\n - %s' % pack.path)
+            return
+
+        MiaCache.touch(*imported_paths)
+        print('Extracted %d files, %s into:\n - %s' % (
+            len(imported_paths),
+            MiaUtils.format_file_size(sum(os.path.getsize(path) for path in imported_paths)),
+            os.path.join(workspace_path, 'resources')
+        ))
+
+    @staticmethod
+    def print_entry(entry):
+        print(' - %s (%s)' % (entry['path'], MiaUtils.format_file_size(entry['size'])))
+
+    @staticmethod
+    def is_extracted(entry, file_path):
+        """
+        :return: Whether the file already exists with the same content.
+        """
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) != entry['size']:
+            return False
+
+        return MiaUtils.get_file_hash(file_path, 'sha256') == entry['sha256']
+
+
+# Add command to the list of available commands.
+available_commands['cache'] = {
+    'class': Cache,
+    'help': __doc__,
+}
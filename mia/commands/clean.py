@@ -3,29 +3,42 @@ The clean command can be use to cleanup the workspace or definition files.
 
 Usage:
     mia clean [<definition>]
+    mia clean --gc --max-size=<size>
     mia clean --help
 
+Command options:
+    --gc               Evict the least recently used cached artifacts, which
+                       are not used by any definition.
+    --max-size=<size>  The size budget of the workspace caches, eg: 20G.
+
 
 """
 
 import os
 import re
-import shutil
 import sys
 
 # Import custom helpers.
 from mia.commands import available_commands
+from mia.cache import MiaCache
 from mia.handler import MiaHandler
+from mia.trash import MiaTrash
+from mia.utils import MiaUtils
 
 
 class Clean(object):
     @classmethod
     def main(cls):
-        if MiaHandler.args['<definition>']:
+        if MiaHandler.args['--gc']:
+            cls.collect_garbage()
+        elif MiaHandler.args['<definition>']:
             cls.clean_definition()
         else:
             cls.clean_workspace()
 
+        # The removed items are already in the trash, delete them.
+        cls.empty_trash()
+
     @staticmethod
     def clean_definition():
         if not re.search(r'^[a-z][a-z0-9-]+$', MiaHandler.args['<definition>']):
@@ -45,40 +58,67 @@ class Clean(object):
                 continue
 
             print('Removing the %s apps from:\n - %s\n' % (app_type, full_path))
-            shutil.rmtree(full_path)
+            MiaTrash.move(full_path)
+
+    @staticmethod
+    def collect_garbage():
+        max_size = MiaCache.parse_size(MiaHandler.args['--max-size'])
+        if max_size is None:
+            print('ERROR: Invalid size: %s' % MiaHandler.args['--max-size'])
+            sys.exit(1)
+
+        print('Workspace directory is:\n - %s\n' % MiaHandler.get_workspace_path())
+
+        evicted, cache_size = MiaCache.collect_garbage(max_size)
+        if evicted is None:
+            print('Skipped the garbage collection, fix the definition files first.')
+            return
+
+        if evicted:
+            print('Evicted the least recently used artifacts:')
+            for artifact in evicted:
+                print(' - %s (%s)' % (artifact['key'], MiaUtils.format_file_size(artifact['size'])))
+
+        reclaimed_size = sum(artifact['size'] for artifact in evicted)
+        print('\nReclaimed %s, the workspace caches use %s of %s.' % (
+            MiaUtils.format_file_size(reclaimed_size),
+            MiaUtils.format_file_size(cache_size),
+            MiaUtils.format_file_size(max_size)
+        ))
+
+        if cache_size > max_size:
+            print('WARNING: The artifacts used by the definitions do not fit in the budget!')
 
     @staticmethod
     def clean_workspace():
         workspace_path = MiaHandler.get_workspace_path()
         print('Workspace directory is:\n - %s\n' % workspace_path)
 
-        # Clean the workspace builds folder.
-        builds_path = os.path.join(workspace_path, 'builds')
-        if os.path.isdir(builds_path):
-            print('Removing items from builds:\n - %s' % builds_path)
-            dir_items = [f for f in os.listdir(builds_path)]
-            for item in dir_items:
-                item_path = os.path.join(builds_path, item)
-                if os.path.isdir(item_path):
-                    print(' - removing directory: %s' % item)
-                    shutil.rmtree(item_path)
-                else:
-                    print(' - removing file: %s' % item)
-                    os.remove(item_path)
-
-        # Clean the workspace resources folder.
-        resources_path = os.path.join(workspace_path, 'resources')
-        if os.path.isdir(resources_path):
-            print('Removing items from resources:\n - %s' % resources_path)
-            dir_items = [f for f in os.listdir(resources_path)]
-            for item in dir_items:
-                item_path = os.path.join(resources_path, item)
-                if os.path.isdir(item_path):
-                    print('   - removing directory: %s' % item)
-                    shutil.rmtree(item_path)
-                else:
-                    print('   - removing file: %s' % item)
-                    os.remove(item_path)
+        # Move the builds and resources folders to the trash, and replace them
+        # with empty ones, so the workspace can be used again right away.
+        for folder in ('builds', 'resources'):
+            folder_path = os.path.join(workspace_path, folder)
+            if not os.path.isdir(folder_path):
+                continue
+
+            print('Removing the %s:\n - %s' % (folder, folder_path))
+            MiaTrash.move(folder_path)
+            os.makedirs(folder_path, mode=0o755)
+
+    @staticmethod
+    def empty_trash():
+        collector = MiaTrash.empty_in_background()
+        collector.join()
+
+        if collector.files_count:
+            print('\nDeleted %d files, %s in %.2f seconds.' % (
+                collector.files_count,
+                MiaUtils.format_file_size(collector.bytes_count),
+                collector.duration
+            ))
+
+        for error in collector.errors:
+            print('WARNING: %s' % error)
 
 
 # Add command to the list of available commands.
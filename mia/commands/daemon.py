@@ -0,0 +1,77 @@
+"""
+Run the mia commands of the current workspace in a long-running process, which
+keeps the parsed settings, repository indexes and file hashes in memory.
+
+Usage:
+    mia daemon start
+    mia daemon stop
+    mia daemon status
+    mia daemon --help
+
+Available sub-commands:
+    start   Start the daemon of the workspace, in the foreground.
+    stop    Stop the daemon of the workspace.
+    status  Display if the daemon of the workspace is running.
+
+
+Notes:
+    While the daemon is running, the mia commands of the workspace are
+    forwarded to it, and run one at a time. Otherwise they run as usual.
+    Set the MIA_NO_DAEMON environment variable to never use the daemon.
+
+    The daemon can be started in the background, eg: `mia daemon start &`.
+
+
+"""
+
+import sys
+
+# Import custom helpers.
+from mia.commands import available_commands
+from mia.daemon import MiaDaemon
+from mia.handler import MiaHandler
+
+
+class Daemon(object):
+    @classmethod
+    def main(cls):
+        if MiaHandler.args['start']:
+            cls.start()
+        elif MiaHandler.args['stop']:
+            cls.stop()
+        else:
+            cls.status()
+
+    @staticmethod
+    def start():
+        # NOTE: The CLI module is imported as mia.__main__ by the mia script.
+        from mia.__main__ import run
+
+        MiaDaemon.serve(MiaHandler.get_workspace_path(), run)
+
+    @staticmethod
+    def stop():
+        if MiaDaemon.request(MiaHandler.get_workspace_path(), 'stop') is None:
+            print('The daemon is not running.')
+            sys.exit(1)
+
+        print('The daemon was stopped.')
+
+    @staticmethod
+    def status():
+        status = MiaDaemon.request(MiaHandler.get_workspace_path(), 'status')
+        if status is None:
+            print('The daemon is not running.')
+            sys.exit(1)
+
+        print('The daemon is running:')
+        print(' - pid: %d' % status['pid'])
+        print(' - uptime: %ds' % status['uptime'])
+        print(' - commands: %d' % status['commands'])
+
+
+# Add command to the list of available commands.
+available_commands['daemon'] = {
+    'class': Daemon,
+    'help': __doc__,
+}
@@ -3,14 +3,19 @@ Create and configure a definition in the current workspace using the provided
 template.
 
 Usage:
-    mia definition create [--cpu=<cpu>] [--force] [--template=<template>]
-                          [<definition>]
+    mia definition create [--cpu=<cpu>] [--force] [--copy]
+                          [--template=<template>] [<definition>]
+    mia definition create [--cpu=<cpu>] [--force] [--copy]
+                          [--template=<template>] --matrix=<file>
     mia definition configure <definition>
-    mia definition lock [--force-latest] <definition>
+    mia definition lock [--force-latest] [--update] <definition>
     mia definition dl-apps <definition>
-    mia definition dl-os <definition>
+    mia definition verify-apps [--cpu=<cpu>] <definition>
+    mia definition dl-os [--url=<url>] [--md5=<md5>] [--segments=<count>]
+                         <definition>
     mia definition extract-update-binary <definition>
-    mia definition update-from-template <definition>
+    mia definition update-from-template [--copy] <definition>
+    mia definition search [--limit=<count>] [--ids] <terms>...
     mia definition --help
 
 Available sub-commands:
@@ -18,45 +23,113 @@ Available sub-commands:
     configure              Configures a definition.
     lock                   Creates a lock file for the applications.
     dl-apps                Downloads the applications using data from the lock file.
-    dl-os                  Show information on how to download and verify an OS zip.
+    verify-apps            Checks the package id, versioncode and native code
+                           of the downloaded applications.
+    dl-os                  Download and verify the OS zip file.
     extract-update-binary  Extract the update-binary from the CyanogenMod zip file.
     update-from-template   Update definition from template
+    search                 Search the apps of the repositories.
 
 Command options:
     --template=<template>  The template to use. [default: mia-default]
     --cpu=<cpu>            The device CPU architecture. [default: armeabi]
     --force                Delete existing definition.
+    --copy                 Copy the template files, instead of sharing them
+                           using reflinks.
+    --matrix=<file>        Create, lock and download the apps of the
+                           definitions listed in a devices file.
     --force-latest         Force using the latest versions.
+    --update               Refresh the repository indexes, and only resolve
+                           again the apps which changed since the last lock.
+    --url=<url>            The URL of the OS zip file, overrides the settings.
+    --md5=<md5>            The md5 checksum of the OS zip file, overrides the settings.
+    --segments=<count>     The number of parallel download requests. [default: 4]
+    --limit=<count>        The maximum number of search results. [default: 20]
+    --ids                  Only list the app ids starting with the terms,
+                           eg: for shell completion.
 
 
 Notes:
     A valid <definition> name consists of lowercase letters, digits and hyphens.
     And it must start with a letter name.
 
+    The downloaded applications are checked against their lock information,
+    and the applications without native code are shared between the CPU
+    architecture caches of the workspace.
+
+    The signatures of the downloaded applications are verified, and the
+    SHA-256 fingerprint of their signer certificate is pinned in the lock
+    file, from the repository index or when first downloaded. The updates of
+    an application must be signed using the pinned certificate.
+
+    The repository indexes are downloaded in the compressed index-v1 format
+    when available, falling back to the index.xml file, and only the apps of
+    the definition are read from them.
+
+    The search matches the id, name, summary and categories of the apps from
+    the repositories of the workspace definitions, or of the template if
+    there are no definitions yet.
+
+    A devices file lists the definitions to create, eg:
+        template: mia-default
+        definitions:
+          - name: nexus-4
+            device_codename: mako
+            os_version: 12.1
+          - name: nexus-5
+            device_codename: hammerhead
+            os_version: 12.1
+
 
 """
 
+import hashlib
+import json
 import re
 import os
 import shutil
 import sys
 import zipfile
-import distutils.dir_util
-import xml.etree.ElementTree as ElementTree
 
 import yaml
 
 # Import custom helpers.
 from mia.commands import available_commands
 from mia.android import MiaAndroid
-from mia.fdroid import MiaFDroid
+from mia.apk import MiaApk, MiaApkError
+from mia.cache import MiaCache
+from mia.clone import MiaClone
+from mia.download import DownloadError, DownloadNotFoundError, MiaDownloader
+from mia.fdroid import MiaFDroid, MiaFDroidJsonRepository
 from mia.handler import MiaHandler
+from mia.mirrors import MiaMirrors
+from mia.pack import MiaPack
+from mia.profiler import MiaProfiler
+from mia.schema import MiaSchema
+from mia.search import MiaSearch
+from mia.settings import MiaSettings
+from mia.signature import MiaSignature
+from mia.tasks import MiaTaskError, MiaTaskGroup
+from mia.trash import MiaTrash
 from mia.utils import MiaUtils
 
 
 class Definition(object):
+    # Maps index file paths to (modification time, repository) tuples.
+    __parsed_indexes = {}
+
     @classmethod
     def main(cls):
+        # Create multiple definitions, non-interactively.
+        if MiaHandler.args['--matrix']:
+            cls.create_definitions_matrix()
+            return None
+
+        # Search the repositories, no definition is needed.
+        if MiaHandler.args['search']:
+            cls.search_apps()
+            return None
+
         # The definition name is optional, this is helpful for new users.
         if MiaHandler.args['<definition>'] is None:
             msg = 'Please provide a definition name'
@@ -82,18 +155,25 @@ class Definition(object):
         if MiaHandler.args['update-from-template']:
             cls.update_definition()
 
-        # Create the apps lock file.
-        if MiaHandler.args['lock']:
+        # Create or update the apps lock file.
+        if MiaHandler.args['lock'] and MiaHandler.args['--update']:
+            cls.update_apps_lock_file()
+        elif MiaHandler.args['lock']:
             cls.create_apps_lock_file()
 
         # Download the CyanogenMod OS.
         if MiaHandler.args['dl-os']:
+            cls.get_segments_count()
             cls.download_os()
 
         # Download apps.
         if MiaHandler.args['dl-apps']:
             cls.download_apps()
 
+        # Check the downloaded apps.
+        if MiaHandler.args['verify-apps']:
+            cls.verify_apps()
+
         # Extract the update-binary from the CyanogenMod zip file.
         if MiaHandler.args['extract-update-binary']:
             cls.extract_update_binary()
@@ -129,12 +209,182 @@ class Definition(object):
             os.makedirs(definitions_path, mode=0o755)
 
         # Create the definition using the provided template.
-        shutil.copytree(template_path, definition_path)
+        cls.clone_template(template_path, definition_path)
 
         # Configure the definition.
         if MiaUtils.input_confirm('Configure now?', True):
             cls.configure_definition()
 
+    @classmethod
+    def create_definitions_matrix(cls):
+        """
+        Create the definitions listed in a devices file, resolving their apps
+        together and downloading each APK only once.
+        """
+        matrix_file = MiaHandler.args['--matrix']
+        try:
+            matrix = MiaSettings.load(matrix_file)
+        except (IOError, OSError, yaml.YAMLError) as e:
+            print('ERROR: Could not read the devices file: %s' % e)
+            sys.exit(1)
+
+        schema_path = os.path.join(os.path.dirname(MiaSchema.get_schema_path()), 'schema-matrix.yaml')
+        errors = MiaSchema.validate(matrix, schema_path)
+        for device in (matrix or {}).get('definitions') or []:
+            if not re.search(r'^[a-z][a-z0-9-]+$', str(device.get('name'))):
+                errors.append('%s: Invalid definition name.' % device.get('name'))
+        if errors:
+            MiaHandler.print_settings_errors(matrix_file, errors)
+            sys.exit(1)
+
+        template = matrix.get('template') or MiaHandler.args['--template']
+        template_path = MiaHandler.get_template_path(template)
+        if template_path is None:
+            print('ERROR: Template "%s" does not exist!' % template)
+            sys.exit(1)
+        print('Using template:\n - %s\n' % template_path)
+
+        # The apps resolved for a definition are reused by the next ones.
+        resolved = {}
+        results = []
+        for device in matrix['definitions']:
+            result = {'name': device['name'], 'lock_data': None, 'warnings': False, 'error': None}
+            results.append(result)
+
+            print('Creating the %s definition.' % device['name'])
+            MiaHandler.set_definition(device['name'])
+            definition_path = MiaHandler.get_definition_path()
+
+            if os.path.exists(definition_path):
+                if not MiaHandler.args['--force']:
+                    result['error'] = 'the definition already exists'
+                    continue
+                MiaTrash.move(definition_path)
+
+            cls.clone_template(template_path, definition_path)
+
+            general = dict((key, value) for key, value in device.items() if key != 'name')
+            general['template'] = template
+            settings_file = os.path.join(definition_path, 'settings.yaml')
+            MiaUtils.update_settings(settings_file, {'general': {'update': general}})
+
+            settings = MiaHandler.get_definition_settings()
+            errors = MiaSchema.validate(settings)
+            if errors:
+                MiaHandler.print_settings_errors(settings_file, errors)
+                result['error'] = 'invalid settings'
+                continue
+
+            repositories_data = cls.get_repositories_data(settings)
+            lock_data, result['warnings'] = cls.resolve_apps(settings, repositories_data, resolved)
+
+            lock_file_path = os.path.join(definition_path, 'apps_lock.yaml')
+            MiaSettings.save(lock_file_path, lock_data)
+            result['lock_data'] = lock_data
+            result['settings'] = settings
+            print('')
+
+        downloads = cls.download_matrix_apps([result for result in results if result['lock_data'] is not None])
+
+        cls.print_matrix_report(results, downloads)
+
+        if any(result['error'] for result in results):
+            sys.exit(1)
+
+    @classmethod
+    def download_matrix_apps(cls, results):
+        """
+        Download each APK used by the definitions once, and share it with the
+        definitions.
+        :return: A (unique APKs count, APK references count, downloaded bytes) tuple.
+        """
+        architecture_cache = MiaHandler.args['--cpu'] + '-apps'
+        cache_directory = os.path.join(MiaHandler.get_workspace_path(), 'resources', architecture_cache)
+        if not os.path.isdir(cache_directory):
+            os.makedirs(cache_directory, mode=0o755)
+
+        # Find the unique APKs, by cache path.
+        apks = {}
+        references = 0
+        for result in results:
+            repositories = dict((repo_info['id'], repo_info) for repo_info in result['settings']['repositories'])
+            for apk_info in result['lock_data']:
+                cache_path = os.path.join(cache_directory, apk_info['package_name'])
+                apks.setdefault(cache_path, (repositories.get(apk_info.get('repository')), apk_info))
+                references += 1
+
+        print('Downloading %d unique APKs, used %d times:' % (len(apks), references))
+        group = MiaTaskGroup(fail_fast=False)
+        downloads = {}
+        for cache_path in sorted(apks):
+            repo_info, apk_info = apks[cache_path]
+            apk_name = apk_info['package_name']
+
+            if repo_info is not None:
+                downloads[cache_path] = group.add('download %s' % apk_name, cls.download_repository_apk, (
+                    repo_info, apk_info, cache_path
+                ), 'network')
+            elif not os.path.isfile(cache_path):
+                download = group.add('download %s' % apk_name, cls.download_url_apk, (apk_info, cache_path), 'network')
+                downloads[cache_path] = group.add(
+                    'verify %s' % apk_name, cls.verify_apk, (apk_info, cache_path), 'hash', [download]
+                )
+
+        try:
+            group.run()
+        except MiaTaskError as e:
+            print('ERROR: %s' % e)
+
+        failed = set(cache_path for cache_path, task in downloads.items() if task.state != 'done')
+        downloaded_bytes = sum(os.path.getsize(cache_path) for cache_path in apks if cache_path not in failed)
+
+        MiaCache.touch(*[cache_path for cache_path in apks if cache_path not in failed])
+
+        # Share the cached APKs with the definitions.
+        for result in results:
+            definition_path = os.path.join(MiaHandler.get_workspace_path(), 'definitions', result['name'])
+            for apk_info in result['lock_data']:
+                cache_path = os.path.join(cache_directory, apk_info['package_name'])
+                if cache_path in failed:
+                    result['error'] = 'some APKs could not be downloaded'
+                    continue
+
+                relative_path = result['settings']['app_types'][apk_info['type']]
+                download_path = os.path.join(definition_path, 'archive', relative_path)
+                if not os.path.isdir(download_path):
+                    os.makedirs(download_path, mode=0o755)
+
+                cls.place_apk(cache_path, os.path.join(download_path, apk_info['package_name']))
+
+        return len(apks), references, downloaded_bytes
+
+    @staticmethod
+    def print_matrix_report(results, downloads):
+        print('\nDefinitions:')
+        for result in results:
+            if result['error']:
+                print(' - %s: FAILED, %s.' % (result['name'], result['error']))
+            elif result['warnings']:
+                print(' - %s: %d apps, some apps are missing.' % (result['name'], len(result['lock_data'])))
+            else:
+                print(' - %s: %d apps.' % (result['name'], len(result['lock_data'])))
+
+        print('Used %d unique APKs (%s) for %d APKs of %d definitions.' % (
+            downloads[0], MiaUtils.format_file_size(downloads[2]), downloads[1], len(results)
+        ))
+
+    @staticmethod
+    def clone_template(template_path, definition_path):
+        mode = 'copy' if MiaHandler.args['--copy'] else 'auto'
+        with MiaProfiler.span('template clone'):
+            stats = MiaClone.clone_tree(template_path, definition_path, mode)
+
+        print('Created the definition files: %d reflinks, %d hard links, %d copies.' % (
+            stats['reflink'], stats['hardlink'], stats['copy']
+        ))
+        if stats['shared_bytes']:
+            print(' - sharing %s with the template.\n' % MiaUtils.format_file_size(stats['shared_bytes']))
+
     @staticmethod
     def update_definition():
         definition_path = MiaHandler.get_definition_path()
@@ -150,8 +400,14 @@ class Definition(object):
             print('ERROR: Template "%s" does not exist!' % template)
             sys.exit(1)
 
-        # Create the definition using the provided template.
-        distutils.dir_util.copy_tree(template_path, definition_path)
+        # Only replace the files with a different content.
+        mode = 'copy' if MiaHandler.args['--copy'] else 'auto'
+        with MiaProfiler.span('template sync'):
+            stats = MiaClone.sync_tree(template_path, definition_path, mode)
+
+        print('Updated the definition files: %d added, %d updated, %d unchanged.' % (
+            stats['added'], stats['updated'], stats['unchanged']
+        ))
 
     @classmethod
     def configure_definition(cls):
@@ -208,33 +464,245 @@ class Definition(object):
             cls.download_apps()
 
     @classmethod
-    def create_apps_lock_file(cls):
+    def create_apps_lock_file(cls, interactive=True):
+        """
+        :param interactive: Whether to ask before continuing with warnings,
+          and before downloading the apps.
+        """
         # Get the APK lock data.
-        lock_data = cls.get_apps_lock_info()
+        lock_data = cls.get_apps_lock_info(interactive)
 
         definition_path = MiaHandler.get_definition_path()
         lock_file_path = os.path.join(definition_path, 'apps_lock.yaml')
+
+        # Keep the pinned signers of the apps.
+        if os.path.isfile(lock_file_path):
+            try:
+                old_lock_data = MiaSettings.load(lock_file_path) or []
+            except yaml.YAMLError:
+                old_lock_data = []
+
+            signers = dict(
+                (lock_info['id'], lock_info['signer']) for lock_info in old_lock_data if lock_info.get('signer')
+            )
+            for lock_info in lock_data:
+                if lock_info['id'] in signers:
+                    lock_info['signer'] = signers[lock_info['id']]
+
         print('Creating lock file:\n - %s\n' % lock_file_path)
 
-        fd = open(lock_file_path, 'w')
         try:
-            fd.write(yaml.dump(lock_data, default_flow_style=False))
-            fd.close()
+            MiaSettings.save(lock_file_path, lock_data)
         except yaml.YAMLError:
             print('ERROR: Could not save the lock file!')
             sys.exit(1)
-        finally:
-            fd.close()
+
+        # Use the new lock data, without reading the file again.
+        MiaHandler.set_definition_apps_lock_data(lock_data)
 
         # Download apps.
-        if MiaHandler.args['lock'] and MiaUtils.input_confirm('Download apps now?', True):
+        if interactive and MiaHandler.args['lock'] and MiaUtils.input_confirm('Download apps now?', True):
             cls.download_apps()
 
+    @classmethod
+    def update_apps_lock_file(cls, interactive=True, refresh=True):
+        """
+        Refresh the repository indexes and update the lock file, resolving only
+        the apps whose settings or repository packages changed.
+        :param interactive: Whether to ask before continuing with warnings,
+          and before downloading the apps.
+        :param refresh: Whether to refresh the indexes and to resolve again
+          the apps whose packages changed. Otherwise, only the apps whose
+          locked versions do not match their settings anymore are resolved.
+        """
+        settings = MiaHandler.get_definition_settings()
+        definition_path = MiaHandler.get_definition_path()
+        lock_file_path = os.path.join(definition_path, 'apps_lock.yaml')
+        if not os.path.isfile(lock_file_path):
+            print('No lock file found, creating a new one.')
+            cls.create_apps_lock_file(interactive)
+            return
+
+        old_lock_data = MiaHandler.get_definition_apps_lock_data() or []
+        repositories_data = cls.get_repositories_data(settings, refresh)
+
+        # Match the settings entries with the locked apps, in order.
+        locked_apps = {}
+        for lock_info in old_lock_data:
+            locked_apps.setdefault(lock_info['id'], []).append(lock_info)
+
+        entries = []
+        changed_apps = []
+        for app_info in settings['apps']:
+            lock_info = locked_apps[app_info['id']].pop(0) if locked_apps.get(app_info['id']) else None
+            changed = lock_info is None or cls.is_lock_outdated(
+                settings, app_info, lock_info, repositories_data, refresh
+            )
+            if changed:
+                changed_apps.append(app_info)
+            entries.append((app_info, lock_info, changed))
+
+        print('Resolving %d of %d apps.' % (len(changed_apps), len(entries)))
+        resolved, warnings_found = cls.resolve_apps(dict(settings, apps=changed_apps), repositories_data)
+        resolved_apps = {}
+        for lock_info in resolved:
+            resolved_apps.setdefault(lock_info['id'], []).append(lock_info)
+
+        lock_data = []
+        updated_apps = []
+        refreshed = False
+        for app_info, lock_info, changed in entries:
+            new_lock_info = lock_info
+            if changed:
+                new_lock_info = resolved_apps[app_info['id']].pop(0) if resolved_apps.get(app_info['id']) else None
+            if new_lock_info is None:
+                continue
+
+            # The updates must be signed using the pinned certificate.
+            if lock_info is not None and lock_info.get('signer') and new_lock_info is not lock_info:
+                new_lock_info['signer'] = lock_info['signer']
+
+            lock_data.append(new_lock_info)
+            if lock_info is not None and dict(new_lock_info, index_fingerprint=None) == dict(
+                lock_info, index_fingerprint=None
+            ):
+                # The same package, only the index fingerprint is updated.
+                refreshed = refreshed or new_lock_info != lock_info
+            else:
+                updated_apps.append((lock_info, new_lock_info))
+
+        removed_apps = [lock_info for lock_infos in locked_apps.values() for lock_info in lock_infos]
+
+        cls.print_lock_update_report(updated_apps, removed_apps)
+
+        if warnings_found and interactive:
+            msg = 'Warnings found, some APKs will not be downloaded! Continue?'
+            if not MiaUtils.input_confirm(msg):
+                sys.exit(1)
+
+        if not updated_apps and not removed_apps and not refreshed:
+            return
+
+        print('Updating lock file:\n - %s\n' % lock_file_path)
+        try:
+            MiaSettings.save(lock_file_path, lock_data)
+        except yaml.YAMLError:
+            print('ERROR: Could not save the lock file!')
+            sys.exit(1)
+        MiaHandler.set_definition_apps_lock_data(lock_data)
+
+        # Remove the replaced APKs from the definition archive.
+        package_names = set(lock_info['package_name'] for lock_info in lock_data)
+        for lock_info in [old for old, new in updated_apps if old is not None] + removed_apps:
+            apk_path = os.path.join(
+                definition_path, 'archive', settings['app_types'][lock_info['type']], lock_info['package_name']
+            )
+            if lock_info['package_name'] not in package_names and os.path.isfile(apk_path):
+                os.remove(apk_path)
+
+        # Only download the changed APKs.
+        if updated_apps and interactive and MiaUtils.input_confirm('Download the updated apps now?', True):
+            cls.download_apps([new for old, new in updated_apps])
+
+    @classmethod
+    def is_lock_outdated(cls, settings, app_info, lock_info, repositories_data, check_packages=True):
+        """
+        Check if the settings entry or the repository packages of an app
+        changed since the app was locked, the packages are compared with the
+        index fingerprint stored in the lock entry.
+        :param check_packages: Whether the changed packages outdate the app.
+        """
+        if 'url' in app_info:
+            return (
+                lock_info.get('package_url') != app_info['url'] or
+                lock_info.get('package_name') != app_info['name'] or
+                lock_info.get('hash') != app_info['hash']
+            )
+
+        repository = app_info.get('repository', settings['defaults']['repository'])
+        repositories = [repository]
+        if repositories_data.get(repository, {}).get('fallback'):
+            repositories.append(repositories_data[repository]['fallback'])
+
+        if lock_info.get('repository') not in repositories:
+            return True
+
+        if lock_info.get('type') != app_info.get('type', settings['defaults']['app_type']):
+            return True
+
+        if 'hash' in app_info and lock_info.get('hash') != app_info['hash']:
+            return True
+
+        if 'versioncode' in app_info:
+            # The pinned versions are not updated, unless forced.
+            if MiaHandler.args['--force-latest']:
+                return True
+            if not MiaFDroid.fdroid_match_constraints(lock_info.get('package_versioncode'), app_info['versioncode']):
+                return True
+
+        if not check_packages:
+            return False
+
+        index_fingerprint = cls.get_index_fingerprint(repositories_data, repositories, app_info['id'])
+        return lock_info.get('index_fingerprint') != index_fingerprint
+
+    @staticmethod
+    def get_index_fingerprint(repositories_data, repositories, app_id):
+        """
+        :return: The hash of the packages of an app in the indexes of it's
+          repositories, the app needs to be resolved again when it changes.
+        """
+        packages = [
+            [repo_id, repositories_data[repo_id]['index'].get_fingerprint(app_id)]
+            for repo_id in repositories if repo_id in repositories_data
+        ]
+
+        return hashlib.sha1(json.dumps(packages).encode('utf-8')).hexdigest()
+
     @staticmethod
-    def get_apps_lock_info():
+    def print_lock_update_report(updated_apps, removed_apps):
+        if not updated_apps and not removed_apps:
+            print('The lock file is up to date.')
+            return
+
+        print('Updated apps:')
+        for old_lock_info, new_lock_info in updated_apps:
+            if old_lock_info is None:
+                print(' - %s: new, %s' % (new_lock_info['id'], new_lock_info.get('package_versioncode', '-')))
+            else:
+                print(' - %s: %s -> %s' % (
+                    new_lock_info['id'],
+                    old_lock_info.get('package_versioncode', '-'),
+                    new_lock_info.get('package_versioncode', '-')
+                ))
+
+        for lock_info in removed_apps:
+            print(' - %s: removed' % lock_info['id'])
+        print('')
+
+    @classmethod
+    def get_apps_lock_info(cls, interactive=True):
         # Read the definition settings.
         settings = MiaHandler.get_definition_settings()
 
+        repositories_data = cls.get_repositories_data(settings)
+        apps_list, warnings_found = cls.resolve_apps(settings, repositories_data)
+
+        # Give the user a chance to fix any possible errors.
+        if warnings_found and interactive:
+            msg = 'Warnings found, some APKs will not be downloaded! Continue?'
+            if not MiaUtils.input_confirm(msg):
+                sys.exit(1)
+
+        return apps_list
+
+    @classmethod
+    def get_repositories_data(cls, settings, refresh=False):
+        """
+        Download and parse the index files of the definition repositories.
+        The parsed indexes are reused by the following definitions.
+        :param refresh: Download the index files again, even if available.
+        """
         if not settings['defaults']['repository']:
             print('Missing default repository setting.')
             sys.exit(1)
@@ -244,24 +712,230 @@ class Definition(object):
         if not os.path.isdir(resources_path):
             os.makedirs(resources_path, mode=0o755)
 
-        # Download and read info from the index.xml file of all repositories.
+        # Download and read info from the index file of all repositories. The
+        # indexes are downloaded in parallel, and each one is parsed as soon
+        # as it is downloaded.
+        group = MiaTaskGroup()
         repositories_data = {}
+        app_ids = cls.get_index_app_ids(settings)
         for repo_info in settings['repositories']:
-            index_path = os.path.join(MiaHandler.get_workspace_path(), 'resources', repo_info['id'] + '.index.xml')
+            if not refresh and cls.get_index_path(repo_info) is None:
+                for index_path in cls.get_index_paths(repo_info):
+                    if MiaPack.extract_resource(index_path):
+                        break
+
+            downloads = []
+            if refresh or cls.get_index_path(repo_info) is None:
+                downloads.append(group.add(
+                    'download %s index' % repo_info['id'], cls.download_repository_index, (repo_info,), 'network'
+                ))
+
+            group.add('parse %s index' % repo_info['id'], cls.load_index, (repo_info, app_ids), 'cpu', downloads)
+            repositories_data[repo_info['id']] = repo_info
 
-            if not os.path.isfile(index_path):
-                index_url = '%s/%s' % (repo_info['url'], 'index.xml')
-                print('Downloading the %s repository information from:\n - %s' % (repo_info['name'], index_url))
-                MiaUtils.urlretrieve(index_url, index_path)
+        try:
+            group.run()
+        except MiaTaskError as e:
+            print('ERROR: %s' % e)
+            sys.exit(1)
 
-            # Parse the repository index file and return the XML root.
-            xml_tree = ElementTree.parse(index_path)
-            if not xml_tree:
-                print('Error parsing file:\n - %s' % index_path)
-            repo_info['tree'] = xml_tree.getroot()
+        MiaCache.touch(*[cls.get_index_path(repo_info) for repo_info in repositories_data.values()])
 
-            repositories_data[repo_info['id']] = repo_info
+        return repositories_data
+
+    @staticmethod
+    def get_index_paths(repo_info):
+        """
+        :return: The paths of the index-v1.jar and the index.xml files of a
+          repository, in order of preference.
+        """
+        return MiaFDroid.get_index_paths(repo_info['id'])
+
+    @staticmethod
+    def get_index_path(repo_info):
+        """
+        :return: The path of the downloaded index of a repository, or None.
+        """
+        return MiaFDroid.get_index_path(repo_info['id'])
+
+    @staticmethod
+    def get_index_app_ids(settings):
+        """
+        :return: The ids of the apps to read from the repository indexes.
+        """
+        return set(app_info['id'] for app_info in settings['apps'] if 'id' in app_info and 'url' not in app_info)
+
+    @classmethod
+    def download_repository_index(cls, repo_info):
+        """
+        Download the compressed index of a repository, or the index.xml file
+        if the repository does not provide it.
+        :raise DownloadError: If the index could not be downloaded.
+        """
+        jar_path, xml_path = cls.get_index_paths(repo_info)
+        print('Downloading the %s repository information.' % repo_info['name'])
+        try:
+            with MiaProfiler.span('index download') as span:
+                MiaMirrors.download(repo_info, 'index-v1.jar', jar_path)
+                span.add('bytes', os.path.getsize(jar_path))
+        except DownloadNotFoundError:
+            print(' - no index-v1.jar file, downloading the index.xml file')
+            # Do not use an outdated index-v1.jar file.
+            if os.path.isfile(jar_path):
+                os.remove(jar_path)
+            cls.download_index(repo_info, xml_path, False)
+            return
+
+        with zipfile.ZipFile(jar_path) as jar:
+            json_size = jar.getinfo(MiaFDroidJsonRepository.index_name).file_size
+        jar_size = os.path.getsize(jar_path)
+        print(' - downloaded %s instead of %s, %.0f%% less' % (
+            MiaUtils.format_file_size(jar_size),
+            MiaUtils.format_file_size(json_size),
+            100.0 - jar_size * 100.0 / max(json_size, 1)
+        ))
+
+    @staticmethod
+    def download_index(repo_info, index_path, show_message=True):
+        """
+        Download the index.xml file of a repository.
+        :raise DownloadError: If the index could not be downloaded.
+        """
+        if show_message:
+            print('Downloading the %s repository information.' % repo_info['name'])
+        with MiaProfiler.span('index download') as span:
+            MiaMirrors.download(repo_info, 'index.xml', index_path)
+            span.add('bytes', os.path.getsize(index_path))
+
+    @classmethod
+    def load_index(cls, repo_info, app_ids):
+        repo_info['index'] = cls.parse_index(cls.get_index_path(repo_info), app_ids)
+
+    @classmethod
+    def search_apps(cls):
+        """
+        Search the apps of the repositories, using their search indexes.
+        """
+        terms = MiaHandler.args['<terms>']
+        repositories = cls.get_search_repositories()
+        repo_ids = [repo_info['id'] for repo_info in repositories]
 
+        # Only list the matching app ids, quietly, without downloading.
+        if MiaHandler.args['--ids']:
+            for app_id in MiaSearch.complete_app_ids(''.join(terms), repo_ids):
+                print(app_id)
+            return None
+
+        try:
+            limit = int(MiaHandler.args['--limit'])
+        except ValueError:
+            print('ERROR: Please provide a valid number of search results!')
+            sys.exit(1)
+
+        # Make sure the resources folder exists.
+        resources_path = os.path.join(MiaHandler.get_workspace_path(), 'resources')
+        if not os.path.isdir(resources_path):
+            os.makedirs(resources_path, mode=0o755)
+
+        # The same index files as the lock, the index-v1.jar file if possible.
+        group = MiaTaskGroup()
+        for repo_info in repositories:
+            if cls.get_index_path(repo_info) is None:
+                for index_path in cls.get_index_paths(repo_info):
+                    if MiaPack.extract_resource(index_path):
+                        break
+
+            if cls.get_index_path(repo_info) is None:
+                group.add(
+                    'download %s index' % repo_info['id'], cls.download_repository_index, (repo_info,), 'network'
+                )
+
+        try:
+            group.run()
+        except MiaTaskError as e:
+            print('ERROR: %s' % e)
+            sys.exit(1)
+
+        with MiaProfiler.span('search'):
+            results = MiaSearch.search(terms, repo_ids, limit)
+
+        if not results:
+            print('No apps found matching "%s".' % ' '.join(terms))
+            return None
+
+        for score, app_id, name, summary, result_repo_ids in results:
+            print(' - %s (%s): %s [%s]' % (app_id, name, summary, ', '.join(result_repo_ids)))
+
+        return None
+
+    @staticmethod
+    def get_search_repositories():
+        """
+        :return: The repositories of all the workspace definitions, or of the
+          template when there are no definitions.
+        """
+        definitions_path = os.path.join(MiaHandler.get_workspace_path(), 'definitions')
+        settings_paths = [
+            os.path.join(definitions_path, name, 'settings.yaml') for name in MiaHandler.get_definition_names()
+        ]
+        if not settings_paths:
+            template_path = MiaHandler.get_template_path(MiaHandler.args['--template'])
+            if template_path is None:
+                print('ERROR: Template "%s" does not exist!' % MiaHandler.args['--template'])
+                sys.exit(1)
+            settings_paths.append(os.path.join(template_path, 'settings.yaml'))
+
+        repositories = []
+        repo_ids = set()
+        for settings_path in settings_paths:
+            settings = MiaSettings.load(settings_path) or {}
+            for repo_info in settings.get('repositories') or []:
+                if repo_info['id'] not in repo_ids:
+                    repo_ids.add(repo_info['id'])
+                    repositories.append(repo_info)
+
+        return repositories
+
+    @classmethod
+    def parse_index(cls, index_path, app_ids=()):
+        """
+        Parse a repository index file, an index-v1.jar or an index.xml file.
+        :param app_ids: The ids of the apps to read from an index-v1.jar file.
+        :rtype: mia.fdroid.MiaFDroidRepository
+        """
+        mtime = os.path.getmtime(index_path)
+        cached = cls.__parsed_indexes.get(index_path)
+        if cached is not None and cached[0] == mtime:
+            if not isinstance(cached[1], MiaFDroidJsonRepository) or cached[1].app_ids.issuperset(app_ids):
+                return cached[1]
+
+            # Read the apps of the previous definitions too.
+            app_ids = cached[1].app_ids.union(app_ids)
+
+        # The F-Droid caches keep the outdated index alive, eg: in the daemon.
+        if cached is not None:
+            MiaFDroid.clear_cache()
+
+        with MiaProfiler.span('index parse') as span:
+            span.add('bytes', os.path.getsize(index_path))
+            repository = MiaFDroid.load_repository(index_path, app_ids)
+
+        cls.__parsed_indexes[index_path] = (mtime, repository)
+
+        return repository
+
+    @classmethod
+    def clear_cache(cls):
+        cls.__parsed_indexes = {}
+
+    @staticmethod
+    def resolve_apps(settings, repositories_data, resolved=None):
+        """
+        Find the packages of the definition apps.
+        :param resolved: Optional dictionary of already resolved apps, shared
+          between definitions using the same repositories.
+        :return: An (apps lock list, warnings found) tuple.
+        """
         apps_list = []
         warnings_found = False
         print('Looking for APKs:')
@@ -281,7 +955,7 @@ class Definition(object):
                 apps_list.append(lock_info)
                 continue
 
-            # Lookup the app by id and versioncode in the repository index.xml.
+            # Lookup the app by id and versioncode in the repository index.
             if 'id' in app_info:
                 # Use the default repository if it has not been provided.
                 if 'repository' not in app_info:
@@ -300,7 +974,17 @@ class Definition(object):
                     app_info['versioncode'] = 'latest'
 
                 # Get the application info.
-                lock_info = MiaFDroid.fdroid_get_app_lock_info(repositories_data, app_info)
+                resolved_key = (
+                    app_info['id'], app_info['versioncode'], app_info['type'], app_info['repository'],
+                    repositories_data[app_info['repository']].get('fallback')
+                )
+                if resolved is not None and resolved_key in resolved:
+                    lock_info = resolved[resolved_key]
+                else:
+                    with MiaProfiler.span('app resolution'):
+                        lock_info = MiaFDroid.fdroid_get_app_lock_info(repositories_data, app_info)
+                    if resolved is not None:
+                        resolved[resolved_key] = lock_info
 
                 if lock_info is None:
                     msg = ' - app `%s` is missing'
@@ -308,6 +992,11 @@ class Definition(object):
                     warnings_found = True
                     continue
 
+                # Find out later whether the packages changed since the app was locked.
+                fallback = repositories_data[app_info['repository']].get('fallback')
+                lock_info = dict(lock_info, index_fingerprint=Definition.get_index_fingerprint(
+                    repositories_data, [app_info['repository']] + ([fallback] if fallback else []), app_info['id']
+                ))
                 repo_id = lock_info['repository']
                 repo_name = repositories_data[repo_id]['name']
 
@@ -321,69 +1010,310 @@ class Definition(object):
                 print(msg % (lock_info['id'], repo_name))
                 apps_list.append(lock_info)
 
-        # Give the user a chance to fix any possible errors.
-        if warnings_found:
-            msg = 'Warnings found, some APKs will not be downloaded! Continue?'
-            if not MiaUtils.input_confirm(msg):
-                sys.exit(1)
-
-        return apps_list
+        return apps_list, warnings_found
 
     @staticmethod
-    def download_apps():
+    def download_apps(lock_data=None, interactive=True):
+        """
+        :param interactive: Whether to ask before continuing without the
+          APKs which could not be downloaded.
+        """
         # Read the definition apps lock data.
-        lock_data = MiaHandler.get_definition_apps_lock_data()
+        if lock_data is None:
+            lock_data = MiaHandler.get_definition_apps_lock_data()
 
         # Read the definition settings.
         settings = MiaHandler.get_definition_settings()
         definition_path = MiaHandler.get_definition_path()
-
+        repositories = dict((repo_info['id'], repo_info) for repo_info in settings['repositories'])
+        cached_paths = []
+
+        # Create the CPU architecture specific apps cache directory.
+        architecture_cache = MiaHandler.args['--cpu'] + '-apps'
+        cache_directory = os.path.join(MiaHandler.get_workspace_path(), 'resources', architecture_cache)
+        if not os.path.isdir(cache_directory):
+            os.makedirs(cache_directory, mode=0o755)
+
+        # Download the APKs in parallel, and verify or copy each one as soon as
+        # it is downloaded.
+        group = MiaTaskGroup(fail_fast=False)
         for apk_info in lock_data:
-            print(' - downloading: %s' % apk_info['package_url'])
             relative_path = settings['app_types'][apk_info['type']]
             download_path = os.path.join(definition_path, 'archive', relative_path)
             if not os.path.isdir(download_path):
                 os.makedirs(download_path, mode=0o755)
 
-            apk_path = os.path.join(download_path, apk_info['package_name'])
+            apk_name = apk_info['package_name']
+            apk_path = os.path.join(download_path, apk_name)
+            cache_path = os.path.join(cache_directory, apk_name)
+            cached_paths.append(cache_path)
+
+            # Read the APKs missing from the cache straight from the mounted packs.
+            found = None
+            if 'hash' in apk_info and not os.path.isfile(cache_path):
+                found = MiaPack.find(cache_path)
+            if found is not None:
+                copy = group.add('copy %s from pack' % apk_name, Definition.copy_pack_apk, found + (apk_info, apk_path), 'hash')
+                group.add('check %s' % apk_name, Definition.check_apk, (apk_info, apk_path, True), 'hash', [copy])
+                continue
+
+            # Download the repository apps from the fastest mirrors, or reuse
+            # the apps without native code from the other CPU caches.
+            if apk_info.get('repository') in repositories and 'hash' in apk_info:
+                shared_path = None
+                if not os.path.isfile(cache_path):
+                    shared_path = Definition.get_shared_apk_path(apk_info, cache_directory)
+
+                if shared_path is not None:
+                    download = group.add('share %s' % apk_name, Definition.share_apk, (
+                        apk_info, shared_path, cache_path
+                    ), 'disk')
+                else:
+                    download = group.add('download %s' % apk_name, Definition.download_repository_apk, (
+                        repositories[apk_info['repository']], apk_info, cache_path
+                    ), 'network')
+                copy = group.add('copy %s' % apk_name, Definition.place_apk, (cache_path, apk_path), 'disk', [download])
+                group.add('check %s' % apk_name, Definition.check_apk, (apk_info, apk_path, True), 'hash', [copy])
+                continue
+
+            download = group.add('download %s' % apk_name, Definition.download_url_apk, (
+                apk_info, apk_path, cache_directory
+            ), 'network')
+
+            if 'hash' in apk_info:
+                download = group.add('verify %s' % apk_name, Definition.verify_apk, (apk_info, apk_path), 'hash', [download])
+            group.add('check %s' % apk_name, Definition.check_apk, (apk_info, apk_path, 'hash' in apk_info), 'hash', [download])
 
-            # Create the CPU architecture specific apps cache directory.
-            architecture_cache = MiaHandler.args['--cpu'] + '-apps'
-            cache_directory = os.path.join(MiaHandler.get_workspace_path(), 'resources', architecture_cache)
-            if not os.path.isdir(cache_directory):
-                os.makedirs(cache_directory, mode=0o755)
+        print('Downloading %d APKs:' % len(lock_data))
+        try:
+            group.run()
+        except MiaTaskError as e:
+            print('ERROR: %s' % e)
+            if not interactive or not MiaUtils.input_confirm('Continue without the failed APKs?', False):
+                sys.exit('Download aborted!')
+        finally:
+            MiaApk.save_cache()
+
+        MiaCache.touch(*cached_paths)
+        print('Finished downloading APKs and verifying their hash values.\n')
+
+        # Pin the signers of the new apps, on first use.
+        report = Definition.verify_signatures(lock_data, True)
+        if report['pinned']:
+            lock_file_path = os.path.join(definition_path, 'apps_lock.yaml')
+            try:
+                MiaSettings.save(lock_file_path, MiaHandler.get_definition_apps_lock_data())
+            except yaml.YAMLError:
+                print('ERROR: Could not save the lock file!')
+                sys.exit(1)
+
+        if report['errors']:
+            # Do not build with APKs from unexpected signers.
+            package_names = set(package_name for package_name, error in report['errors'])
+            for apk_info in lock_data:
+                apk_path = os.path.join(
+                    definition_path, 'archive', settings['app_types'][apk_info['type']], apk_info['package_name']
+                )
+                if apk_info['package_name'] in package_names and os.path.isfile(apk_path):
+                    os.remove(apk_path)
+            sys.exit('Signature verification failed!')
+
+    @staticmethod
+    def verify_signatures(lock_data, pin=False):
+        """
+        Verify the signatures of the downloaded APKs of the definition, and
+        compare their signer certificates with the lock file.
+        :param pin: Whether to pin the signers of the apps without one.
+        :return: The report of MiaSignature.verify_apks().
+        """
+        settings = MiaHandler.get_definition_settings()
+        definition_path = MiaHandler.get_definition_path()
+
+        apks = []
+        for apk_info in lock_data:
+            apk_path = os.path.join(
+                definition_path, 'archive', settings['app_types'][apk_info['type']], apk_info['package_name']
+            )
+            apks.append((apk_info, apk_path))
+
+        report = MiaSignature.verify_apks(apks, pin)
+        MiaSignature.print_report(report)
+
+        return report
+
+    @staticmethod
+    def download_repository_apk(repo_info, apk_info, cache_path):
+        """
+        Download an APK from the repository mirrors, unless already cached.
+        The hash is verified while downloading.
+        :raise DownloadError: If the APK could not be downloaded.
+        """
+        apk_name = apk_info['package_name']
+        if os.path.isfile(cache_path):
+            if MiaUtils.get_file_hash(cache_path, apk_info['hash_type']) == apk_info['hash']:
+                MiaTaskGroup.log(' - %s: already downloaded, using cached apk.' % apk_name)
+                return
+
+        with MiaProfiler.span('apk download') as span:
+            MiaMirrors.download(
+                repo_info, apk_name, cache_path,
+                apk_info['hash_type'], apk_info['hash']
+            )
+            span.add('bytes', os.path.getsize(cache_path))
+
+        MiaTaskGroup.log(' - %s: downloaded %s, file hash is OK.' % (
+            apk_name, MiaUtils.format_file_size(os.path.getsize(cache_path))
+        ))
 
+    @staticmethod
+    def download_url_apk(apk_info, apk_path, cache_directory=None):
+        """
+        Download an APK from it's URL, using wget.
+        :raise DownloadError: If the APK could not be downloaded.
+        """
+        apk_name = os.path.basename(apk_path)
+        with MiaProfiler.span('apk download'):
             path, http_message = MiaUtils.urlretrieve(apk_info['package_url'], apk_path, cache_directory)
-            if http_message['status_code'] == 200:
-                print('   - downloaded: %s' % MiaUtils.format_file_size(http_message['Content-Length']))
-            elif http_message['status_code'] == 206:
-                print('   - download continued: %s' % MiaUtils.format_file_size(http_message['Content-Length']))
-            elif http_message['status_code'] == 416:
-                print('   - already downloaded, using cached apk.')
-            else:
-                print('   - error downloading file.')
-                if not MiaUtils.input_confirm('Continue?', True):
-                    sys.exit('Download aborted!')
 
-            # TODO: Verify signatures?!?
-            if os.path.exists(apk_path) and 'hash' in apk_info:
-                apk_hash_value = MiaUtils.get_file_hash(apk_path, apk_info['hash_type'])
+        if http_message['status_code'] == 200:
+            MiaTaskGroup.log(' - %s: downloaded %s' % (apk_name, MiaUtils.format_file_size(http_message['Content-Length'])))
+        elif http_message['status_code'] == 206:
+            MiaTaskGroup.log(' - %s: download continued, %s' % (
+                apk_name, MiaUtils.format_file_size(http_message['Content-Length'])
+            ))
+        elif http_message['status_code'] == 416:
+            MiaTaskGroup.log(' - %s: already downloaded, using cached apk.' % apk_name)
+        else:
+            raise DownloadError('Error downloading %s: HTTP %d' % (apk_info['package_url'], http_message['status_code']))
 
-                if apk_hash_value != apk_info['hash']:
-                    sys.exit('WARNING: Unexpected hash for downloaded apk!')
-                else:
-                    print('   - file hash is OK.')
+    @staticmethod
+    def check_apk(apk_info, apk_path, verified):
+        """
+        Check the package id, the versioncode and the native code of an APK.
+        :raise MiaApkError: If the APK does not match, the APK is removed.
+        """
+        try:
+            MiaApk.check(apk_info, apk_path, MiaHandler.args['--cpu'], verified)
+        except MiaApkError:
+            os.remove(apk_path)
+            raise
+        except Exception as e:
+            os.remove(apk_path)
+            raise MiaApkError('Could not check %s: %s' % (apk_info['package_name'], e))
 
-        print('Finished downloading APKs and verifying their hash values.')
+    @staticmethod
+    def get_shared_apk_path(apk_info, cache_directory):
+        """
+        Find an APK without native code in the other CPU architecture caches.
+        :return: The path of the APK, or None if not found.
+        """
+        info = MiaApk.get_cached_info(apk_info['hash_type'], apk_info['hash'])
+        if info is None or info['abis']:
+            return None
+
+        resources_path = os.path.dirname(cache_directory)
+        for name in sorted(os.listdir(resources_path)):
+            shared_path = os.path.join(resources_path, name, apk_info['package_name'])
+            if name.endswith('-apps') and name != os.path.basename(cache_directory) and os.path.isfile(shared_path):
+                return shared_path
+
+        return None
 
     @staticmethod
-    def download_os():
+    def place_apk(cache_path, apk_path):
         """
-        Display information to the user on how to download the OS and verify it's
-        checksum.
+        Place a cached APK in the archive of a definition, sharing it's data
+        when possible. The APK might already be a hard link of the cached one.
         """
-        print('\nNOTE: Command not finished yet; See instructions!\n')
+        if os.path.exists(apk_path) and os.path.samefile(cache_path, apk_path):
+            return
+
+        MiaClone.clone_file(cache_path, apk_path, 0o644, 'shared')
 
+    @staticmethod
+    def share_apk(apk_info, shared_path, cache_path):
+        """
+        Share an APK between the CPU architecture caches, verifying it's hash.
+        :raise ValueError: If the hash is not the expected one.
+        """
+        if MiaUtils.get_file_hash(shared_path, apk_info['hash_type']) != apk_info['hash']:
+            raise ValueError('Unexpected hash for the shared apk %s!' % shared_path)
+
+        MiaClone.clone_file(shared_path, cache_path, 0o644, 'shared')
+        MiaTaskGroup.log(' - %s: shared with the %s cache, no native code.' % (
+            apk_info['package_name'], os.path.basename(os.path.dirname(shared_path))
+        ))
+
+    @classmethod
+    def verify_apps(cls):
+        """
+        Check all the downloaded APKs of the definition, in parallel.
+        """
+        lock_data = MiaHandler.get_definition_apps_lock_data()
+        settings = MiaHandler.get_definition_settings()
+        definition_path = MiaHandler.get_definition_path()
+        cpu = MiaHandler.args['--cpu']
+
+        group = MiaTaskGroup(fail_fast=False)
+        for apk_info in lock_data:
+            apk_path = os.path.join(
+                definition_path, 'archive', settings['app_types'][apk_info['type']], apk_info['package_name']
+            )
+            group.add(apk_info['package_name'], MiaApk.check, (apk_info, apk_path, cpu), 'hash')
+
+        print('Checking %d APKs for the %s CPU architecture:' % (len(lock_data), cpu))
+        try:
+            group.run()
+        except MiaTaskError as e:
+            print('ERROR: %s' % e)
+            sys.exit(1)
+        finally:
+            MiaApk.save_cache()
+
+        for task in group.tasks:
+            info = task.result
+            print(' - %s: %s %s (%s), %s' % (
+                task.name, info['package'], info['versionname'], info['versioncode'],
+                'native code for %s' % ', '.join(info['abis']) if info['abis'] else 'no native code, shareable'
+            ))
+
+        print('All the APKs match the lock file.')
+
+    @staticmethod
+    def copy_pack_apk(pack, entry, apk_info, apk_path):
+        """
+        Copy an APK from a mounted pack, verifying it's hash.
+        :raise ValueError: If the hash is not the expected one.
+        """
+        with MiaProfiler.span('hash ' + apk_info['hash_type']):
+            hash_value = hashlib.new(apk_info['hash_type'], pack.read(entry)).hexdigest()
+        if hash_value != apk_info['hash']:
+            raise ValueError('Unexpected hash for the apk of the pack %s!' % pack.path)
+
+        pack.extract(entry, apk_path)
+        MiaTaskGroup.log(' - %s: copied from the cache pack, file hash is OK.' % apk_info['package_name'])
+
+    @staticmethod
+    def verify_apk(apk_info, apk_path):
+        """
+        :raise ValueError: If the hash is not the expected one, the APK is removed.
+        """
+        if MiaUtils.get_file_hash(apk_path, apk_info['hash_type']) != apk_info['hash']:
+            os.remove(apk_path)
+            raise ValueError('Unexpected hash for downloaded apk!')
+
+        MiaTaskGroup.log(' - %s: file hash is OK.' % os.path.basename(apk_path))
+
+    @classmethod
+    def download_os(cls, interactive=True):
+        """
+        Download the OS zip file and save it's md5 checksum. Or, if the URL of
+        the file is not known, display information to the user on how to
+        download the OS and verify it's checksum.
+        :param interactive: Whether to wait for the user to download the OS
+          zip file when the URL is not known.
+        :raise RuntimeError: If not interactive, and the URL is not known.
+        """
         # Read the definition settings.
         settings = MiaHandler.get_definition_settings()
 
@@ -392,12 +1322,76 @@ class Definition(object):
         if not os.path.isdir(resources_path):
             os.makedirs(resources_path, mode=0o755)
 
+        file_name = MiaHandler.get_os_zip_filename()
+        zip_file_path = os.path.join(resources_path, file_name)
+        if not os.path.isfile(zip_file_path) and MiaPack.extract_resource(zip_file_path):
+            MiaPack.extract_resource(zip_file_path + '.md5')
+
+        url = MiaHandler.args.get('--url') or settings['general'].get('os_url')
+        expected_md5 = MiaHandler.args.get('--md5') or settings['general'].get('os_md5')
+
+        if not url and not interactive:
+            if os.path.isfile(zip_file_path) and os.path.isfile(zip_file_path + '.md5'):
+                print('Using OS zip file:\n - %s\n' % zip_file_path)
+                MiaCache.touch(zip_file_path)
+                return
+
+            raise RuntimeError('The URL of the OS zip file is not known, see: mia definition dl-os %s' % (
+                MiaHandler.args['<definition>']
+            ))
+
+        if not url:
+            cls.download_os_manually(settings, resources_path, file_name)
+            return
+
+        if os.path.isfile(zip_file_path) and os.path.isfile(zip_file_path + '.md5'):
+            print('Using OS zip file:\n - %s\n' % zip_file_path)
+            MiaCache.touch(zip_file_path)
+            return
+
+        print('Downloading the OS zip file from:\n - %s' % url)
+        downloader = MiaDownloader(url, zip_file_path, cls.get_segments_count(), 'md5')
+        try:
+            md5_value = downloader.download(expected_md5)
+        except DownloadError as e:
+            print('ERROR: %s' % e)
+            sys.exit(1)
+
+        if expected_md5:
+            print(' - md5 checksum is OK.')
+        else:
+            print('WARNING: No md5 checksum provided, the download was not verified!')
+            print(' - md5 checksum: %s' % md5_value)
+
+        # Save the checksum, required when installing the OS.
+        MiaUtils.write_hash_file(zip_file_path, 'md5', md5_value)
+        MiaCache.touch(zip_file_path)
+        print('Saved the OS zip file:\n - %s\n' % zip_file_path)
+
+    @staticmethod
+    def get_segments_count():
+        """
+        :return: The number of parallel download requests of the OS zip file.
+        """
+        try:
+            segments = int(MiaHandler.args.get('--segments') or 4)
+        except ValueError:
+            segments = 0
+
+        if segments < 1:
+            print('ERROR: Please provide a valid number of download segments!')
+            sys.exit(1)
+
+        return segments
+
+    @staticmethod
+    def download_os_manually(settings, resources_path, file_name):
+        print('\nNOTE: The URL of the OS zip file is not known; See instructions!\n')
+
         url = 'https://download.cyanogenmod.org/?device=%s' % (
             settings['general']['device_codename']
         )
 
-        file_name = MiaHandler.get_os_zip_filename()
-
         message = '\n'.join((
             'Download CyanogenMod from:\n - %s',
             'and save the file as\n - %s',
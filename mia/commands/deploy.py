@@ -0,0 +1,111 @@
+"""
+Build the update.zip file and install it, together with the OS, onto a device
+(real or emulated) in a single pipeline.
+
+The OS zip file, usually the largest transfer, is pushed onto the device while
+the update.zip file is being built and hashed. The update.zip file is pushed as
+soon as it is ready.
+
+Usage:
+    mia deploy [--emulator] [--no-reboot] [--push-only] [--skip-os] <definition>
+    mia deploy --help
+
+Command options:
+    --emulator   Use running emulator instead of a real device.
+    --no-reboot  Do not reboot the device once all the files are in place.
+    --push-only  Only build and push the OS and update zips.
+    --skip-os    Do not push the OS zip file (again). Install the existing one.
+
+Notes:
+  * For a successful install a prior push is required when using `--skip-os`.
+
+
+"""
+
+import sys
+import time
+
+# Import custom helpers.
+from mia.commands import available_commands
+from mia.commands.build import Build
+from mia.commands.install import Install
+from mia.handler import MiaHandler
+from mia.profiler import MiaProfiler
+from mia.tasks import MiaTaskError, MiaTaskGroup
+from mia.utils import MiaUtils
+
+
+class Deploy(object):
+    @classmethod
+    def main(cls):
+        start_time = time.time()
+
+        # Pushing and building run in parallel, each stage starts as soon as
+        # the stages it depends on are done.
+        group = MiaTaskGroup()
+
+        if not MiaHandler.args['--skip-os']:
+            # Fail early, before starting any work, if the OS zip is not ready.
+            Install.get_os_zip_path()
+
+            # Push the OS archive and hash file to the device in the background.
+            group.add('push OS zip', cls.run_stage, ('push OS zip', Install.push_os_zip, False), 'adb')
+
+        # Build the update archive and compute its hash.
+        build = group.add('build update zip', cls.run_stage, ('build update zip', Build.build_update_zip, False))
+        seal = group.add('hash update zip', cls.run_stage, ('hash update zip', cls.hash_update_zip, build), 'hash', [
+            build
+        ])
+
+        # Push the update archive and hash file as soon as they are sealed.
+        group.add('push update zip', cls.run_stage, ('push update zip', Install.push_update_zip, False), 'adb', [
+            seal
+        ])
+
+        try:
+            group.run()
+        except MiaTaskError as e:
+            print('ERROR: %s' % e)
+            sys.exit(1)
+
+        cls.print_timings([
+            (task.name, task.start_time, task.end_time) for task in group.tasks if task.start_time is not None
+        ], time.time() - start_time)
+
+        if MiaHandler.args['--push-only']:
+            print('\n' + 'Finished pushing the files onto the device.')
+            sys.exit(0)
+
+        Install.start_install()
+
+    @staticmethod
+    def run_stage(name, callback, *args):
+        with MiaProfiler.span(name):
+            return callback(*args)
+
+    @staticmethod
+    def hash_update_zip(build):
+        MiaUtils.create_hash_file(build.result, 'md5')
+
+    @staticmethod
+    def print_timings(timings, total_time):
+        print('\nStage timings:')
+
+        sequential_time = 0
+        first_start_time = min(start for name, start, end in timings)
+        for name, start_time, end_time in sorted(timings, key=lambda t: t[1]):
+            sequential_time += end_time - start_time
+            print(' - {:<16} {:>8.2f}s  (started at +{:.2f}s)'.format(
+                name, end_time - start_time, start_time - first_start_time
+            ))
+
+        print(' - {:<16} {:>8.2f}s  (sequential: {:.2f}s)'.format(
+            'total', total_time, sequential_time
+        ))
+
+
+# Add command to the list of available commands.
+available_commands['deploy'] = {
+    'class': Deploy,
+    'help': __doc__,
+}
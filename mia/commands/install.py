@@ -23,23 +23,42 @@ import sys
 # Import custom helpers.
 from mia.commands import available_commands
 from mia.android import MiaAndroid
+from mia.cache import MiaCache
+from mia.commands.build import Build
 from mia.handler import MiaHandler
+from mia.pack import MiaPack
+from mia.tasks import MiaTaskError, MiaTaskGroup
 
 
 class Install(object):
     @staticmethod
     def main():
-        # Push the update archive and hash file to the device.
-        Install.push_update_zip()
+        # Fail early, before pushing anything, if an archive is not ready.
+        Install.get_update_zip_path()
+        if not MiaHandler.args['--skip-os']:
+            Install.get_os_zip_path()
 
+        # Push the archives and their hash files to the device in parallel.
+        # NOTE: The progress bar is garbled when pushing files concurrently.
+        group = MiaTaskGroup()
+        group.add('push update zip', Install.push_update_zip, (MiaHandler.args['--skip-os'],), 'adb')
         if not MiaHandler.args['--skip-os']:
-            # Push the OS archive and hash file to the device.
-            Install.push_os_zip()
+            group.add('push OS zip', Install.push_os_zip, (False,), 'adb')
+
+        try:
+            group.run()
+        except MiaTaskError as e:
+            print('ERROR: %s' % e)
+            sys.exit(1)
 
         if MiaHandler.args['--push-only']:
             print('\n' + 'Finished pushing the files onto the device.')
             sys.exit(0)
 
+        Install.start_install()
+
+    @staticmethod
+    def start_install():
         # Set the openrecoveryscript.
         MiaAndroid.set_open_recovery_script()
 
@@ -48,11 +67,15 @@ class Install(object):
             MiaAndroid.reboot_device('recovery')
 
     @staticmethod
-    def push_os_zip():
+    def get_os_zip_path():
         # Get the OS file name.
         zip_name = MiaHandler.get_os_zip_filename()
         zip_path = os.path.join(MiaHandler.get_workspace_path(), 'resources', zip_name)
 
+        # Use the OS zip file of the mounted packs, eg: on air-gapped hosts.
+        if not os.path.isfile(zip_path) and MiaPack.extract_resource(zip_path):
+            MiaPack.extract_resource(zip_path + '.md5')
+
         if not os.path.isfile(zip_path):
             print('ERROR: OS archive is missing:\n - %s' % zip_path)
             sys.exit(1)
@@ -62,15 +85,21 @@ class Install(object):
             print('ERROR: Hash file for the OS archive is missing.')
             sys.exit(1)
 
+        MiaCache.touch(zip_path)
+
+        return zip_path
+
+    @staticmethod
+    def push_os_zip(progress=True):
+        zip_path = Install.get_os_zip_path()
+
         # Push the mia-os.zip to the device.
-        MiaAndroid.push_file('OS archive', zip_path, '/sdcard/mia-os.zip')
-        MiaAndroid.push_hash_for_file('md5', zip_path, '/sdcard/mia-os.zip')
+        MiaAndroid.push_file('OS archive', zip_path, '/sdcard/mia-os.zip', progress)
+        MiaAndroid.push_hash_for_file('md5', zip_path, '/sdcard/mia-os.zip', progress)
 
     @staticmethod
-    def push_update_zip():
-        # Create the builds folder.
-        zip_name = '%s.%s' % (MiaHandler.args['<definition>'], 'mia-update.zip')
-        zip_path = os.path.join(MiaHandler.get_workspace_path(), 'builds', zip_name)
+    def get_update_zip_path():
+        zip_path = Build.get_update_zip_path()
 
         if not os.path.isfile(zip_path):
             print('ERROR: Please run the build command first.')
@@ -81,9 +110,16 @@ class Install(object):
             print('ERROR: Hash file for the built update archive is missing.')
             sys.exit(1)
 
+        return zip_path
+
+    @staticmethod
+    def push_update_zip(progress=True):
+        zip_path = Install.get_update_zip_path()
+        MiaCache.touch(zip_path)
+
         # Push the mia-update.zip to the device.
-        MiaAndroid.push_file('update archive', zip_path, '/sdcard/mia-update.zip')
-        MiaAndroid.push_hash_for_file('md5', zip_path, '/sdcard/mia-update.zip')
+        MiaAndroid.push_file('update archive', zip_path, '/sdcard/mia-update.zip', progress)
+        MiaAndroid.push_hash_for_file('md5', zip_path, '/sdcard/mia-update.zip', progress)
 
 
 # Add command to the list of available commands.
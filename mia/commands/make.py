@@ -0,0 +1,212 @@
+"""
+Run only the stages of a definition which are not up to date, from the lock
+file to the installation onto the device.
+
+Usage:
+    mia make [--force] [--cpu=<cpu>] [--emulator] [--no-reboot] <definition> [<target>]
+    mia make --help
+
+Available targets:
+    lock     Create or update the apps lock file from the settings and the repository indexes.
+    apps     Download the apps of the lock file into the archive.
+    os       Download the OS zip file.
+    build    Build the update.zip file, the default target.
+    install  Push the OS and the update.zip files onto the device, and install them.
+
+Command options:
+    --force      Run all the stages of the target, even if up to date.
+    --cpu=<cpu>  The device CPU architecture. [default: armeabi]
+    --emulator   Use running emulator instead of a real device.
+    --no-reboot  Do not reboot the device once all the files are in place.
+
+
+Notes:
+  Each stage runs once the stages it depends on are done, the os stage runs
+  in parallel with the others:
+
+      settings -> lock -> apps -> build -> install
+                              os -------/
+
+  A stage runs when it's input files or settings changed since it's last run,
+  comparing their content, or when one of it's output files is missing. The
+  state of the stages is saved in the `stages.json` file of the definition.
+
+  The lock stage keeps the locked versions which still match the settings, use
+  `mia definition lock --update` to update them. The os stage fails when the
+  URL of the OS zip file is not known, see: mia definition dl-os
+
+  The install stage pushes the OS zip file again unless it was last pushed
+  onto the same device, identified by it's serial number (adb get-serialno).
+
+
+"""
+
+import os
+import sys
+import time
+
+# Import custom helpers.
+from mia.commands import available_commands
+from mia.android import MiaAndroid
+from mia.commands.build import Build
+from mia.commands.definition import Definition
+from mia.commands.install import Install
+from mia.commands.plan import Plan
+from mia.handler import MiaHandler
+from mia.settings import MiaSettings
+from mia.stages import MiaStage, MiaStageGraph
+from mia.tasks import MiaTaskError, MiaTaskGroup
+
+
+class Make(object):
+    @classmethod
+    def main(cls):
+        target = MiaHandler.args['<target>'] or 'build'
+
+        definition_path = MiaHandler.get_definition_path()
+        if not os.path.isdir(definition_path):
+            print('ERROR: Definition "%s" does not exist!' % MiaHandler.args['<definition>'])
+            sys.exit(1)
+
+        settings = MiaHandler.get_definition_settings()
+        if not settings['general'].get('device_codename'):
+            print('ERROR: The device codename is not set, see: mia definition configure')
+            sys.exit(1)
+
+        stages = cls.get_stages()
+        if target not in stages:
+            print('ERROR: Unknown target "%s", see: mia help make' % target)
+            sys.exit(1)
+
+        graph = MiaStageGraph(os.path.join(definition_path, 'stages.json'), MiaHandler.get_workspace_path())
+        for stage in stages.values():
+            graph.add(stage)
+
+        start_time = time.time()
+        try:
+            graph.run(stages[target], MiaHandler.args['--force'])
+        except MiaTaskError as e:
+            print('ERROR: %s' % e)
+            cls.print_report(graph.get_stages(stages[target]), time.time() - start_time)
+            sys.exit(1)
+
+        cls.print_report(graph.get_stages(stages[target]), time.time() - start_time)
+
+    @classmethod
+    def get_stages(cls):
+        """
+        :return: The stages of the definition, by target name.
+        """
+        settings = MiaHandler.get_definition_settings()
+        definition_path = MiaHandler.get_definition_path()
+        resources_path = os.path.join(MiaHandler.get_workspace_path(), 'resources')
+        lock_file_path = os.path.join(definition_path, 'apps_lock.yaml')
+        os_zip_path = os.path.join(resources_path, MiaHandler.get_os_zip_filename())
+        update_zip_path = Build.get_update_zip_path()
+
+        lock = MiaStage(
+            'lock', cls.lock,
+            inputs=lambda: [os.path.join(definition_path, 'settings.yaml')] + [
+                Definition.get_index_path(repo_info) or Definition.get_index_paths(repo_info)[0]
+                for repo_info in settings['repositories']
+            ],
+            outputs=lambda: [lock_file_path]
+        )
+        apps = MiaStage(
+            'apps', cls.download_apps,
+            inputs=lambda: [lock_file_path],
+            outputs=cls.get_apk_paths,
+            values=lambda: {'cpu': MiaHandler.args['--cpu']},
+            dependencies=[lock]
+        )
+        os_zip = MiaStage(
+            'os', cls.download_os,
+            outputs=lambda: [os_zip_path, os_zip_path + '.md5'],
+            values=lambda: {'general': dict(
+                (key, value) for key, value in settings['general'].items() if key.startswith(('os_', 'device_'))
+            )}
+        )
+        build = MiaStage(
+            'build', cls.build,
+            inputs=lambda: [
+                os.path.join(definition_path, 'archive', *path.split('/'))
+                for path in sorted(Build.get_archive_snapshot(os.path.join(definition_path, 'archive')))
+            ],
+            outputs=lambda: [update_zip_path, update_zip_path + '.md5'],
+            dependencies=[apps]
+        )
+        install = MiaStage(
+            'install', cls.install,
+            inputs=lambda: [update_zip_path + '.md5', os_zip_path + '.md5'],
+            values=lambda: {'device': 'emulator' if MiaHandler.args['--emulator'] else 'device'},
+            dependencies=[build, os_zip]
+        )
+
+        return {'lock': lock, 'apps': apps, 'os': os_zip, 'build': build, 'install': install}
+
+    @staticmethod
+    def get_apk_paths():
+        """
+        :return: The archive paths of the APKs of the lock file.
+        """
+        settings = MiaHandler.get_definition_settings()
+        definition_path = MiaHandler.get_definition_path()
+        lock_file_path = os.path.join(definition_path, 'apps_lock.yaml')
+        if not os.path.isfile(lock_file_path):
+            return []
+
+        return [
+            os.path.join(definition_path, 'archive', settings['app_types'][apk_info['type']], apk_info['package_name'])
+            for apk_info in MiaSettings.load(lock_file_path) or []
+        ]
+
+    @staticmethod
+    def lock():
+        # Only resolve the apps whose settings changed, keeping the locked
+        # versions, see: mia definition lock --update
+        MiaHandler.args.setdefault('--force-latest', False)
+        Definition.update_apps_lock_file(False, False)
+
+    @staticmethod
+    def download_os():
+        # The stages can not wait for the user to download the OS zip file.
+        Definition.download_os(False)
+
+    @staticmethod
+    def download_apps():
+        Definition.download_apps(None, False)
+
+    @staticmethod
+    def build():
+        Build.build_update_zip(True)
+
+    @staticmethod
+    def install():
+        # Only push the OS zip file again when it changed.
+        group = MiaTaskGroup()
+        group.add('push update zip', Install.push_update_zip, (False,), 'adb')
+        if not Plan.is_pushed(MiaAndroid.load_pushed_files(), Install.get_os_zip_path(), '/sdcard/mia-os.zip'):
+            group.add('push OS zip', Install.push_os_zip, (False,), 'adb')
+        group.run()
+
+        Install.start_install()
+
+    @staticmethod
+    def print_report(stages, duration):
+        print('\nStages:')
+        for stage in stages:
+            if stage.state == 'done':
+                print(' - {:<8} ran in {:.2f}s, {}'.format(stage.name, stage.duration, stage.reason))
+            elif stage.state is not None:
+                print(' - {:<8} {}'.format(stage.name, stage.state))
+            else:
+                print(' - {:<8} not run'.format(stage.name))
+
+        print('Finished in {:.2f}s.'.format(duration))
+
+
+# Add command to the list of available commands.
+available_commands['make'] = {
+    'class': Make,
+    'help': __doc__,
+}
@@ -0,0 +1,393 @@
+"""
+Display the actions needed to bring a definition, it's build and the device up
+to date, without running them.
+
+Usage:
+    mia plan [--emulator] [--cpu=<cpu>] <definition>
+    mia plan --help
+
+Command options:
+    --emulator   Compare with the files pushed onto the emulator instead of a
+                 real device.
+    --cpu=<cpu>  The device CPU architecture. [default: armeabi]
+
+
+Notes:
+  The plan compares the settings, the lock file, the workspace caches, the
+  manifest of the last build and the files last pushed onto the connected
+  device, identified by it's serial number. Only the file sizes and
+  modification times, and the cached metadata are read, no file is hashed and
+  nothing is downloaded.
+
+  The estimated durations use the throughput of the repository mirrors, when
+  already measured, and conservative defaults otherwise.
+
+
+"""
+
+import os
+import sys
+import time
+
+import yaml
+
+# Import custom helpers.
+from mia.commands import available_commands
+from mia.android import MiaAndroid
+from mia.commands.build import Build
+from mia.commands.definition import Definition
+from mia.handler import MiaHandler
+from mia.mirrors import MiaMirrors
+from mia.pack import MiaPack
+from mia.schema import MiaSchema
+from mia.settings import MiaSettings
+from mia.signature import MiaSignature
+from mia.utils import MiaUtils
+
+
+class Plan(object):
+    # The estimated throughputs, in bytes per second, of the operations.
+    rates = {
+        'network': 1024 ** 2,
+        'disk': 100 * 1024 ** 2,
+        'zip': 20 * 1024 ** 2,
+        'signatures': 50 * 1024 ** 2,
+        'adb': 10 * 1024 ** 2,
+    }
+
+    @classmethod
+    def main(cls):
+        start_time = time.time()
+
+        definition_path = MiaHandler.get_definition_path()
+        if not os.path.isdir(definition_path):
+            print('ERROR: The definition does not exist, see: mia help definition')
+            sys.exit(1)
+
+        actions = []
+        settings = cls.plan_settings(actions, definition_path)
+        if settings is not None:
+            MiaHandler.set_definition_settings(settings)
+
+            apps = cls.plan_apps(actions, settings, definition_path)
+            os_zip_path = cls.plan_os(actions, settings)
+            update_zip_size = cls.plan_build(actions, definition_path, apps)
+            cls.plan_install(actions, os_zip_path, update_zip_size)
+
+        cls.print_plan(actions, time.time() - start_time)
+
+    @staticmethod
+    def add_action(actions, command, reasons, size=0, rate=None):
+        """
+        :param size: The number of bytes to process, or None if unknown.
+        :param rate: The throughput of the action.
+        """
+        actions.append({
+            'command': command,
+            'reasons': reasons,
+            'size': size,
+            'duration': size / float(rate) if size and rate else 0,
+        })
+
+    @classmethod
+    def plan_settings(cls, actions, definition_path):
+        """
+        :return: The definition settings, or None if they are not valid.
+        """
+        definition = MiaHandler.args['<definition>']
+        settings_file = os.path.join(definition_path, 'settings.yaml')
+        try:
+            settings = MiaSettings.load(settings_file)
+            errors = MiaSchema.validate(settings)
+        except (IOError, yaml.YAMLError):
+            errors = ['Could not read configuration file!']
+
+        if errors:
+            cls.add_action(actions, 'mia definition configure %s' % definition, [
+                'invalid settings: %s' % error for error in errors
+            ])
+            return None
+
+        if not settings['general'].get('device_codename'):
+            cls.add_action(actions, 'mia definition configure %s' % definition, ['no device codename'])
+
+        return settings
+
+    @classmethod
+    def plan_apps(cls, actions, settings, definition_path):
+        """
+        :return: The number of APKs to add to the archive, or None if unknown.
+        """
+        definition = MiaHandler.args['<definition>']
+        resources_path = os.path.join(MiaHandler.get_workspace_path(), 'resources')
+        lock_file_path = os.path.join(definition_path, 'apps_lock.yaml')
+
+        lock_reasons = []
+        for repo_info in settings['repositories']:
+            if Definition.get_index_path(repo_info) is None:
+                lock_reasons.append('download the %s repository index' % repo_info['name'])
+
+        if not os.path.isfile(lock_file_path):
+            cls.add_action(actions, 'mia definition lock %s' % definition, ['no lock file'] + lock_reasons)
+            cls.add_action(actions, 'mia definition dl-apps %s' % definition, [
+                'download the %d apps once locked' % len(settings['apps'])
+            ], None)
+            return None
+
+        try:
+            lock_data = MiaSettings.load(lock_file_path) or []
+        except yaml.YAMLError:
+            lock_data = []
+            lock_reasons.append('invalid lock file')
+
+        locked_ids = set(apk_info['id'] for apk_info in lock_data)
+        missing_ids = [app_info['id'] for app_info in settings['apps'] if app_info['id'] not in locked_ids]
+        if os.path.getmtime(os.path.join(definition_path, 'settings.yaml')) > os.path.getmtime(lock_file_path):
+            lock_reasons.append('the settings changed since the last lock')
+        if missing_ids:
+            lock_reasons.append('%d apps are not locked, eg: %s' % (len(missing_ids), missing_ids[0]))
+        if lock_reasons:
+            cls.add_action(actions, 'mia definition lock --update %s' % definition, lock_reasons)
+
+        cache_directory = os.path.join(resources_path, MiaHandler.args['--cpu'] + '-apps')
+        signatures = MiaSignature.load_cache()
+        # The number of APKs and bytes by operation.
+        counts = dict((name, [0, 0]) for name in ('download', 'copy', 'share', 'verify'))
+        unknown_sizes = 0
+        unpinned = 0
+        for apk_info in lock_data:
+            apk_name = apk_info['package_name']
+            apk_path = os.path.join(definition_path, 'archive', settings['app_types'][apk_info['type']], apk_name)
+            cache_path = os.path.join(cache_directory, apk_name)
+
+            if not apk_info.get('signer'):
+                unpinned += 1
+
+            operation, size = cls.get_apk_operation(apk_info, apk_path, cache_path)
+            if operation == 'download' and size is None:
+                unknown_sizes += 1
+
+            if operation is not None:
+                counts[operation][0] += 1
+                counts[operation][1] += size or 0
+
+            # The signatures already verified, by digest.
+            if apk_info.get('hash_type', 'sha256') != 'sha256' or 'sha256:%s' % apk_info.get('hash') not in signatures:
+                counts['verify'][0] += 1
+                counts['verify'][1] += size or 0
+
+        reasons = []
+        for operation, (count, size) in sorted(counts.items()):
+            if count and operation != 'verify':
+                reasons.append('%s %d APKs, %s' % (operation, count, MiaUtils.format_file_size(size)))
+        if unknown_sizes:
+            reasons.append('the size of %d downloads is unknown' % unknown_sizes)
+        if counts['verify'][0]:
+            reasons.append('verify the signatures of %d APKs' % counts['verify'][0])
+        if unpinned:
+            reasons.append('pin the signers of %d apps' % unpinned)
+
+        if reasons:
+            size = sum(counts[operation][1] for operation in ('download', 'copy', 'share'))
+            duration = (
+                counts['download'][1] / float(cls.get_network_rate(settings)) +
+                (counts['copy'][1] + counts['share'][1]) / float(cls.rates['disk']) +
+                counts['verify'][1] / float(cls.rates['signatures'])
+            )
+            cls.add_action(actions, 'mia definition dl-apps %s' % definition, reasons, None if unknown_sizes else size)
+            actions[-1]['duration'] = duration
+
+        return sum(counts[operation][0] for operation in ('download', 'copy', 'share'))
+
+    @staticmethod
+    def get_apk_operation(apk_info, apk_path, cache_path):
+        """
+        :return: A (operation, size) tuple, the operation is None if the APK is
+          already in the archive.
+        """
+        if os.path.isfile(apk_path):
+            return None, os.path.getsize(apk_path)
+
+        if os.path.isfile(cache_path):
+            return 'copy', os.path.getsize(cache_path)
+
+        if 'hash' in apk_info:
+            found = MiaPack.find(cache_path)
+            if found is not None:
+                return 'copy', found[1]['size']
+
+            shared_path = Definition.get_shared_apk_path(apk_info, os.path.dirname(cache_path))
+            if shared_path is not None:
+                return 'share', os.path.getsize(shared_path)
+
+        return 'download', apk_info.get('size')
+
+    @classmethod
+    def get_network_rate(cls, settings):
+        """
+        :return: The best measured throughput of the repository mirrors, or
+          the default one.
+        """
+        rankings = MiaMirrors.load_rankings()
+        rates = [
+            result['throughput']
+            for repo_info in settings['repositories'] if repo_info['id'] in rankings
+            for result in rankings[repo_info['id']]['mirrors'] if result['healthy']
+        ]
+
+        return max(rates) if rates else cls.rates['network']
+
+    @classmethod
+    def plan_os(cls, actions, settings):
+        """
+        :return: The path of the OS zip file, downloaded or not, or None if
+          the OS is not configured.
+        """
+        try:
+            zip_name = MiaHandler.get_os_zip_filename(settings)
+        except KeyError:
+            return None
+
+        zip_path = os.path.join(MiaHandler.get_workspace_path(), 'resources', zip_name)
+        if os.path.isfile(zip_path) and os.path.isfile(zip_path + '.md5'):
+            return zip_path
+
+        # Extracted from the mounted packs when installing.
+        if MiaPack.find(zip_path) is not None and MiaPack.find(zip_path + '.md5') is not None:
+            return zip_path
+
+        reason = 'no %s file' % zip_name if not os.path.isfile(zip_path) else 'no hash file for %s' % zip_name
+        cls.add_action(actions, 'mia definition dl-os %s' % MiaHandler.args['<definition>'], [reason], None)
+
+        return zip_path
+
+    @classmethod
+    def plan_build(cls, actions, definition_path, apps):
+        """
+        :param apps: The number of APKs to add to the archive.
+        :return: The estimated size of the update.zip file, or None if it is
+          up to date.
+        """
+        zip_path = Build.get_update_zip_path()
+        snapshot = Build.get_archive_snapshot(os.path.join(definition_path, 'archive'))
+        manifest = Build.load_manifest(zip_path)
+
+        reasons = []
+        if not os.path.isfile(zip_path):
+            reasons.append('no build')
+        elif manifest is None:
+            reasons.append('no manifest for the last build')
+        else:
+            files = manifest['files']
+            changed = [path for path in snapshot if path in files and snapshot[path] != files[path]]
+            added = [path for path in snapshot if path not in files]
+            removed = [path for path in files if path not in snapshot]
+            for count, change in ((len(changed), 'changed'), (len(added), 'added'), (len(removed), 'removed')):
+                if count:
+                    reasons.append('%d files %s since the last build' % (count, change))
+
+        if apps is None or apps:
+            reasons.append('add the downloaded apps')
+        if os.path.isfile(zip_path) and not os.path.isfile(zip_path + '.md5'):
+            reasons.append('no hash file for the build')
+
+        if not reasons:
+            return None
+
+        size = sum(file_size for file_size, mtime in snapshot.values())
+        cls.add_action(actions, 'mia build %s' % MiaHandler.args['<definition>'], reasons, size, cls.rates['zip'])
+
+        return size
+
+    @classmethod
+    def plan_install(cls, actions, os_zip_path, update_zip_size):
+        """
+        :param update_zip_size: The estimated size of the new build, or None if
+          the build is up to date.
+        """
+        serial = MiaAndroid.get_device_serial()
+        pushed = MiaAndroid.load_pushed_files(serial) if serial is not None else {}
+
+        reasons = []
+        size = 0
+        if update_zip_size is not None:
+            reasons.append('push the new build')
+            size += update_zip_size
+        elif not cls.is_pushed(pushed, Build.get_update_zip_path(), '/sdcard/mia-update.zip'):
+            reasons.append('push the build')
+            size += os.path.getsize(Build.get_update_zip_path())
+
+        # The OS downloaded by the planned dl-os action is pushed too.
+        skip_os = os_zip_path is None or (
+            os.path.isfile(os_zip_path) and cls.is_pushed(pushed, os_zip_path, '/sdcard/mia-os.zip')
+        )
+        if not skip_os:
+            reasons.append('push the OS')
+            found = None if os.path.isfile(os_zip_path) else MiaPack.find(os_zip_path)
+            if found is None and not os.path.isfile(os_zip_path):
+                # Not downloaded yet.
+                size = None
+            else:
+                size += found[1]['size'] if found is not None else os.path.getsize(os_zip_path)
+
+        if not reasons:
+            return
+
+        # The files pushed onto another device are not on this one.
+        if serial is None:
+            reasons.append('no device connected')
+
+        command = ['mia', 'install']
+        if MiaHandler.args['--emulator']:
+            command.append('--emulator')
+        if skip_os:
+            command.append('--skip-os')
+        command.append(MiaHandler.args['<definition>'])
+
+        cls.add_action(actions, ' '.join(command), reasons, size, cls.rates['adb'])
+
+    @staticmethod
+    def is_pushed(pushed, file_path, destination):
+        """
+        :return: Whether the file is already on the device, comparing it's
+          hash file with the hash of the last pushed file.
+        """
+        if destination not in pushed or not os.path.isfile(file_path + '.md5'):
+            return False
+
+        with open(file_path + '.md5', 'r') as fd:
+            hash_value = fd.read().split()
+
+        return bool(hash_value) and pushed[destination]['hash'] == hash_value[0]
+
+    @staticmethod
+    def print_plan(actions, duration):
+        if not actions:
+            print('Nothing to do, the build and the device are up to date (planned in %.0f ms).' % (duration * 1000))
+            return
+
+        print('Planned %d actions in %.0f ms:' % (len(actions), duration * 1000))
+        for index, action in enumerate(actions):
+            estimate = ''
+            if action['size'] is None:
+                estimate = 'unknown size'
+            elif action['size']:
+                estimate = '%s, ~%.1fs' % (MiaUtils.format_file_size(action['size']), action['duration'])
+
+            print(('%2d. %-48s %s' % (index + 1, action['command'], estimate)).rstrip())
+            for reason in action['reasons']:
+                print('      - %s' % reason)
+
+        known = [action for action in actions if action['size'] is not None]
+        print('\nEstimated total: %s, ~%.1fs%s.' % (
+            MiaUtils.format_file_size(sum(action['size'] for action in known)),
+            sum(action['duration'] for action in actions),
+            '' if len(known) == len(actions) else ', without the unknown sizes'
+        ))
+
+
+# Add command to the list of available commands.
+available_commands['plan'] = {
+    'class': Plan,
+    'help': __doc__,
+}
@@ -0,0 +1,231 @@
+"""
+Shell completion of the mia commands, answered from a precomputed cache.
+
+The commands, options, definitions, templates and app ids are saved once to a
+JSON file in the user cache folder, one per workspace, and the file is only
+generated again when the mia package or the workspace changes. This module
+must stay cheap to import, the mia commands are only loaded when generating
+the cache.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+
+from mia import (__version__)
+
+
+class MiaCompletion(object):
+    # Increase when changing the format of the cache files.
+    format_version = 1
+
+    # The options completed with the templates.
+    template_options = ('--template',)
+
+    # The suffixes of the repository index files, see MiaFDroid.index_suffixes.
+    index_suffixes = ('.index-v1.jar', '.index.xml')
+
+    # The suffixes of the files the app ids are read from.
+    app_ids_suffixes = index_suffixes + ('.index-v1.jar.search', '.index.xml.search')
+
+    @staticmethod
+    def get_package_path():
+        return os.path.dirname(os.path.realpath(__file__))
+
+    @staticmethod
+    def get_cache_path(workspace_path):
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        workspace_hash = hashlib.sha1(os.path.realpath(workspace_path).encode('utf-8')).hexdigest()
+
+        return os.path.join(cache_home, 'mia', 'completion-%s.json' % workspace_hash[:16])
+
+    @classmethod
+    def get_stamp(cls, workspace_path):
+        """
+        :return: A list identifying the versions of the package and the
+          workspace files the completions are generated from.
+        """
+        package_path = cls.get_package_path()
+        commands_path = os.path.join(package_path, 'commands')
+        templates_path = os.path.join(package_path, 'templates')
+
+        stamp = [cls.format_version, __version__]
+        package_files = [os.path.join(package_path, '__main__.py'), os.path.realpath(__file__), templates_path]
+        for file_path in package_files + sorted(
+                os.path.join(commands_path, name) for name in os.listdir(commands_path) if name.endswith('.py')):
+            stamp.append(os.path.getmtime(file_path))
+
+        # The definitions are listed once their settings file is created, eg:
+        # after the template files were copied into the definition folder.
+        definitions_path = os.path.join(workspace_path, 'definitions')
+        if os.path.isdir(definitions_path):
+            for name in sorted(os.listdir(definitions_path)):
+                settings_path = os.path.join(definitions_path, name, 'settings.yaml')
+                if os.path.isfile(settings_path):
+                    stamp.append([name, os.path.getmtime(settings_path)])
+
+        # The app ids come from the search indexes of the downloaded
+        # repository indexes, once built by a search.
+        resources_path = os.path.join(workspace_path, 'resources')
+        if os.path.isdir(resources_path):
+            for name in sorted(os.listdir(resources_path)):
+                if name.endswith(cls.app_ids_suffixes):
+                    file_stat = os.stat(os.path.join(resources_path, name))
+                    stamp.append([name, file_stat.st_size, file_stat.st_mtime])
+
+        return stamp
+
+    @classmethod
+    def load(cls, workspace_path, main_doc):
+        """
+        Load the cached completions, generating them when outdated.
+        """
+        stamp = cls.get_stamp(workspace_path)
+        cache_path = cls.get_cache_path(workspace_path)
+
+        if os.path.isfile(cache_path):
+            try:
+                with open(cache_path, 'r') as fd:
+                    completions = json.load(fd)
+                if completions.get('stamp') == stamp:
+                    return completions
+            except ValueError:
+                pass
+
+        completions = cls.generate(workspace_path, main_doc)
+        completions['stamp'] = stamp
+
+        try:
+            if not os.path.isdir(os.path.dirname(cache_path)):
+                os.makedirs(os.path.dirname(cache_path), mode=0o755)
+
+            # Write the file atomically, completions may run concurrently.
+            temp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+            with open(temp_path, 'w') as fd:
+                json.dump(completions, fd)
+            os.rename(temp_path, cache_path)
+        except (IOError, OSError):
+            # Completion still works without the cache, only slower.
+            pass
+
+        return completions
+
+    @classmethod
+    def generate(cls, workspace_path, main_doc):
+        """
+        Collect the completions from the commands help and the workspace.
+        """
+        from mia.commands import available_commands
+        from mia.handler import MiaHandler
+        from mia.search import MiaSearch
+
+        MiaHandler(os.path.dirname(cls.get_package_path()), workspace_path, {})
+
+        completions = {
+            'commands': cls.get_section_words(main_doc, 'Available commands'),
+            'global_options': cls.get_section_words(main_doc, 'Global options'),
+            'sub_commands': {},
+            'command_options': {},
+            'definition_commands': [],
+            'definitions': MiaHandler.get_definition_names(),
+            'templates': [],
+            'app_ids': [],
+        }
+
+        for command, info in available_commands.items():
+            completions['sub_commands'][command] = cls.get_section_words(info['help'], 'Available sub-commands')
+            completions['command_options'][command] = cls.get_section_words(info['help'], 'Command options')
+            if '<definition>' in info['help']:
+                completions['definition_commands'].append(command)
+
+        templates_path = os.path.join(cls.get_package_path(), 'templates')
+        completions['templates'] = sorted(
+            name for name in os.listdir(templates_path) if os.path.isdir(os.path.join(templates_path, name))
+        )
+
+        resources_path = os.path.join(workspace_path, 'resources')
+        if os.path.isdir(resources_path):
+            repo_ids = set(
+                name[:-len(suffix)] for name in os.listdir(resources_path)
+                for suffix in cls.index_suffixes if name.endswith(suffix)
+            )
+            # NOTE: Building the search indexes takes seconds, too slow for a
+            # tab press, the app ids are completed once a search built them.
+            completions['app_ids'] = MiaSearch.complete_app_ids('', sorted(repo_ids), False)
+
+        return completions
+
+    @staticmethod
+    def get_section_words(doc, section_name):
+        """
+        :return: The commands or the options listed in a section of a command
+          help, without the option values, eg: --cpu for --cpu=<cpu>.
+        """
+        match = re.search(r'^%s:\n((?:[ \t]+\S.*\n)+)' % re.escape(section_name), doc, re.IGNORECASE | re.MULTILINE)
+        if match is None:
+            return []
+
+        words = []
+        for line in match.group(1).splitlines():
+            # Skip the continuation lines of the descriptions.
+            if re.match(r'^ {1,4}\S', line) is None:
+                continue
+
+            for word in line.strip().split('  ')[0].split(', '):
+                words.append(re.sub(r'=<\w+>$', '', word))
+
+        return words
+
+    @classmethod
+    def complete(cls, completions, words):
+        """
+        :param words: The words following "mia", the last one is completed.
+        :return: The sorted candidates starting with the completed word.
+        """
+        current = words[-1] if words else ''
+        previous = words[:-1]
+
+        # Bash splits "--template=mia" into three words.
+        if previous and previous[-1] == '=':
+            previous = previous[:-1]
+
+        command = None
+        arguments = []
+        for word in previous:
+            if command is None and word in completions['commands']:
+                command = word
+            elif command is not None and not word.startswith('-'):
+                arguments.append(word)
+
+        if command is None:
+            candidates = completions['global_options']
+            if not current.startswith('-'):
+                candidates = candidates + completions['commands']
+        elif current.startswith('-'):
+            candidates = completions['command_options'].get(command, [])
+        elif previous and previous[-1] in cls.template_options:
+            candidates = completions['templates']
+        elif completions['sub_commands'].get(command) and not arguments:
+            candidates = completions['sub_commands'][command]
+        elif command == 'definition' and arguments[:1] == ['search']:
+            candidates = completions['app_ids']
+        elif command in completions['definition_commands'] and not (set(arguments) & set(completions['definitions'])):
+            candidates = completions['definitions']
+        else:
+            candidates = []
+
+        return sorted(candidate for candidate in candidates if candidate.startswith(current))
+
+    @classmethod
+    def main(cls, workspace_path, main_doc, words):
+        """
+        Print the completion candidates, one per line.
+        """
+        completions = cls.load(workspace_path, main_doc)
+        candidates = cls.complete(completions, words)
+        if candidates:
+            sys.stdout.write('\n'.join(candidates) + '\n')
+
+        return 0
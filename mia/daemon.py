@@ -0,0 +1,382 @@
+"""
+Optional daemon running the mia commands of a workspace, keeping the loaded
+modules, the parsed settings and repository indexes and the file hashes warm
+in memory between the commands.
+
+The CLI forwards the commands over a Unix socket when the daemon of the current
+workspace is running, and runs them in-process otherwise. The sockets are in a
+folder private to the user, and both ends check the user of the other end. The
+client passes it's standard input and outputs to the daemon, so the commands
+display their output, prompt the user and run external commands (eg: adb) as
+usual. The commands run one at a time.
+
+This module must stay cheap to import, it is used for every command.
+"""
+
+import array
+import hashlib
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import time
+import traceback
+
+
+class MiaDaemon(object):
+    # Set this environment variable to always run the commands in-process.
+    disable_variable = 'MIA_NO_DAEMON'
+
+    # The maximum size of the first message chunk, with the file descriptors.
+    chunk_size = 65536
+
+    @staticmethod
+    def is_supported():
+        # NOTE: Passing file descriptors requires Python 3.
+        return hasattr(socket, 'AF_UNIX') and hasattr(socket.socket, 'sendmsg')
+
+    @staticmethod
+    def get_sockets_path():
+        """
+        :return: The private folder of the user sockets, in the user runtime
+          folder, since the socket paths length is limited.
+        """
+        runtime_path = os.environ.get('XDG_RUNTIME_DIR')
+        if not runtime_path or not os.path.isdir(runtime_path):
+            runtime_path = tempfile.gettempdir()
+
+        return os.path.join(runtime_path, 'mia-%d' % os.getuid())
+
+    @classmethod
+    def get_socket_path(cls, workspace_path):
+        """
+        :return: The socket path of the workspace daemon.
+        """
+        workspace_hash = hashlib.sha1(os.path.realpath(workspace_path).encode('utf-8')).hexdigest()
+
+        return os.path.join(cls.get_sockets_path(), '%s.sock' % workspace_hash[:16])
+
+    @classmethod
+    def is_private_folder(cls, create=False):
+        """
+        Check that the sockets folder can only be used by the current user, eg:
+        in a shared /tmp folder, where another user could create it first.
+        :param create: Create the folder if missing.
+        """
+        sockets_path = cls.get_sockets_path()
+        if create and not os.path.lexists(sockets_path):
+            try:
+                os.mkdir(sockets_path, 0o700)
+            except OSError:
+                # Created concurrently, checked below.
+                pass
+
+        try:
+            folder_stat = os.lstat(sockets_path)
+        except OSError:
+            return False
+
+        return (
+            stat.S_ISDIR(folder_stat.st_mode) and folder_stat.st_uid == os.getuid() and
+            not folder_stat.st_mode & 0o077
+        )
+
+    @staticmethod
+    def get_peer_uid(connection):
+        """
+        :return: The user id of the other end of a socket, or None if unknown.
+        """
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return None
+
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        return struct.unpack('3i', credentials)[1]
+
+    @classmethod
+    def connect(cls, workspace_path):
+        """
+        :return: A socket connected to the workspace daemon, or None if it is
+          not running.
+        """
+        socket_path = cls.get_socket_path(workspace_path)
+        if not cls.is_supported() or not os.path.exists(socket_path) or not cls.is_private_folder():
+            return None
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(socket_path)
+        except (IOError, OSError):
+            # A stale socket, left by a killed daemon.
+            client.close()
+            return None
+
+        # Never send the environment and the terminal to another user.
+        peer_uid = cls.get_peer_uid(client)
+        if peer_uid is not None and peer_uid != os.getuid():
+            client.close()
+            return None
+
+        return client
+
+    @staticmethod
+    def get_command_name(argv):
+        for arg in argv:
+            if not arg.startswith('-'):
+                return arg
+
+        return None
+
+    @classmethod
+    def forward(cls, argv, workspace_path):
+        """
+        Run a command in the daemon, if it is running.
+        :return: The exit code, or None if the command was not forwarded.
+        """
+        if os.environ.get(cls.disable_variable) or cls.get_command_name(argv) == 'daemon':
+            return None
+
+        try:
+            fds = [stream.fileno() for stream in (sys.stdin, sys.stdout, sys.stderr)]
+        except (AttributeError, ValueError):
+            # The standard streams are closed or replaced.
+            return None
+
+        client = cls.connect(workspace_path)
+        if client is None:
+            return None
+
+        request = {
+            'type': 'run',
+            'argv': argv,
+            'cwd': workspace_path,
+            'env': dict(os.environ),
+        }
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        try:
+            client.sendmsg(
+                [cls.encode(request)],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+            )
+            reader = client.makefile('rb')
+            response = cls.read_message(reader)
+
+            try:
+                response = cls.read_message(reader)
+            except KeyboardInterrupt:
+                # Interrupt the command, the same as when running in-process.
+                if response is not None:
+                    os.kill(response['pid'], signal.SIGINT)
+                response = cls.read_message(reader)
+        except (IOError, OSError) as e:
+            print('ERROR: Lost the connection to the mia daemon: %s' % e)
+            return 1
+        finally:
+            client.close()
+
+        if response is None or 'exit_code' not in response:
+            print('ERROR: The mia daemon stopped before finishing the command.')
+            return 1
+
+        return response['exit_code']
+
+    @classmethod
+    def request(cls, workspace_path, request_type):
+        """
+        Send a control request, eg: status or stop.
+        :return: The response, or None if the daemon is not running.
+        """
+        client = cls.connect(workspace_path)
+        if client is None:
+            return None
+
+        try:
+            client.sendall(cls.encode({'type': request_type}))
+            return cls.read_message(client.makefile('rb'))
+        finally:
+            client.close()
+
+    @staticmethod
+    def encode(message):
+        return (json.dumps(message) + '\n').encode('utf-8')
+
+    @staticmethod
+    def read_message(reader):
+        line = reader.readline()
+        if not line:
+            return None
+
+        return json.loads(line.decode('utf-8'))
+
+    @classmethod
+    def serve(cls, workspace_path, handler):
+        """
+        Run the commands sent by the clients, until stopped.
+        :param handler: A function running a command, called with the argv
+          list and the workspace path, and returning the exit code.
+        """
+        if not cls.is_supported():
+            print('ERROR: The daemon requires Python 3 and Unix sockets.')
+            sys.exit(1)
+
+        if cls.connect(workspace_path) is not None:
+            print('ERROR: The daemon is already running for this workspace.')
+            sys.exit(1)
+
+        if not cls.is_private_folder(True):
+            print('ERROR: The sockets folder is not private to the current user:\n - %s' % cls.get_sockets_path())
+            sys.exit(1)
+
+        socket_path = cls.get_socket_path(workspace_path)
+        if os.path.lexists(socket_path):
+            os.remove(socket_path)
+
+        # Only the current user may connect.
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            server.bind(socket_path)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+
+        print('The mia daemon is listening on:\n - %s' % socket_path)
+        sys.stdout.flush()
+
+        # Remove the socket when terminated, eg: by a service manager.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        stats = {'pid': os.getpid(), 'start_time': time.time(), 'commands': 0}
+        try:
+            running = True
+            while running:
+                connection = server.accept()[0]
+                try:
+                    running = cls.handle(connection, handler, stats)
+                except (IOError, OSError) as e:
+                    print('WARNING: %s' % e)
+                finally:
+                    connection.close()
+        except KeyboardInterrupt:
+            print('\n' + 'Exiting...')
+        finally:
+            server.close()
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+    @classmethod
+    def handle(cls, connection, handler, stats):
+        """
+        Handle the request of a client.
+        :return: False if the daemon should stop.
+        """
+        # Ignore the other users, even if the socket permissions allow them.
+        peer_uid = cls.get_peer_uid(connection)
+        if peer_uid is not None and peer_uid != os.getuid():
+            return True
+
+        request, fds = cls.receive(connection)
+        try:
+            if request is None:
+                return True
+
+            if request['type'] == 'status':
+                connection.sendall(cls.encode(dict(stats, uptime=time.time() - stats['start_time'])))
+                return True
+
+            if request['type'] == 'stop':
+                connection.sendall(cls.encode({'stopped': True}))
+                return False
+
+            if len(fds) != 3:
+                return True
+
+            connection.sendall(cls.encode({'pid': os.getpid()}))
+            exit_code = cls.run_command(request, fds, handler)
+            stats['commands'] += 1
+            connection.sendall(cls.encode({'exit_code': exit_code}))
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+        return True
+
+    @classmethod
+    def receive(cls, connection):
+        """
+        :return: A (request, file descriptors) tuple.
+        """
+        fds = array.array('i')
+        data, ancdata, flags, address = connection.recvmsg(
+            cls.chunk_size, socket.CMSG_LEN(3 * fds.itemsize)
+        )
+        for level, message_type, cdata in ancdata:
+            if level == socket.SOL_SOCKET and message_type == socket.SCM_RIGHTS:
+                fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+
+        # The environment may not fit in the first chunk.
+        while data and not data.endswith(b'\n'):
+            chunk = connection.recv(cls.chunk_size)
+            if not chunk:
+                break
+            data += chunk
+
+        if not data.endswith(b'\n'):
+            return None, list(fds)
+
+        return json.loads(data.decode('utf-8')), list(fds)
+
+    @staticmethod
+    def run_command(request, fds, handler):
+        """
+        Run a command using the client standard input and outputs, working
+        directory and environment.
+        :return: The exit code.
+        """
+        saved_fds = [os.dup(fd) for fd in (0, 1, 2)]
+        saved_environ = dict(os.environ)
+        saved_cwd = os.getcwd()
+
+        try:
+            for fd, client_fd in zip((0, 1, 2), fds):
+                os.dup2(client_fd, fd)
+
+            # Display the output right away, the same as in a terminal.
+            sys.stdout.reconfigure(line_buffering=True)
+
+            os.environ.clear()
+            os.environ.update(request['env'])
+            os.chdir(request['cwd'])
+
+            try:
+                # NOTE: The commands return None on success.
+                exit_code = handler(request['argv'], request['cwd']) or 0
+            except SystemExit as e:
+                # Eg: the docopt usage, or sys.exit() in the commands.
+                if e.code is None or isinstance(e.code, int):
+                    exit_code = e.code or 0
+                else:
+                    sys.stderr.write('%s\n' % e.code)
+                    exit_code = 1
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+            for fd, saved_fd in zip((0, 1, 2), saved_fds):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+
+            os.environ.clear()
+            os.environ.update(saved_environ)
+            os.chdir(saved_cwd)
+
+        return exit_code
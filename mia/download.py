@@ -0,0 +1,412 @@
+"""
+Resumable downloads using parallel HTTP Range requests.
+
+The file is downloaded in segments into a `.part` file, and the progress is
+saved to a `.part.json` file so an interrupted download can be resumed. The
+hash is computed while downloading, following the contiguous downloaded part
+of the file, so the file does not have to be read again once finished.
+
+When multiple URLs (mirrors) of the same file are provided, the segments are
+spread across them, and a failed segment continues from the next URL. The
+servers ignoring the Range requests send the whole file instead, the segments
+are then read from that single stream.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    # Python 2.
+    from urllib2 import HTTPError, Request, URLError, urlopen
+
+from mia.profiler import MiaProfiler
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadNotFoundError(DownloadError):
+    """
+    None of the URLs provide the file.
+    """
+    pass
+
+
+class MiaDownloader(object):
+    # The size of the chunks read from the network and hashed.
+    chunk_size = 256 * 1024
+
+    # Save the progress after downloading this many bytes.
+    state_interval = 8 * 1024 * 1024
+
+    # The range of a partial response, eg: bytes 0-1023/4096
+    content_range_pattern = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+    def __init__(self, url, file_path, segments=4, hash_type='md5', timeout=60, retries=3):
+        """
+        :param url: The URL of the file, or a list of URLs, best mirror first.
+        :param file_path: Where to save the downloaded file.
+        :param segments: The number of parallel HTTP Range requests.
+        :param hash_type: The type of hash computed while downloading.
+        :param timeout: The timeout, in seconds, of the network operations.
+        :param retries: How many times to retry a failed segment.
+        """
+        self.urls = [url] if not isinstance(url, list) else list(url)
+        self.url = self.urls[0]
+        self.failed_urls = set()
+        self.file_path = file_path
+        self.part_path = file_path + '.part'
+        self.state_path = file_path + '.part.json'
+        self.segments_count = max(1, int(segments))
+        self.hash_type = hash_type
+        self.timeout = timeout
+        self.retries = retries
+
+        self.size = None
+        self.segments = []
+        self.lock = threading.Lock()
+        self.progress = threading.Condition(self.lock)
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.unsaved_bytes = 0
+        self.downloaded_bytes = 0
+
+    def download(self, expected_hash=None, show_progress=True):
+        """
+        Download the file, resuming a previous download if possible.
+        :param expected_hash: Verify the hash of the file, if provided.
+        :param show_progress: Periodically display the download progress.
+        :return: The hash of the downloaded file.
+        :raise DownloadError: If the download failed or the hash is wrong.
+        """
+        with MiaProfiler.span('segmented download') as span:
+            size, ranges_supported = self.get_remote_info()
+            self.prepare(size, ranges_supported)
+
+            workers = []
+            for index in range(len(self.segments)):
+                worker = threading.Thread(target=self.download_segment, args=(index,))
+                worker.daemon = True
+                workers.append(worker)
+                worker.start()
+
+            hasher = MiaStreamHasher(self)
+            hasher.daemon = True
+            hasher.start()
+
+            try:
+                # NOTE: Join with a timeout, to be able to handle interruptions.
+                last_report = time.time()
+                while any(worker.is_alive() for worker in workers):
+                    for worker in workers:
+                        worker.join(0.2)
+
+                    if show_progress and time.time() - last_report > 2:
+                        last_report = time.time()
+                        self.print_progress()
+            except BaseException:
+                self.stop_event.set()
+                raise
+            finally:
+                self.save_state()
+
+            if self.errors:
+                self.stop_event.set()
+                raise DownloadError('Could not download %s: %s' % (self.url, self.errors[0]))
+
+            hasher.join()
+            hash_value = hasher.hexdigest()
+            span.add('bytes', self.downloaded_bytes)
+
+        if expected_hash is not None and hash_value != expected_hash.lower():
+            # Start from scratch next time, the downloaded data is not valid.
+            self.remove_partial_files()
+            raise DownloadError('Unexpected %s hash of %s: %s' % (self.hash_type, self.url, hash_value))
+
+        # The download is complete.
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+        os.rename(self.part_path, self.file_path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+        return hash_value
+
+    def get_remote_info(self):
+        """
+        :return: A (size, ranges supported) tuple, the size might be None.
+        """
+        response = None
+        missing_urls = 0
+        for url in self.urls:
+            try:
+                response = urlopen(Request(url, headers={'Range': 'bytes=0-0'}), timeout=self.timeout)
+                break
+            except (HTTPError, URLError, IOError) as e:
+                self.failed_urls.add(url)
+                if isinstance(e, HTTPError) and e.code == 404:
+                    missing_urls += 1
+                if url == self.urls[-1]:
+                    if missing_urls == len(self.urls):
+                        raise DownloadNotFoundError('Could not find %s: %s' % (url, e))
+                    raise DownloadError('Could not access %s: %s' % (url, e))
+
+        try:
+            content_range = response.headers.get('Content-Range')
+            if response.getcode() == 206 and content_range and '/' in content_range:
+                total_size = content_range.rsplit('/', 1)[1]
+                if total_size.isdigit():
+                    return int(total_size), True
+
+            content_length = response.headers.get('Content-Length')
+            return int(content_length) if content_length else None, False
+        finally:
+            response.close()
+
+    def prepare(self, size, ranges_supported):
+        """
+        Split the file into segments, or restore the segments of a previous run.
+        """
+        self.size = size
+
+        state = self.load_state()
+        if ranges_supported and state and state['url'] in self.urls and state['size'] == size \
+                and os.path.isfile(self.part_path) and os.path.getsize(self.part_path) == size:
+            print('Resuming the download of:\n - %s' % self.url)
+            self.segments = state['segments']
+            return
+
+        # Start a new download.
+        self.remove_partial_files()
+
+        if not ranges_supported or not size:
+            # Download the file in one go, the size might not be known.
+            self.segments = [[0, None, 0]]
+        else:
+            # Segments are [start, end, downloaded bytes], the end is excluded.
+            segment_size = -(-size // self.segments_count)
+            self.segments = [
+                [start, min(start + segment_size, size), 0]
+                for start in range(0, size, segment_size)
+            ]
+
+        with open(self.part_path, 'wb') as fd:
+            if size:
+                fd.truncate(size)
+
+        self.save_state()
+
+    def download_segment(self, index):
+        segment = self.segments[index]
+        attempts = 0
+
+        # Spread the segments across the available URLs.
+        urls = [url for url in self.urls if url not in self.failed_urls] or self.urls
+        url_index = index % len(urls)
+
+        while not self.stop_event.is_set():
+            start, end, done = segment
+            if end is not None and start + done >= end:
+                return
+
+            headers = {}
+            if end is not None:
+                headers['Range'] = 'bytes=%d-%d' % (start + done, end - 1)
+
+            url = urls[url_index % len(urls)]
+            try:
+                response = urlopen(Request(url, headers=headers), timeout=self.timeout)
+                try:
+                    if end is not None:
+                        self.seek_response(response, start + done, end)
+                    self.read_response(response, segment)
+                finally:
+                    response.close()
+
+                if end is None:
+                    # The size was unknown, the segment ends with the response.
+                    with self.progress:
+                        segment[1] = start + segment[2]
+                        self.progress.notify_all()
+                    return
+            except (HTTPError, URLError, IOError, OSError) as e:
+                attempts += 1
+                if attempts > self.retries * len(urls) or (end is None and segment[2]):
+                    with self.progress:
+                        self.errors.append(e)
+                        self.progress.notify_all()
+                    return
+
+                if len(urls) > 1:
+                    # Fail over to the next URL, continuing from the last
+                    # downloaded byte.
+                    with self.lock:
+                        self.failed_urls.add(url)
+                    url_index += 1
+                    continue
+
+                # Retry, continuing from the last downloaded byte.
+                time.sleep(min(2 ** attempts, 10))
+
+    def seek_response(self, response, offset, end):
+        """
+        Make sure the response to a Range request starts at the requested
+        offset. When the server ignored the Range header, the start of the
+        whole file is skipped.
+        :raise IOError: If the response is not the requested range.
+        """
+        if response.getcode() == 200:
+            skipped = 0
+            while skipped < offset and not self.stop_event.is_set():
+                chunk = response.read(min(self.chunk_size, offset - skipped))
+                if not chunk:
+                    raise IOError('Connection closed before the start of the segment.')
+                skipped += len(chunk)
+            return
+
+        content_range = response.headers.get('Content-Range') or ''
+        match = self.content_range_pattern.match(content_range)
+        if response.getcode() != 206 or match is None or int(match.group(1)) != offset \
+                or int(match.group(2)) >= end or match.group(3) not in ('*', str(self.size)):
+            raise IOError('Unexpected response %d, %r, to the request of the bytes %d-%d.' % (
+                response.getcode(), content_range, offset, end - 1
+            ))
+
+    def read_response(self, response, segment):
+        start, end = segment[0], segment[1]
+
+        with open(self.part_path, 'r+b') as fd:
+            fd.seek(start + segment[2])
+
+            while not self.stop_event.is_set():
+                chunk_size = self.chunk_size
+                if end is not None:
+                    chunk_size = min(chunk_size, end - start - segment[2])
+                    if chunk_size <= 0:
+                        break
+
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    if end is not None and start + segment[2] < end:
+                        raise IOError('Connection closed before the end of the segment.')
+                    break
+
+                fd.write(chunk)
+                fd.flush()
+
+                with self.progress:
+                    segment[2] += len(chunk)
+                    self.downloaded_bytes += len(chunk)
+                    self.unsaved_bytes += len(chunk)
+                    save_state = self.unsaved_bytes >= self.state_interval
+                    self.progress.notify_all()
+
+                if save_state:
+                    self.save_state()
+
+    def get_contiguous_size(self):
+        """
+        :return: The size of the downloaded part, from the start of the file.
+        """
+        contiguous_size = 0
+        for start, end, done in self.segments:
+            contiguous_size = start + done
+            if end is None or start + done < end:
+                break
+
+        return contiguous_size
+
+    def is_finished(self):
+        if self.errors:
+            return True
+
+        return all(end is not None and start + done >= end for start, end, done in self.segments)
+
+    def load_state(self):
+        if not os.path.isfile(self.state_path):
+            return None
+
+        try:
+            with open(self.state_path, 'r') as fd:
+                return json.load(fd)
+        except ValueError:
+            return None
+
+    def save_state(self):
+        with self.lock:
+            self.unsaved_bytes = 0
+            state = {
+                'url': self.url,
+                'size': self.size,
+                'segments': [list(segment) for segment in self.segments],
+            }
+
+        # Write the state atomically.
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as fd:
+            json.dump(state, fd)
+        os.rename(temp_path, self.state_path)
+
+    def remove_partial_files(self):
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def print_progress(self):
+        with self.lock:
+            done = sum(segment[2] for segment in self.segments)
+
+        if self.size:
+            print(' - downloaded %.1f%% of %s' % (done * 100.0 / self.size, self.format_size(self.size)))
+        else:
+            print(' - downloaded %s' % self.format_size(done))
+
+    @staticmethod
+    def format_size(size):
+        return '%.2f Mb' % (size / 1024.0 / 1024.0)
+
+
+class MiaStreamHasher(threading.Thread):
+    """
+    Hash the downloaded data as soon as it is contiguous with the hashed part.
+    """
+    def __init__(self, downloader):
+        super(MiaStreamHasher, self).__init__()
+        self.downloader = downloader
+        self.hash = hashlib.new(downloader.hash_type)
+
+    def run(self):
+        downloader = self.downloader
+        hashed_size = 0
+
+        # NOTE: Unbuffered, the data written after a read must not be read from
+        # a stale buffer.
+        with open(downloader.part_path, 'rb', 0) as fd:
+            while not downloader.stop_event.is_set():
+                with downloader.progress:
+                    available_size = downloader.get_contiguous_size()
+                    if available_size <= hashed_size:
+                        if downloader.is_finished():
+                            return
+
+                        downloader.progress.wait(1)
+                        continue
+
+                fd.seek(hashed_size)
+                while hashed_size < available_size:
+                    chunk = fd.read(min(downloader.chunk_size, available_size - hashed_size))
+                    if not chunk:
+                        break
+                    self.hash.update(chunk)
+                    hashed_size += len(chunk)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
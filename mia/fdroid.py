@@ -1,40 +1,278 @@
 """
 Helper functions dealing with F-Droid.
+
+The repository indexes are read from the compressed index-v1.jar file when the
+repository provides it, or from the legacy index.xml file. Both formats are
+read through the same repository interface, returning the same applications
+and packages.
 """
 
+import bisect
+import json
+import os
+import re
+import zipfile
+import xml.etree.ElementTree as ElementTree
+
+from mia.handler import MiaHandler
+from mia.jsonstream import MiaJsonStream
+
+
+class MiaFDroidRepository(object):
+    """
+    The applications of a repository index, whatever it's format. The apps
+    are dictionaries with the id, the name, the summary, the categories list
+    and the packages, the packages are dictionaries with the apkname,
+    versioncode, hash, hash_type, size and signer, the last two might be None.
+    """
+    def get_app_ids(self):
+        """
+        :return: The ids of the apps read from the index, in index order.
+        """
+        raise NotImplementedError()
+
+    def get_app(self, app_id):
+        """
+        :return: The app, or None if not in the repository.
+        """
+        raise NotImplementedError()
+
+    def get_fingerprint(self, app_id):
+        """
+        Get the packages of an application, used to find out whether the
+        application changed since it was locked.
+        :return: A list of [versioncode, hash] lists, or None if not in the
+          repository.
+        """
+        app = self.get_app(app_id)
+        if app is None:
+            return None
+
+        return [[package['versioncode'], package['hash']] for package in app['packages']]
+
+
+class MiaFDroidXmlRepository(MiaFDroidRepository):
+    def __init__(self, root):
+        """
+        :type root: xml.etree.ElementTree.Element
+        """
+        self.root = root
+
+        # Maps the app ids to the application tags, and to the converted apps.
+        self.applications = None
+        self.apps = {}
+
+    def get_applications(self):
+        if self.applications is None:
+            # NOTE: Like before, the last application tag wins for duplicate ids.
+            self.applications = dict((tag.get('id'), tag) for tag in self.root.iter('application'))
+
+        return self.applications
+
+    def get_app_ids(self):
+        return list(self.get_applications())
+
+    def get_app(self, app_id):
+        if app_id in self.apps:
+            return self.apps[app_id]
+
+        tag = self.get_applications().get(app_id)
+        app = None
+        if tag is not None:
+            categories = tag.findtext('categories') or tag.findtext('category') or ''
+            app = {
+                'id': tag.findtext('id'),
+                'name': tag.findtext('name'),
+                'summary': tag.findtext('summary'),
+                'categories': [category for category in categories.split(',') if category],
+                'packages': [{
+                    'apkname': package.findtext('apkname'),
+                    'versioncode': package.findtext('versioncode'),
+                    'hash': package.findtext('hash'),
+                    'hash_type': package.find('hash').get('type') if package.find('hash') is not None else None,
+                    'size': package.findtext('size'),
+                    # The SHA-256 fingerprint of the signer certificate, in the recent indexes.
+                    'signer': package.findtext('signer'),
+                } for package in tag.iter('package')],
+            }
+        self.apps[app_id] = app
+
+        return app
+
+
+class MiaFDroidJsonRepository(MiaFDroidRepository):
+    # The name of the index in the index-v1.jar file.
+    index_name = 'index-v1.json'
+
+    # The app ids in the text of an app of the index.
+    package_name_pattern = re.compile(r'"packageName"\s*:\s*"([^"\\]*)"')
+
+    def __init__(self, apps, app_ids):
+        """
+        :param apps: A dictionary mapping the app ids to the apps.
+        :param app_ids: The app ids read from the index, found or not.
+        """
+        self.apps = apps
+        self.app_ids = frozenset(app_ids)
+
+    @classmethod
+    def load(cls, jar_path, app_ids=None):
+        """
+        Stream the index-v1.json file of a jar file, only decoding the apps
+        and the packages of the given app ids.
+        :param app_ids: The app ids to decode, or None to decode all of them.
+        :raise ValueError: If the index is not valid.
+        """
+        all_apps = app_ids is None
+        app_ids = frozenset(app_ids or ())
+        apps = {}
+        packages = {}
+
+        with zipfile.ZipFile(jar_path) as jar:
+            with jar.open(cls.index_name) as fd:
+                stream = MiaJsonStream(fd)
+                for key in stream.iter_object():
+                    if key == 'apps':
+                        for _ in stream.iter_array():
+                            # Only decode the referenced apps.
+                            raw = stream.read_raw()
+                            if all_apps or app_ids.intersection(cls.package_name_pattern.findall(raw)):
+                                app = cls.get_app_info(json.loads(raw))
+                                if all_apps or app['id'] in app_ids:
+                                    apps[app['id']] = app
+                    elif key == 'packages':
+                        for app_id in stream.iter_object():
+                            if all_apps or app_id in app_ids:
+                                packages[app_id] = [cls.get_package_info(package) for package in stream.read_value()]
+                            else:
+                                stream.skip_value()
+                    else:
+                        stream.skip_value()
+
+        for app_id, app in apps.items():
+            app['packages'] = packages.get(app_id, [])
+
+        return cls(apps, apps if all_apps else app_ids)
+
+    @staticmethod
+    def get_localized(data, field):
+        """
+        :return: The value of a field, from the localized data if missing.
+        """
+        value = data.get(field)
+        localized = data.get('localized') or {}
+        for locale in ['en-US', 'en'] + sorted(localized):
+            if value:
+                break
+            value = (localized.get(locale) or {}).get(field)
+
+        return value
+
+    @classmethod
+    def get_app_info(cls, data):
+        return {
+            'id': data['packageName'],
+            # The name might only be available in the localized data.
+            'name': cls.get_localized(data, 'name'),
+            'summary': cls.get_localized(data, 'summary'),
+            'categories': data.get('categories') or [],
+            'packages': [],
+        }
+
+    @staticmethod
+    def get_package_info(data):
+        return {
+            'apkname': data.get('apkName'),
+            'versioncode': str(data['versionCode']) if data.get('versionCode') is not None else None,
+            'hash': data.get('hash'),
+            'hash_type': data.get('hashType'),
+            'size': data.get('size'),
+            'signer': data.get('signer'),
+        }
+
+    def get_app_ids(self):
+        return list(self.apps)
+
+    def get_app(self, app_id):
+        return self.apps.get(app_id)
+
 
 class MiaFDroid(object):
+    # Maps (repositories ids, app id) to (repositories, sorted versioncodes,
+    # packages) tuples, the packages are (repository id, app, package).
+    __versions = {}
+
+    # A version constraint, eg: >=96000
+    constraint_pattern = re.compile(r'^\s*(==|!=|>=|<=|>|<|~=)?\s*(\d+)\s*$')
+
+    # The suffixes of the downloaded index files, in order of preference.
+    index_suffixes = ('.index-v1.jar', '.index.xml')
+
     @classmethod
-    def fdroid_get_app_lock_info(cls, data, app_info):
-        repo = None
-        app_lock_info = None
+    def get_index_paths(cls, repo_id):
+        """
+        :return: The paths of the index-v1.jar and the index.xml files of a
+          repository, in order of preference.
+        """
+        resources_path = os.path.join(MiaHandler.get_workspace_path(), 'resources')
+        return [os.path.join(resources_path, repo_id + suffix) for suffix in cls.index_suffixes]
+
+    @classmethod
+    def get_index_path(cls, repo_id):
+        """
+        :return: The path of the downloaded index of a repository, or None.
+        """
+        for index_path in cls.get_index_paths(repo_id):
+            if os.path.isfile(index_path):
+                return index_path
+
+        return None
+
+    @staticmethod
+    def load_repository(index_path, app_ids=None):
+        """
+        Read a repository index file, an index-v1.jar or an index.xml file.
+        :param app_ids: The ids of the apps to read from an index-v1.jar file,
+          or None to read all of them.
+        :rtype: MiaFDroidRepository
+        """
+        if index_path.endswith('.jar'):
+            return MiaFDroidJsonRepository.load(index_path, app_ids)
 
+        return MiaFDroidXmlRepository(ElementTree.parse(index_path).getroot())
+
+    @classmethod
+    def fdroid_get_app_lock_info(cls, data, app_info):
+        """
+        Find the newest package of an app matching the version constraints, eg:
+        latest, 96000, >=96000, <200, ~=96000 or >=96000,!=96100
+        The packages of the fallback repository are merged with the packages of
+        the repository, which are preferred for the same versioncode.
+        """
         # Prepare a list of repositories to look into.
         repositories = [app_info['repository']]
         if 'fallback' in data[app_info['repository']]:
             repositories.append(data[app_info['repository']]['fallback'])
 
-        for repo in repositories:
-            # TODO: Improve detection!
-            for tag in data[repo]['tree'].findall('application'):
-                if tag.get('id') != app_info['id']:
-                    continue
-
-                app_lock_info = \
-                    cls._fdroid_index_get_app_info(tag, app_info['versioncode'])
+        try:
+            constraints = cls.fdroid_parse_constraints(app_info['versioncode'])
+        except ValueError:
+            print(' - invalid version constraint: %s:%s' % (app_info['id'], app_info['versioncode']))
+            return None
 
-            # Only try the fallback repository if the application was not found.
-            if app_lock_info is not None:
-                break
+        versioncodes, packages = cls.fdroid_get_app_versions(data, repositories, app_info['id'])
+        index = cls.fdroid_find_version(versioncodes, constraints)
 
-        if app_lock_info is None and app_info['versioncode'] == 'latest':
+        if not versioncodes:
             print(' - no such app: %s' % app_info['id'])
             return None
-        elif app_lock_info is None:
+        elif index is None:
             msg = ' - no package: %s:%s'
             print(msg % (app_info['id'], app_info['versioncode']))
             return None
 
+        repo, app, package = packages[index]
+        app_lock_info = cls._fdroid_index_get_app_info(app, package)
         app_lock_info['package_url'] = '%s/%s' % (
             data[repo]['url'].strip('/'),
             app_lock_info['package_name']
@@ -44,31 +282,133 @@ class MiaFDroid(object):
 
         return app_lock_info
 
+    @classmethod
+    def fdroid_get_app_versions(cls, data, repositories, app_id):
+        """
+        Merge the packages of an app from multiple repositories, sorted by
+        versioncode. The first repository is preferred for the same versioncode.
+        :return: A (sorted versioncodes, packages) tuple.
+        """
+        indexes = tuple(data[repo]['index'] for repo in repositories)
+        key = (tuple(id(index) for index in indexes), app_id)
+
+        cached = cls.__versions.get(key)
+        if cached is not None and all(a is b for a, b in zip(cached[0], indexes)):
+            return cached[1], cached[2]
+
+        packages = {}
+        for repo, index in zip(repositories, indexes):
+            app = index.get_app(app_id)
+            if app is None:
+                continue
+
+            for package in app['packages']:
+                versioncode = package['versioncode']
+                if versioncode is not None and versioncode.strip().isdigit():
+                    packages.setdefault(int(versioncode), (repo, app, package))
+
+        versioncodes = sorted(packages)
+        packages = [packages[versioncode] for versioncode in versioncodes]
+        cls.__versions[key] = (indexes, versioncodes, packages)
+
+        return versioncodes, packages
+
+    @classmethod
+    def fdroid_parse_constraints(cls, spec):
+        """
+        Parse version constraints, separated by commas.
+        :return: A list of (operator, versioncode) tuples, empty for latest.
+        :raise ValueError: If the constraints are not valid.
+        """
+        if spec == 'latest':
+            return []
+
+        constraints = []
+        for part in str(spec).split(','):
+            match = cls.constraint_pattern.match(part)
+            if match is None:
+                raise ValueError('Invalid version constraint: %s' % part)
+            constraints.append((match.group(1) or '==', int(match.group(2))))
+
+        return constraints
+
     @staticmethod
-    def _fdroid_index_get_app_info(tag, target_versioncode):
+    def fdroid_find_version(versioncodes, constraints):
         """
-        :type tag: xml.etree.ElementTree.Element
-        :type target_versioncode: str
-        :rtype: dict
+        Find the newest versioncode matching the constraints, using binary search.
+        :param versioncodes: A sorted list of versioncodes.
+        :return: The index of the versioncode, or None.
         """
-        package = None
-        if target_versioncode == 'latest':
-            package = tag.find('package')
-        else:
-            for item in tag.findall('package'):
-                package_versioncode = item.find('versioncode').text
-                if int(package_versioncode) == int(target_versioncode):
-                    package = item
-                    break
-
-        if package is None:
-            return None
+        low, high = 0, len(versioncodes)
+        excluded = set()
 
-        return {
-            'id': tag.find('id').text,
-            'name': tag.find('name').text,
-            'package_name': package.find('apkname').text,
-            'package_versioncode': package.find('versioncode').text,
-            'hash': package.find('hash').text,
-            'hash_type': package.find('hash').get('type'),
+        for operator, value in constraints:
+            if operator == '==':
+                low = max(low, bisect.bisect_left(versioncodes, value))
+                high = min(high, bisect.bisect_right(versioncodes, value))
+            elif operator == '>=':
+                low = max(low, bisect.bisect_left(versioncodes, value))
+            elif operator == '>':
+                low = max(low, bisect.bisect_right(versioncodes, value))
+            elif operator == '<=':
+                high = min(high, bisect.bisect_right(versioncodes, value))
+            elif operator == '<':
+                high = min(high, bisect.bisect_left(versioncodes, value))
+            elif operator == '!=':
+                excluded.add(value)
+            elif operator == '~=':
+                # Compatible release, the trailing zeros set the precision:
+                # ~=96000 means >=96000,<100000 and ~=96100 means >=96100,<97000
+                precision = 1
+                while value and value % (precision * 10) == 0:
+                    precision *= 10
+                low = max(low, bisect.bisect_left(versioncodes, value))
+                high = min(high, bisect.bisect_left(versioncodes, (value // (precision * 10) + 1) * precision * 10))
+
+        for index in range(high - 1, low - 1, -1):
+            if versioncodes[index] not in excluded:
+                return index
+
+        return None
+
+    @classmethod
+    def fdroid_match_constraints(cls, versioncode, spec):
+        """
+        :return: Whether a versioncode matches the version constraints.
+        """
+        try:
+            return cls.fdroid_find_version([int(versioncode)], cls.fdroid_parse_constraints(spec)) is not None
+        except ValueError:
+            return False
+
+    @classmethod
+    def clear_cache(cls):
+        cls.__versions = {}
+
+    @staticmethod
+    def _fdroid_index_get_app_info(app, package):
+        """
+        :param app: An app of a repository index.
+        :param package: A package of the app.
+        :rtype: dict
+        """
+        app_info = {
+            'id': app['id'],
+            'name': app['name'],
+            'package_name': package['apkname'],
+            'package_versioncode': package['versioncode'],
+            'hash': package['hash'],
+            'hash_type': package['hash_type'],
         }
+
+        # The size of the APK, eg: to estimate the downloads.
+        size = package['size']
+        if size is not None and str(size).isdigit():
+            app_info['size'] = int(size)
+
+        # The SHA-256 fingerprint of the signer certificate.
+        signer = package['signer']
+        if signer and len(signer) == 64:
+            app_info['signer'] = signer.lower()
+
+        return app_info
@@ -9,6 +9,10 @@ import yaml
 
 from pkg_resources import DistributionNotFound, Requirement, resource_filename, resource_isdir
 
+from mia.profiler import MiaProfiler
+from mia.schema import MiaSchema
+from mia.settings import MiaSettings
+
 
 class MiaHandler:
     args = {}
@@ -53,6 +57,30 @@ class MiaHandler:
     def get_workspace_path(cls):
         return cls.__workspace_path
 
+    @classmethod
+    def set_definition(cls, definition):
+        """
+        Switch to another definition, eg: when working with multiple definitions.
+        """
+        cls.args['<definition>'] = definition
+        cls.__definition_path = ''
+        cls.__definition_settings = {}
+        cls.__definition_apps_lock_data = {}
+
+    @classmethod
+    def get_definition_names(cls):
+        """
+        :return: A sorted list with the names of the workspace definitions.
+        """
+        definitions_path = os.path.join(cls.__workspace_path, 'definitions')
+        if not os.path.isdir(definitions_path):
+            return []
+
+        return sorted(
+            name for name in os.listdir(definitions_path)
+            if os.path.isfile(os.path.join(definitions_path, name, 'settings.yaml'))
+        )
+
     @classmethod
     def get_definition_path(cls):
         if not cls.__definition_path and cls.args['<definition>']:
@@ -86,9 +114,10 @@ class MiaHandler:
         return full_path
 
     @classmethod
-    def get_os_zip_filename(cls):
+    def get_os_zip_filename(cls, settings=None):
         # Read the definition settings.
-        settings = cls.get_definition_settings()
+        if settings is None:
+            settings = cls.get_definition_settings()
 
         return '%s-%s-%s.zip' % (
             settings['general']['os_name'],
@@ -105,28 +134,44 @@ class MiaHandler:
                 print('Using definition settings file:\n - %s\n' % settings_file)
 
             try:
-                fd = open(settings_file, 'r')
-
                 # Load the yaml and sort the top level entries.
-                settings = yaml.load(fd)
-
-                fd.close()
+                with MiaProfiler.span('settings load'):
+                    settings = MiaSettings.load(settings_file)
             except yaml.YAMLError:
                 print('ERROR: Could not read configuration file!')
                 sys.exit(1)
 
-            # Set 'user' as default app_type if none was provided.
-            if 'app_type' not in settings['defaults']:
-                settings['defaults']['app_type'] = 'user'
-
-            # Set 'sha256' as default hash_type if none was provided.
-            if 'hash_type' not in settings['defaults']:
-                settings['defaults']['hash_type'] = 'sha256'
+            # Validate the settings early, reporting all the errors at once.
+            errors = MiaSchema.validate(settings)
+            if errors:
+                cls.print_settings_errors(settings_file, errors)
+                sys.exit(1)
 
-            cls.__definition_settings = settings
+            cls.set_definition_settings(settings)
 
         return cls.__definition_settings
 
+    @staticmethod
+    def print_settings_errors(settings_file, errors):
+        print('ERROR: Invalid settings file:\n - %s' % settings_file)
+        for error in errors:
+            print('   - %s' % error)
+
+    @classmethod
+    def set_definition_settings(cls, settings):
+        """
+        Use already loaded settings, eg: after saving changes to the file.
+        """
+        # Set 'user' as default app_type if none was provided.
+        if 'app_type' not in settings['defaults']:
+            settings['defaults']['app_type'] = 'user'
+
+        # Set 'sha256' as default hash_type if none was provided.
+        if 'hash_type' not in settings['defaults']:
+            settings['defaults']['hash_type'] = 'sha256'
+
+        cls.__definition_settings = settings
+
     @classmethod
     def get_definition_apps_lock_data(cls):
         if not cls.__definition_apps_lock_data and cls.args['<definition>']:
@@ -139,12 +184,9 @@ class MiaHandler:
                 sys.exit(1)
 
             try:
-                fd = open(lock_file_path, 'r')
-
                 # Load the yaml and sort the top level entries.
-                lock_data = yaml.load(fd)
-
-                fd.close()
+                with MiaProfiler.span('lock file load'):
+                    lock_data = MiaSettings.load(lock_file_path)
             except yaml.YAMLError:
                 print('ERROR: Could not read configuration file!')
                 sys.exit(1)
@@ -153,3 +195,10 @@ class MiaHandler:
                 cls.__definition_apps_lock_data = lock_data
 
         return cls.__definition_apps_lock_data
+
+    @classmethod
+    def set_definition_apps_lock_data(cls, lock_data):
+        """
+        Use already loaded lock data, eg: right after creating the lock file.
+        """
+        cls.__definition_apps_lock_data = lock_data
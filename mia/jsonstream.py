@@ -0,0 +1,171 @@
+"""
+Streaming reader of large JSON documents, eg: the F-Droid index-v1.json file.
+
+The document is read by chunks, and the caller walks through the objects and
+arrays, decoding only the values it needs and skipping the others without
+building them. Only the text of the current value is kept in memory.
+"""
+
+import codecs
+import json
+import re
+
+
+class MiaJsonStream(object):
+    # The size of the chunks read from the file.
+    chunk_size = 256 * 1024
+
+    # The text up to the next bracket, skipping the brackets inside strings.
+    # It stops at the opening quote of a string truncated by the end of the
+    # buffer.
+    skip_pattern = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+    string_pattern = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+    scalar_pattern = re.compile(r'[^\s,:\[\]{}"]+')
+    whitespace_pattern = re.compile(r'\s*')
+
+    def __init__(self, fd):
+        """
+        :param fd: A file object opened in binary mode, eg: a zip file member.
+        """
+        self.fd = fd
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+
+    def read_more(self):
+        """
+        Append the next chunk to the buffer, dropping the text already read.
+        :return: False at the end of the file.
+        """
+        chunk = self.fd.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(chunk, not chunk)
+        self.pos = 0
+
+        return bool(chunk)
+
+    def peek(self):
+        """
+        :return: The next character, after the whitespace, or '' at the end.
+        """
+        while True:
+            self.pos = self.whitespace_pattern.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError('Expected "%s" at "%s"' % (char, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def read_raw(self, keep=True):
+        """
+        Read the next value without decoding it.
+        :param keep: Keep the text of the value, or drop it while skipping.
+        :return: The text of the value, or None if not kept.
+        """
+        char = self.peek()
+        if char == '':
+            raise ValueError('Unexpected end of the JSON data')
+
+        if char not in '[{':
+            pattern = self.string_pattern if char == '"' else self.scalar_pattern
+            while True:
+                # Make sure the value is not truncated by the end of the buffer.
+                match = pattern.match(self.buffer, self.pos)
+                if match is not None and match.end() < len(self.buffer):
+                    break
+                if not self.read_more():
+                    if match is None:
+                        raise ValueError('Invalid JSON value at "%s"' % self.buffer[self.pos:self.pos + 20])
+                    break
+
+            self.pos = match.end()
+            return match.group()
+
+        # NOTE: Local variables, this loop runs for every bracket.
+        skip = self.skip_pattern.match
+        buffer = self.buffer
+        depth = 1
+        offset = self.pos + 1
+        while True:
+            offset = skip(buffer, offset).end()
+            if offset == len(buffer) or buffer[offset] == '"':
+                # Scan the truncated string again, with the next chunk.
+                if not keep:
+                    self.pos = offset
+                shift = self.pos
+                if not self.read_more():
+                    raise ValueError('Unexpected end of the JSON data')
+                buffer = self.buffer
+                offset -= shift
+                continue
+
+            char = buffer[offset]
+            offset += 1
+            if char == '[' or char == '{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    break
+
+        raw = self.buffer[self.pos:offset] if keep else None
+        self.pos = offset
+
+        return raw
+
+    def read_value(self):
+        """
+        :return: The decoded next value.
+        """
+        return json.loads(self.read_raw())
+
+    def skip_value(self):
+        self.read_raw(False)
+
+    def iter_object(self):
+        """
+        Iterate over the keys of the next object, the caller must read or skip
+        the value of each key.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+
+        while True:
+            key = json.loads(self.read_raw())
+            self.expect(':')
+            yield key
+
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return
+            elif char != ',':
+                raise ValueError('Expected "," or "}" at "%s"' % self.buffer[self.pos - 1:self.pos + 20])
+
+    def iter_array(self):
+        """
+        Iterate over the indexes of the next array, the caller must read or
+        skip each value.
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+
+        index = 0
+        while True:
+            yield index
+            index += 1
+
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return
+            elif char != ',':
+                raise ValueError('Expected "," or "]" at "%s"' % self.buffer[self.pos - 1:self.pos + 20])
@@ -0,0 +1,251 @@
+"""
+Ranking of the repository mirrors and downloads with automatic failover.
+
+A repository can list multiple mirrors, in addition to it's main URL:
+
+    repositories:
+      - id: fdroid
+        name: F-Droid
+        url: https://f-droid.org/repo
+        mirrors:
+          - https://mirror.example.org/fdroid/repo
+
+The mirrors are probed for latency and throughput, and the ranking is cached
+in the workspace resources folder.
+"""
+
+import json
+import os
+import threading
+import time
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    # Python 2.
+    from urllib2 import HTTPError, Request, URLError, urlopen
+
+from mia.download import DownloadNotFoundError, MiaDownloader
+from mia.handler import MiaHandler
+from mia.profiler import MiaProfiler
+
+
+class MiaMirrors(object):
+    # How long, in seconds, the cached ranking is used before probing again.
+    ranking_ttl = 24 * 60 * 60
+
+    # The number of bytes requested when probing a mirror.
+    probe_size = 64 * 1024
+
+    # Spread the downloads across this many of the fastest healthy mirrors.
+    spread = 3
+
+    # The timeout, in seconds, of the probe requests.
+    probe_timeout = 10
+
+    __rankings = None
+    __downloads_count = 0
+    lock = threading.Lock()
+
+    @staticmethod
+    def get_mirror_urls(repo_info):
+        """
+        :return: The main URL of the repository, followed by the mirrors.
+        """
+        urls = [repo_info['url'].rstrip('/')]
+        for url in repo_info.get('mirrors') or []:
+            url = url.rstrip('/')
+            if url not in urls:
+                urls.append(url)
+
+        return urls
+
+    @classmethod
+    def get_cache_path(cls):
+        return os.path.join(MiaHandler.get_workspace_path(), 'resources', 'mirrors.json')
+
+    @classmethod
+    def load_rankings(cls):
+        if cls.__rankings is None:
+            cls.__rankings = {}
+
+            cache_path = cls.get_cache_path()
+            if os.path.isfile(cache_path):
+                try:
+                    with open(cache_path, 'r') as fd:
+                        cls.__rankings = json.load(fd)
+                except ValueError:
+                    pass
+
+        return cls.__rankings
+
+    @classmethod
+    def save_rankings(cls):
+        cache_path = cls.get_cache_path()
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path), mode=0o755)
+
+        with open(cache_path, 'w') as fd:
+            json.dump(cls.load_rankings(), fd, indent=2, sort_keys=True)
+
+    @classmethod
+    def probe(cls, url, path='index.xml'):
+        """
+        Measure the latency and the throughput of a mirror.
+        :return: A dictionary with the probe results.
+        """
+        result = {
+            'url': url,
+            'healthy': False,
+            'latency': None,
+            'throughput': None,
+        }
+
+        request = Request('%s/%s' % (url, path), headers={'Range': 'bytes=0-%d' % (cls.probe_size - 1)})
+        start_time = time.time()
+        try:
+            response = urlopen(request, timeout=cls.probe_timeout)
+            try:
+                first_byte = response.read(1)
+                result['latency'] = time.time() - start_time
+
+                data = response.read()
+                transfer_time = max(time.time() - start_time - result['latency'], 1e-6)
+                result['throughput'] = (len(first_byte) + len(data)) / transfer_time
+                result['healthy'] = True
+            finally:
+                response.close()
+        except (HTTPError, URLError, IOError) as e:
+            result['error'] = str(e)
+
+        return result
+
+    @classmethod
+    def rank(cls, repo_info, force=False):
+        """
+        Probe the mirrors of a repository, and save the ranking in the cache.
+        :return: The list of probe results, best mirror first.
+        """
+        urls = cls.get_mirror_urls(repo_info)
+        rankings = cls.load_rankings()
+        cached = rankings.get(repo_info['id'])
+
+        if not force and cached and sorted(m['url'] for m in cached['mirrors']) == sorted(urls) \
+                and time.time() - cached['timestamp'] < cls.ranking_ttl:
+            return cached['mirrors']
+
+        print('Probing the %s repository mirrors:' % repo_info['name'])
+        with MiaProfiler.span('mirror probe'):
+            results = [None] * len(urls)
+            threads = []
+            for index, url in enumerate(urls):
+                thread = threading.Thread(target=cls._probe_into, args=(results, index, url))
+                thread.daemon = True
+                threads.append(thread)
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        results.sort(key=cls.get_score)
+        for result in results:
+            if result['healthy']:
+                print(' - %s: %.0f ms, %.0f Kb/s' % (
+                    result['url'], result['latency'] * 1000, result['throughput'] / 1024
+                ))
+            else:
+                print(' - %s: unreachable' % result['url'])
+
+        with cls.lock:
+            rankings[repo_info['id']] = {
+                'timestamp': time.time(),
+                'mirrors': results,
+            }
+            cls.save_rankings()
+
+        return results
+
+    @classmethod
+    def _probe_into(cls, results, index, url):
+        results[index] = cls.probe(url)
+
+    @staticmethod
+    def get_score(result):
+        """
+        The estimated time to download 1 Mb, unreachable mirrors are last.
+        """
+        if not result['healthy']:
+            return float('inf')
+
+        return result['latency'] + 1024 * 1024 / max(result['throughput'], 1)
+
+    @classmethod
+    def get_ranked_urls(cls, repo_info):
+        """
+        :return: The URLs of the healthy mirrors, best first, followed by the
+          rest of the mirrors as a last resort.
+        """
+        urls = cls.get_mirror_urls(repo_info)
+        if len(urls) == 1:
+            return urls
+
+        results = cls.rank(repo_info)
+        healthy = [result['url'] for result in results if result['healthy']]
+
+        return healthy + [url for url in urls if url not in healthy]
+
+    @classmethod
+    def mark_unhealthy(cls, repo_info, urls):
+        """
+        Demote mirrors that failed during a download, until probed again.
+        """
+        rankings = cls.load_rankings()
+        if repo_info['id'] not in rankings:
+            return
+
+        with cls.lock:
+            for result in rankings[repo_info['id']]['mirrors']:
+                if result['url'] in urls:
+                    result['healthy'] = False
+            rankings[repo_info['id']]['mirrors'].sort(key=cls.get_score)
+            cls.save_rankings()
+
+    @classmethod
+    def download(cls, repo_info, relative_path, file_path, hash_type='sha256', expected_hash=None, segments=1):
+        """
+        Download a repository file from the fastest healthy mirrors.
+        :param repo_info: The repository settings.
+        :param relative_path: The path of the file, relative to the repository.
+        :param file_path: Where to save the downloaded file.
+        :return: The hash of the downloaded file.
+        :raise DownloadError: If the file could not be downloaded from any mirror.
+        """
+        urls = cls.get_ranked_urls(repo_info)
+
+        # Spread consecutive downloads across the fastest healthy mirrors.
+        with cls.lock:
+            offset = cls.__downloads_count % min(cls.spread, len(urls))
+            cls.__downloads_count += 1
+        urls = urls[offset:] + urls[:offset]
+
+        downloader = MiaDownloader(
+            ['%s/%s' % (url, relative_path) for url in urls],
+            file_path, segments, hash_type
+        )
+
+        try:
+            return downloader.download(expected_hash, False)
+        except DownloadNotFoundError:
+            # The file is missing from the repository, not a mirror failure.
+            downloader.failed_urls.clear()
+            raise
+        finally:
+            if downloader.failed_urls and len(urls) > 1:
+                cls.mark_unhealthy(repo_info, [
+                    url for url in urls if '%s/%s' % (url, relative_path) in downloader.failed_urls
+                ])
+
+    @classmethod
+    def reset(cls):
+        cls.__rankings = None
+        cls.__downloads_count = 0
@@ -0,0 +1,298 @@
+"""
+Portable packs of the workspace caches, eg: to build on air-gapped hosts.
+
+A pack is a single file with a header, the raw content of the cached files and
+a table of contents, with the path, size, modification time and sha256 hash of
+each entry. The packs are read through memory-mapping, so the entries can be
+verified and extracted in parallel. Packs can also be mounted in a workspace,
+the commands then extract the missing artifacts from them when first needed.
+
+The entries of a pack must be files of the workspace resources folder, as
+listed when exporting: the packs might come from another host.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from mia.cache import MiaCache
+from mia.handler import MiaHandler
+
+
+class MiaPackError(Exception):
+    pass
+
+
+class MiaPack(object):
+    magic = b'MIAPACK\n'
+    format_version = 1
+
+    # The magic, the format version, the offset, size and sha256 hash of the
+    # table of contents.
+    header = struct.Struct('<8sIQQ32s')
+
+    chunk_size = 1024 * 1024
+
+    # The temporary, partial or generated files, not worth packing.
+    excluded_suffixes = ('.part', '.part.json', '.tmp', '.search')
+
+    # Maps the mounted pack paths to the opened packs.
+    __mounted = {}
+    lock = threading.Lock()
+
+    def __init__(self, pack_path):
+        """
+        Open a pack, checking it's table of contents.
+        :raise MiaPackError: If the file is not a valid pack.
+        """
+        self.path = os.path.abspath(pack_path)
+        self.fd = open(self.path, 'rb')
+
+        try:
+            magic, version, toc_offset, toc_size, toc_hash = self.header.unpack(self.fd.read(self.header.size))
+        except struct.error:
+            raise MiaPackError('Not a mia pack: %s' % self.path)
+
+        if magic != self.magic:
+            raise MiaPackError('Not a mia pack: %s' % self.path)
+        if version != self.format_version:
+            raise MiaPackError('Unsupported pack version %d: %s' % (version, self.path))
+
+        self.map = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        toc_data = self.map[toc_offset:toc_offset + toc_size]
+        if hashlib.sha256(toc_data).digest() != toc_hash:
+            raise MiaPackError('Corrupted pack table of contents: %s' % self.path)
+
+        self.toc = json.loads(toc_data.decode('utf-8'))
+        for entry in self.toc['entries']:
+            if not self.is_valid_path(entry['path']):
+                raise MiaPackError('Invalid pack entry %s: %s' % (entry['path'], self.path))
+        self.entries = dict((entry['path'], entry) for entry in self.toc['entries'])
+
+    def close(self):
+        self.map.close()
+        self.fd.close()
+
+    def read(self, entry):
+        """
+        :return: The content of an entry, mapped from the pack without copy.
+        """
+        return memoryview(self.map)[entry['offset']:entry['offset'] + entry['size']]
+
+    def verify(self, entry):
+        """
+        :raise MiaPackError: If the content of the entry is corrupted.
+        """
+        # NOTE: hashlib releases the GIL, the entries can be verified in parallel.
+        if hashlib.sha256(self.read(entry)).hexdigest() != entry['sha256']:
+            raise MiaPackError('Corrupted pack entry: %s' % entry['path'])
+
+    def extract(self, entry, destination):
+        """
+        Write the content of an entry to a file, atomically.
+        """
+        if not os.path.isdir(os.path.dirname(destination)):
+            try:
+                os.makedirs(os.path.dirname(destination), mode=0o755)
+            except OSError:
+                # Created by a concurrent extraction.
+                if not os.path.isdir(os.path.dirname(destination)):
+                    raise
+
+        temp_path = '%s.%d.tmp' % (destination, threading.current_thread().ident)
+        with open(temp_path, 'wb') as fd:
+            fd.write(self.read(entry))
+        os.utime(temp_path, (time.time(), entry['mtime']))
+        os.rename(temp_path, destination)
+
+    @classmethod
+    def is_valid_path(cls, relative_path):
+        """
+        :return: Whether a relative path is one of the packed files, as listed
+          by get_workspace_files.
+        """
+        if not isinstance(relative_path, type(u'')):
+            return False
+
+        parts = relative_path.split('/')
+        if len(parts) < 2 or parts[0] != 'resources' or '\\' in relative_path or ':' in relative_path:
+            return False
+        if any(part in ('', '.', '..') for part in parts):
+            return False
+        if len(parts) == 2 and parts[1] in MiaCache.metadata_files:
+            return False
+
+        return not relative_path.endswith(cls.excluded_suffixes)
+
+    @classmethod
+    def get_file_path(cls, relative_path):
+        """
+        :return: The workspace path of a packed file.
+        :raise MiaPackError: If the path is not inside the resources folder,
+          eg: through a symbolic link.
+        """
+        if not cls.is_valid_path(relative_path):
+            raise MiaPackError('Invalid pack entry: %s' % relative_path)
+
+        workspace_path = MiaHandler.get_workspace_path()
+        resources_path = os.path.realpath(os.path.join(workspace_path, 'resources'))
+        file_path = os.path.join(workspace_path, *relative_path.split('/'))
+        if not os.path.realpath(file_path).startswith(resources_path + os.sep):
+            raise MiaPackError('Invalid pack entry: %s' % relative_path)
+
+        return file_path
+
+    @classmethod
+    def get_workspace_files(cls):
+        """
+        :return: The workspace relative paths of the cached files to pack.
+        """
+        workspace_path = MiaHandler.get_workspace_path()
+        resources_path = os.path.join(workspace_path, 'resources')
+
+        relative_paths = []
+        for path, directories, files in os.walk(resources_path):
+            directories.sort()
+            for file_name in sorted(files):
+                if path == resources_path and file_name in MiaCache.metadata_files:
+                    continue
+                if file_name.endswith(cls.excluded_suffixes):
+                    continue
+
+                relative_path = os.path.relpath(os.path.join(path, file_name), workspace_path)
+                relative_paths.append(relative_path.replace(os.sep, '/'))
+
+        return relative_paths
+
+    @classmethod
+    def create(cls, pack_path, relative_paths, callback=None):
+        """
+        Pack workspace files, hashing them while they are copied.
+        :param callback: Called with each packed entry.
+        :return: The table of contents.
+        """
+        workspace_path = MiaHandler.get_workspace_path()
+        toc = {'created': time.time(), 'entries': []}
+
+        temp_path = pack_path + '.tmp'
+        with open(temp_path, 'wb') as pack:
+            # The header is written once the table of contents is known.
+            pack.write(b'\0' * cls.header.size)
+
+            for relative_path in relative_paths:
+                file_path = os.path.join(workspace_path, relative_path)
+                entry = {
+                    'path': relative_path,
+                    'offset': pack.tell(),
+                    'mtime': os.path.getmtime(file_path),
+                }
+
+                file_hash = hashlib.sha256()
+                with open(file_path, 'rb') as fd:
+                    for chunk in iter(lambda: fd.read(cls.chunk_size), b''):
+                        file_hash.update(chunk)
+                        pack.write(chunk)
+
+                entry['size'] = pack.tell() - entry['offset']
+                entry['sha256'] = file_hash.hexdigest()
+                toc['entries'].append(entry)
+                if callback is not None:
+                    callback(entry)
+
+            toc_data = json.dumps(toc, sort_keys=True).encode('utf-8')
+            toc_offset = pack.tell()
+            pack.write(toc_data)
+
+            pack.seek(0)
+            pack.write(cls.header.pack(
+                cls.magic, cls.format_version, toc_offset, len(toc_data), hashlib.sha256(toc_data).digest()
+            ))
+
+        os.rename(temp_path, pack_path)
+
+        return toc
+
+    @staticmethod
+    def get_mounts_file_path():
+        return os.path.join(MiaHandler.get_workspace_path(), 'resources', 'packs.json')
+
+    @classmethod
+    def get_mounted_paths(cls):
+        file_path = cls.get_mounts_file_path()
+        if not os.path.isfile(file_path):
+            return []
+
+        try:
+            with open(file_path, 'r') as fd:
+                return json.load(fd)
+        except ValueError:
+            return []
+
+    @classmethod
+    def mount(cls, pack_path):
+        """
+        Use a pack as a source of the missing workspace cached files.
+        """
+        pack_paths = [path for path in cls.get_mounted_paths() if path != os.path.abspath(pack_path)]
+        pack_paths.insert(0, os.path.abspath(pack_path))
+
+        file_path = cls.get_mounts_file_path()
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path), mode=0o755)
+
+        with open(file_path, 'w') as fd:
+            json.dump(pack_paths, fd, indent=0)
+
+    @classmethod
+    def find(cls, file_path):
+        """
+        Find a workspace file in the mounted packs.
+        :return: A (pack, entry) tuple, or None if not found.
+        """
+        relative_path = os.path.relpath(file_path, MiaHandler.get_workspace_path()).replace(os.sep, '/')
+
+        for pack_path in cls.get_mounted_paths():
+            with cls.lock:
+                pack = cls.__mounted.get(pack_path)
+                if pack is None:
+                    # The packs may be on removable media.
+                    if not os.path.isfile(pack_path):
+                        continue
+
+                    try:
+                        pack = cls.__mounted[pack_path] = MiaPack(pack_path)
+                    except MiaPackError as e:
+                        print('WARNING: %s' % e)
+                        continue
+
+            if relative_path in pack.entries:
+                return pack, pack.entries[relative_path]
+
+        return None
+
+    @classmethod
+    def extract_resource(cls, file_path):
+        """
+        Extract a missing workspace file from the mounted packs.
+        :return: Whether the file was found and extracted.
+        """
+        found = cls.find(file_path)
+        if found is None:
+            return False
+
+        pack, entry = found
+        try:
+            file_path = cls.get_file_path(entry['path'])
+            pack.verify(entry)
+        except MiaPackError as e:
+            print('WARNING: %s' % e)
+            return False
+
+        pack.extract(entry, file_path)
+        print('Extracted from the cache pack:\n - %s' % entry['path'])
+
+        return True
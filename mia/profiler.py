@@ -0,0 +1,214 @@
+"""
+Lightweight timing instrumentation for the mia script.
+
+Usage:
+    with MiaProfiler.span('index parse'):
+        ...
+
+Spans with the same name and parent are aggregated into a single node of the
+timing tree, so a span opened once for each downloaded APK shows up as one
+phase with a call count and the total, minimum and maximum durations.
+"""
+
+import json
+import threading
+import time
+
+
+class MiaProfilerNode(object):
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.children = []
+        self.calls = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.counters = {}
+        self.__children_index = {}
+
+    def get_child(self, name):
+        child = self.__children_index.get(name)
+        if child is None:
+            child = MiaProfilerNode(name, self)
+            self.__children_index[name] = child
+            self.children.append(child)
+
+        return child
+
+    def get_path(self):
+        if self.parent is None:
+            return ''
+
+        parent_path = self.parent.get_path()
+        if not parent_path:
+            return self.name
+
+        return '/'.join((parent_path, self.name))
+
+    def add_duration(self, duration):
+        self.calls += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+
+    def add(self, counter, value):
+        """
+        Increment a counter of the node, eg: the number of transferred bytes.
+        """
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'path': self.get_path(),
+            'calls': self.calls,
+            'total': round(self.total, 6),
+            'min': round(self.min or 0.0, 6),
+            'max': round(self.max or 0.0, 6),
+            'counters': dict(self.counters),
+            'children': [child.to_dict() for child in self.children],
+        }
+
+
+class MiaProfilerSpan(object):
+    def __init__(self, name):
+        self.name = name
+        self.node = None
+        self.start_time = None
+
+    def __enter__(self):
+        stack = MiaProfiler.get_stack()
+
+        with MiaProfiler.lock:
+            self.node = stack[-1].get_child(self.name)
+
+        stack.append(self.node)
+        self.start_time = time.time()
+
+        return self.node
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self.start_time
+        MiaProfiler.get_stack().pop()
+
+        with MiaProfiler.lock:
+            self.node.add_duration(duration)
+
+        return False
+
+
+class MiaProfilerNullSpan(object):
+    """
+    Used when the profiler is disabled, to keep the overhead to a minimum.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add(self, counter, value):
+        pass
+
+
+class MiaProfiler(object):
+    enabled = False
+    lock = threading.Lock()
+    __root = MiaProfilerNode('mia')
+    __local = threading.local()
+    __null_span = MiaProfilerNullSpan()
+    __start_time = None
+
+    @classmethod
+    def enable(cls):
+        cls.enabled = True
+        cls.__root = MiaProfilerNode('mia')
+        cls.__local = threading.local()
+        cls.__start_time = time.time()
+
+    @classmethod
+    def disable(cls):
+        cls.enabled = False
+
+    @classmethod
+    def span(cls, name):
+        """
+        Create a context manager measuring the time spent in a phase.
+        :param name: The name of the phase.
+        :return: A context manager, returning the timing tree node on enter.
+        """
+        if not cls.enabled:
+            return cls.__null_span
+
+        return MiaProfilerSpan(name)
+
+    @classmethod
+    def get_stack(cls):
+        # Each thread has it's own stack, the spans of worker threads are
+        # attached directly to the root node.
+        if not hasattr(cls.__local, 'stack'):
+            cls.__local.stack = [cls.__root]
+
+        return cls.__local.stack
+
+    @classmethod
+    def get_root(cls):
+        if cls.__start_time is not None:
+            cls.__root.calls = 1
+            cls.__root.total = time.time() - cls.__start_time
+
+        return cls.__root
+
+    @classmethod
+    def print_tree(cls):
+        root = cls.get_root()
+
+        print('\nTiming tree:')
+        print('  {:>10} {:>7} {:>10}  {}'.format('total', 'calls', 'max', 'phase'))
+        cls._print_node(root, 0)
+
+    @classmethod
+    def _print_node(cls, node, depth):
+        counters = ''
+        if node.counters:
+            counters = '  ({})'.format(', '.join(
+                '{}: {}'.format(key, node.counters[key]) for key in sorted(node.counters)
+            ))
+
+        print('  {:>9.3f}s {:>7} {:>9.3f}s  {}{}{}'.format(
+            node.total, node.calls, node.max or node.total, '  ' * depth, node.name, counters
+        ))
+
+        for child in node.children:
+            cls._print_node(child, depth + 1)
+
+    @classmethod
+    def save_metrics(cls, file_path, extra_data=None):
+        """
+        Save the timing tree as JSON, along with a flat list of the phases.
+        """
+        root = cls.get_root()
+
+        phases = []
+        nodes = list(root.children)
+        while nodes:
+            node = nodes.pop(0)
+            phase = node.to_dict()
+            del phase['children']
+            phases.append(phase)
+            nodes.extend(node.children)
+
+        metrics = {
+            'timestamp': int(cls.__start_time or time.time()),
+            'total': round(root.total, 6),
+            'phases': phases,
+            'tree': root.to_dict(),
+        }
+        if extra_data:
+            metrics.update(extra_data)
+
+        with open(file_path, 'w') as fd:
+            json.dump(metrics, fd, indent=2, sort_keys=True)
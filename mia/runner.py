@@ -0,0 +1,180 @@
+"""
+Central runner for the external commands (wget, adb) used by the mia script.
+
+Every call is traced: the arguments, the duration, the exit code and the size
+of the output are recorded, and a summary table can be displayed at exit.
+"""
+
+import subprocess
+import threading
+import time
+
+
+class CommandTimeoutError(Exception):
+    def __init__(self, argv, timeout):
+        self.argv = argv
+        self.timeout = timeout
+        msg = 'Command timed out after {}s: {}'.format(timeout, ' '.join(argv))
+        super(CommandTimeoutError, self).__init__(msg)
+
+
+class MiaRunnerRecord(object):
+    def __init__(self, argv):
+        self.argv = list(argv)
+        self.duration = 0.0
+        self.returncode = None
+        self.output_bytes = 0
+        self.timed_out = False
+
+    def get_name(self):
+        """
+        A short name for the command, eg: `adb push` or `wget`.
+        """
+        name = [self.argv[0]]
+        for argument in self.argv[1:]:
+            if not argument.startswith('-'):
+                if self.argv[0] == 'adb':
+                    name.append(argument)
+                break
+
+        return ' '.join(name)
+
+    def to_dict(self):
+        return {
+            'argv': self.argv,
+            'duration': round(self.duration, 6),
+            'returncode': self.returncode,
+            'output_bytes': self.output_bytes,
+            'timed_out': self.timed_out,
+        }
+
+
+class MiaRunner(object):
+    # The default timeout, in seconds, for all commands; None disables it.
+    timeout = None
+    records = []
+    lock = threading.Lock()
+
+    @classmethod
+    def run(cls, argv, capture=True, timeout=None):
+        """
+        Run an external command and wait for it to finish.
+        :param argv: The command and it's arguments.
+        :param capture: Capture the output instead of displaying it.
+        :param timeout: Timeout in seconds, the default timeout is used if None.
+        :return: A (returncode, stdout, stderr) tuple, the output is None if
+          it was not captured.
+        :raise CommandTimeoutError: If the command did not finish in time.
+        """
+        if timeout is None:
+            timeout = cls.timeout
+
+        record = MiaRunnerRecord(argv)
+        start_time = time.time()
+
+        if capture:
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        else:
+            proc = subprocess.Popen(argv)
+
+        # NOTE: Popen.communicate() only accepts a timeout in Python 3, so kill
+        # the process from a timer thread, which works in Python 2 as well.
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, cls._kill, (proc, record))
+            timer.start()
+
+        try:
+            stdout, stderr = proc.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+            record.duration = time.time() - start_time
+            record.returncode = proc.returncode
+            record.output_bytes = len(stdout or b'') + len(stderr or b'') if capture else 0
+
+            with cls.lock:
+                cls.records.append(record)
+
+        if record.timed_out:
+            raise CommandTimeoutError(argv, timeout)
+
+        return proc.returncode, stdout, stderr
+
+    @classmethod
+    def reset(cls):
+        """
+        Restore the default timeout and forget the recorded commands.
+        """
+        cls.timeout = None
+        with cls.lock:
+            cls.records = []
+
+    @classmethod
+    def call(cls, argv, timeout=None):
+        """
+        Run an external command, displaying it's output.
+        :return: The exit code of the command.
+        """
+        return cls.run(argv, False, timeout)[0]
+
+    @classmethod
+    def check_output(cls, argv, timeout=None):
+        """
+        Run an external command and return it's output.
+        :raise subprocess.CalledProcessError: If the exit code is not zero.
+        """
+        returncode, stdout, stderr = cls.run(argv, True, timeout)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, argv, stdout)
+
+        return stdout
+
+    @staticmethod
+    def _kill(proc, record):
+        record.timed_out = True
+        try:
+            proc.kill()
+        except OSError:
+            # The process has already finished.
+            pass
+
+    @classmethod
+    def print_summary(cls):
+        if not cls.records:
+            return
+
+        print('\nExternal commands:')
+        print('  {:>9} {:>5} {:>10}  {}'.format('time', 'exit', 'output', 'command'))
+        for record in cls.records:
+            command = ' '.join(record.argv)
+            if len(command) > 100:
+                command = command[:97] + '...'
+
+            print('  {:>8.3f}s {:>5} {:>10}  {}'.format(
+                record.duration,
+                'T/O' if record.timed_out else record.returncode,
+                record.output_bytes,
+                command
+            ))
+
+        # Group the calls by command name.
+        totals = {}
+        for record in cls.records:
+            total = totals.setdefault(record.get_name(), [0, 0.0, 0.0, 0])
+            total[0] += 1
+            total[1] += record.duration
+            total[2] = max(total[2], record.duration)
+            total[3] += 1 if record.returncode != 0 else 0
+
+        print('\n  {:>9} {:>5} {:>9} {:>6}  {}'.format('total', 'calls', 'max', 'failed', 'command'))
+        for name in sorted(totals, key=lambda n: totals[n][1], reverse=True):
+            calls, duration, max_duration, failures = totals[name]
+            print('  {:>8.3f}s {:>5} {:>8.3f}s {:>6}  {}'.format(
+                duration, calls, max_duration, failures, name
+            ))
+
+    @classmethod
+    def get_records(cls):
+        return [record.to_dict() for record in cls.records]
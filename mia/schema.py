@@ -0,0 +1,237 @@
+"""
+Validation of the definition settings against the schema.
+
+The schema uses a subset of the Yamale syntax, see: mia/schema.yaml
+@see https://github.com/23andMe/Yamale
+
+The schema is compiled once into a tree of validator functions, which are
+reused for every validated file. All the errors are reported at once.
+"""
+
+import ast
+import os
+import sys
+
+import yaml
+
+from mia.profiler import MiaProfiler
+
+# Use the LibYAML bindings, if available.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+if sys.version_info.major == 2:
+    string_types = (str, unicode)
+    integer_types = (int, long)
+else:
+    string_types = (str,)
+    integer_types = (int,)
+
+
+class SchemaError(Exception):
+    pass
+
+
+class MiaSchema(object):
+    # Maps schema file paths to (modification time, compiled validator) tuples.
+    __cache = {}
+
+    @staticmethod
+    def get_schema_path():
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)), 'schema.yaml')
+
+    @classmethod
+    def get_validator(cls, schema_path=None):
+        """
+        Compile the schema, or get the already compiled validator.
+        :return: A function taking the data, a path and a list to add errors to.
+        """
+        if schema_path is None:
+            schema_path = cls.get_schema_path()
+
+        mtime = os.path.getmtime(schema_path)
+        cached = cls.__cache.get(schema_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with MiaProfiler.span('schema compile'):
+            with open(schema_path, 'r') as fd:
+                documents = [document for document in yaml.load_all(fd, Loader=SafeLoader) if document]
+
+            if not documents:
+                raise SchemaError('Empty schema file: %s' % schema_path)
+
+            validator = MiaSchemaCompiler(documents[0], documents[1:]).compile()
+
+        cls.__cache[schema_path] = (mtime, validator)
+
+        return validator
+
+    @classmethod
+    def clear_cache(cls):
+        cls.__cache = {}
+
+    @classmethod
+    def validate(cls, data, schema_path=None):
+        """
+        Validate the data against the schema.
+        :return: A list of error messages, empty if the data is valid.
+        """
+        validator = cls.get_validator(schema_path)
+
+        with MiaProfiler.span('schema validation'):
+            errors = []
+            validator(data, '', errors)
+
+        return errors
+
+
+class MiaSchemaCompiler(object):
+    def __init__(self, schema, includes):
+        self.schema = schema
+        self.includes = {}
+        self.compiled_includes = {}
+
+        for include in includes:
+            self.includes.update(include)
+
+    def compile(self):
+        return self.compile_map(self.schema)
+
+    def compile_map(self, schema):
+        """
+        Compile a schema section into a validator for a dictionary.
+        """
+        fields = []
+        for key, value in schema.items():
+            if isinstance(value, dict):
+                fields.append((key, self.compile_map(value), True))
+            else:
+                validator, required = self.compile_expression(value)
+                fields.append((key, validator, required))
+
+        def validate_map(data, path, errors):
+            if not isinstance(data, dict):
+                errors.append('%s: %r is not a map.' % (path or '.', data))
+                return
+
+            for key, validator, required in fields:
+                field_path = '.'.join((path, str(key))) if path else str(key)
+                value = data.get(key)
+                if value is None:
+                    if required:
+                        errors.append('%s: Required field missing' % field_path)
+                    continue
+
+                validator(value, field_path, errors)
+
+        return validate_map
+
+    def compile_expression(self, expression):
+        """
+        Compile a validator expression, eg: `str(required=False)`.
+        :return: A (validator function, required) tuple.
+        """
+        try:
+            node = ast.parse(expression.strip(), mode='eval').body
+        except (AttributeError, SyntaxError):
+            raise SchemaError('Invalid validator: %r' % expression)
+
+        return self.compile_node(node)
+
+    def compile_node(self, node):
+        if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Name):
+            raise SchemaError('Invalid validator: %s' % ast.dump(node))
+
+        name = node.func.id
+        kwargs = dict((keyword.arg, ast.literal_eval(keyword.value)) for keyword in node.keywords)
+        required = kwargs.pop('required', True)
+
+        if name == 'str':
+            return self.make_type_validator(string_types, 'str'), required
+        elif name == 'int':
+            return self.make_type_validator(integer_types, 'int'), required
+        elif name == 'num':
+            return self.make_type_validator(integer_types + (float,), 'num'), required
+        elif name == 'bool':
+            return self.make_type_validator((bool,), 'bool'), required
+        elif name == 'map':
+            return self.make_type_validator((dict,), 'map'), required
+        elif name == 'enum':
+            return self.make_enum_validator([ast.literal_eval(arg) for arg in node.args]), required
+        elif name == 'include':
+            return self.make_include_validator(ast.literal_eval(node.args[0])), required
+        elif name == 'any':
+            return self.make_any_validator([self.compile_node(arg)[0] for arg in node.args]), required
+        elif name == 'list':
+            return self.make_list_validator([self.compile_node(arg)[0] for arg in node.args]), required
+
+        raise SchemaError('Unknown validator: %s()' % name)
+
+    @staticmethod
+    def make_type_validator(types, type_name):
+        def validate_type(data, path, errors):
+            # NOTE: bool is a subclass of int.
+            if not isinstance(data, types) or (isinstance(data, bool) and bool not in types):
+                errors.append('%s: %r is not a %s.' % (path, data, type_name))
+
+        return validate_type
+
+    @staticmethod
+    def make_enum_validator(values):
+        def validate_enum(data, path, errors):
+            if data not in values:
+                errors.append('%s: %r not in %s' % (path, data, tuple(values)))
+
+        return validate_enum
+
+    def make_include_validator(self, include_name):
+        if include_name not in self.includes:
+            raise SchemaError('Include "%s" is not defined.' % include_name)
+
+        # Compile each include once, even if it is used multiple times.
+        if include_name not in self.compiled_includes:
+            self.compiled_includes[include_name] = self.compile_map(self.includes[include_name])
+
+        return self.compiled_includes[include_name]
+
+    @staticmethod
+    def make_any_validator(validators):
+        def validate_any(data, path, errors):
+            closest_errors = None
+            for validator in validators:
+                validator_errors = []
+                validator(data, path, validator_errors)
+                if not validator_errors:
+                    return
+
+                if closest_errors is None or len(validator_errors) < len(closest_errors):
+                    closest_errors = validator_errors
+
+            # Report the errors of the closest match, they are the most useful.
+            errors.extend(closest_errors)
+
+        return validate_any
+
+    @classmethod
+    def make_list_validator(cls, validators):
+        any_validator = cls.make_any_validator(validators) if len(validators) > 1 else None
+
+        def validate_list(data, path, errors):
+            if not isinstance(data, list):
+                errors.append('%s: %r is not a list.' % (path, data))
+                return
+
+            if not validators:
+                return
+
+            for index, item in enumerate(data):
+                item_path = '%s.%d' % (path, index)
+                if any_validator is not None:
+                    any_validator(item, item_path, errors)
+                else:
+                    validators[0](item, item_path, errors)
+
+        return validate_list
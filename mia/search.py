@@ -0,0 +1,208 @@
+"""
+Search of the applications of the repository indexes.
+
+An inverted index of the id, name, summary and categories of the applications
+is built once for every version of a repository index, the index-v1.jar or the
+index.xml file used by the lock, and saved in the workspace resources folder
+next to it, eg: as `<repo id>.index-v1.jar.search`.
+"""
+
+import bisect
+import os
+import pickle
+import re
+
+from mia.fdroid import MiaFDroid
+from mia.profiler import MiaProfiler
+
+
+class MiaSearch(object):
+    # Increase when changing the format of the saved search indexes.
+    format_version = 2
+
+    # The weights of the matched fields.
+    field_weights = (('id', 4), ('name', 3), ('categories', 2), ('summary', 1))
+
+    # The weight of the terms matching only the start of a word.
+    prefix_weight = 0.5
+
+    # Maps repository ids to loaded search indexes.
+    __indexes = {}
+
+    token_pattern = re.compile(r'[a-z0-9]+')
+
+    @staticmethod
+    def get_search_index_path(index_path):
+        # NOTE: Named after the index file, to be evicted with it.
+        return index_path + '.search'
+
+    @classmethod
+    def get_version(cls, index_path):
+        stat = os.stat(index_path)
+        return (
+            cls.format_version, os.path.basename(index_path), stat.st_size, getattr(stat, 'st_mtime_ns', stat.st_mtime)
+        )
+
+    @classmethod
+    def load(cls, repo_id, build=True):
+        """
+        Load the search index of a repository, building it if outdated.
+        :param build: Whether to build missing or outdated search indexes.
+        :return: The search index, or None if not available.
+        """
+        index_path = MiaFDroid.get_index_path(repo_id)
+        if index_path is None:
+            return None
+
+        version = cls.get_version(index_path)
+        search_index = cls.__indexes.get(repo_id)
+        if search_index is not None and search_index['version'] == version:
+            return search_index
+
+        search_index_path = cls.get_search_index_path(index_path)
+        if os.path.isfile(search_index_path):
+            with MiaProfiler.span('search index load'):
+                try:
+                    with open(search_index_path, 'rb') as fd:
+                        search_index = pickle.load(fd)
+                except (EOFError, ValueError, pickle.UnpicklingError):
+                    search_index = None
+
+        if search_index is None or search_index['version'] != version:
+            if not build:
+                return None
+
+            search_index = cls.build(index_path)
+            search_index['version'] = version
+            cls.save(search_index_path, search_index)
+
+        cls.__indexes[repo_id] = search_index
+
+        return search_index
+
+    @classmethod
+    def build(cls, index_path):
+        """
+        Build the inverted index of a repository index file, an index-v1.jar
+        or an index.xml file.
+        """
+        apps = []
+        postings = {}
+
+        with MiaProfiler.span('search index build') as span:
+            span.add('bytes', os.path.getsize(index_path))
+
+            repository = MiaFDroid.load_repository(index_path)
+            for app_id in repository.get_app_ids():
+                app = repository.get_app(app_id)
+                fields = {
+                    'id': app_id or app['id'] or '',
+                    'name': app['name'] or '',
+                    'summary': app['summary'] or '',
+                    'categories': ','.join(app['categories']),
+                }
+
+                app_index = len(apps)
+                apps.append((fields['id'], fields['name'], fields['summary']))
+
+                weights = {fields['id'].lower(): cls.field_weights[0][1]}
+                for field, weight in cls.field_weights:
+                    for token in cls.tokenize(fields[field]):
+                        weights[token] = max(weights.get(token, 0), weight)
+
+                for token, weight in weights.items():
+                    postings.setdefault(token, []).append((app_index, weight))
+
+        return {
+            'apps': apps,
+            'postings': postings,
+            'tokens': sorted(postings),
+            'ids': sorted(app[0] for app in apps),
+        }
+
+    @staticmethod
+    def save(file_path, search_index):
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'wb') as fd:
+            pickle.dump(search_index, fd, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, file_path)
+
+    @classmethod
+    def tokenize(cls, text):
+        return cls.token_pattern.findall(text.lower())
+
+    @classmethod
+    def search(cls, terms, repo_ids, limit=None):
+        """
+        Search the apps matching all the terms, best match first.
+        :return: A list of (score, app id, name, summary, repository ids) tuples.
+        """
+        tokens = [token for term in terms for token in cls.tokenize(term)]
+        results = {}
+
+        for repo_id in repo_ids:
+            search_index = cls.load(repo_id)
+            if search_index is None or not tokens:
+                continue
+
+            with MiaProfiler.span('search query'):
+                scores = None
+                for token in tokens:
+                    token_scores = cls.get_token_scores(search_index, token)
+                    if scores is None:
+                        scores = token_scores
+                    else:
+                        scores = dict(
+                            (app_index, score + token_scores[app_index])
+                            for app_index, score in scores.items() if app_index in token_scores
+                        )
+
+            for app_index, score in scores.items():
+                app_id, name, summary = search_index['apps'][app_index]
+                if app_id in results:
+                    results[app_id][4].append(repo_id)
+                    continue
+                results[app_id] = (score, app_id, name, summary, [repo_id])
+
+        ranked = sorted(results.values(), key=lambda result: (-result[0], result[2].lower(), result[1]))
+
+        return ranked[:limit] if limit else ranked
+
+    @classmethod
+    def get_token_scores(cls, search_index, token):
+        """
+        :return: A dictionary mapping app indexes to the best score of a token.
+        """
+        scores = {}
+        tokens = search_index['tokens']
+        postings = search_index['postings']
+
+        # Words starting with the token, including the token itself.
+        index = bisect.bisect_left(tokens, token)
+        while index < len(tokens) and tokens[index].startswith(token):
+            factor = 1 if tokens[index] == token else cls.prefix_weight
+            for app_index, weight in postings[tokens[index]]:
+                if scores.get(app_index, 0) < weight * factor:
+                    scores[app_index] = weight * factor
+            index += 1
+
+        return scores
+
+    @classmethod
+    def complete_app_ids(cls, prefix, repo_ids, build=True):
+        """
+        :return: The sorted app ids starting with the prefix.
+        """
+        app_ids = set()
+        for repo_id in repo_ids:
+            search_index = cls.load(repo_id, build)
+            if search_index is None:
+                continue
+
+            ids = search_index['ids']
+            index = bisect.bisect_left(ids, prefix)
+            while index < len(ids) and ids[index].startswith(prefix):
+                app_ids.add(ids[index])
+                index += 1
+
+        return sorted(app_ids)
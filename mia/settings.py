@@ -0,0 +1,100 @@
+"""
+Loading and saving of the YAML settings and lock files.
+
+The LibYAML bindings are used when available. The parsed files are cached in
+memory, keyed by the file modification time and the digest of the content, so
+loading an unchanged file again does not parse it a second time.
+"""
+
+import hashlib
+import os
+import pickle
+
+import yaml
+
+from mia.profiler import MiaProfiler
+
+# Use the LibYAML bindings, if available.
+try:
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
+
+
+class MiaSettings(object):
+    # Maps file paths to (stat key, digest, pickled data) tuples.
+    __cache = {}
+
+    @classmethod
+    def load(cls, file_path):
+        """
+        Load a YAML file, using the cache if the file did not change.
+        :return: A new copy of the parsed data, safe to be modified.
+        :raise yaml.YAMLError: If the file is not valid.
+        """
+        stat_key = cls._get_stat_key(file_path)
+        cached = cls.__cache.get(file_path)
+
+        # The file did not change since it was last parsed.
+        if cached is not None and cached[0] == stat_key:
+            return pickle.loads(cached[2])
+
+        with open(file_path, 'rb') as fd:
+            content = fd.read()
+        digest = hashlib.sha1(content).hexdigest()
+
+        # The file was touched, but the content is the same.
+        if cached is not None and cached[1] == digest:
+            cls.__cache[file_path] = (stat_key, digest, cached[2])
+            return pickle.loads(cached[2])
+
+        with MiaProfiler.span('yaml parse') as span:
+            span.add('bytes', len(content))
+            data = yaml.load(content, Loader=SafeLoader)
+
+        pickled_data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        cls.__cache[file_path] = (stat_key, digest, pickled_data)
+
+        return pickle.loads(pickled_data)
+
+    @classmethod
+    def save(cls, file_path, data, order=None):
+        """
+        Save the data to a YAML file, and keep it in the cache.
+        :param file_path: The path to the YAML file.
+        :param data: The data to save.
+        :param order: An optional list with a custom order of the top level
+          entries, the entries missing from the list are saved last.
+        """
+        if order is not None:
+            order = [key for key in order if key in data]
+            order += [key for key in data if key not in order]
+            content = ''.join(cls.dump({key: data[key]}) for key in order)
+        else:
+            content = cls.dump(data)
+
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+
+        with open(file_path, 'wb') as fd:
+            fd.write(content)
+
+        # The saved data is what a new load would return, no need to parse it.
+        cls.__cache[file_path] = (
+            cls._get_stat_key(file_path),
+            hashlib.sha1(content).hexdigest(),
+            pickle.dumps(data, pickle.HIGHEST_PROTOCOL),
+        )
+
+    @staticmethod
+    def dump(data):
+        return yaml.dump(data, Dumper=SafeDumper, default_flow_style=False)
+
+    @classmethod
+    def clear_cache(cls):
+        cls.__cache = {}
+
+    @staticmethod
+    def _get_stat_key(file_path):
+        stat = os.stat(file_path)
+        return stat.st_ino, stat.st_size, getattr(stat, 'st_mtime_ns', stat.st_mtime)
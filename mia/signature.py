@@ -0,0 +1,758 @@
+"""
+Verification of the APK signatures, and of the signer certificates pinned in
+the lock files.
+
+Both the v1 (JAR signing) and the v2 (APK Signature Scheme v2) signatures are
+verified, and the SHA-256 fingerprint of the signer certificate is compared
+with the `signer` of the lock file entry. The content digests are computed
+using hashlib, the signatures themselves are verified using the
+`cryptography` package: without it the APKs are rejected, the digests and the
+certificates alone do not prove who signed an APK.
+
+The verifications run in a process pool, and their results are cached by APK
+digest in the workspace resources folder, as `apk-signatures.json`.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import dsa, ec, padding, rsa
+except ImportError:
+    # Only the digests and the certificates are checked without it, and the
+    # APKs are rejected by verify_apks().
+    x509 = None
+
+from mia.handler import MiaHandler
+from mia.profiler import MiaProfiler
+from mia.tasks import CPU_COUNT, MiaTaskError, MiaTaskGroup
+from mia.utils import MiaUtils
+
+
+class MiaSignatureError(Exception):
+    pass
+
+
+def verify_apk(apk_path):
+    """
+    Verify an APK, in a process of the pool.
+    """
+    return MiaSignature.verify(apk_path)
+
+
+class MiaSignature(object):
+    # Increase when changing the verification results.
+    format_version = 2
+
+    # The APK Signing Block, before the zip central directory.
+    signing_block_magic = b'APK Sig Block 42'
+    v2_block_id = 0x7109871a
+
+    chunk_size = 1024 * 1024
+
+    # The APK Signature Scheme v2 algorithms: (digest, key type, PSS padding).
+    v2_algorithms = {
+        0x0101: ('sha256', 'rsa', True),
+        0x0102: ('sha512', 'rsa', True),
+        0x0103: ('sha256', 'rsa', False),
+        0x0104: ('sha512', 'rsa', False),
+        0x0201: ('sha256', 'ec', False),
+        0x0202: ('sha512', 'ec', False),
+        0x0301: ('sha256', 'dsa', False),
+    }
+
+    digest_oids = {
+        '1.3.14.3.2.26': 'sha1',
+        '2.16.840.1.101.3.4.2.1': 'sha256',
+        '2.16.840.1.101.3.4.2.2': 'sha384',
+        '2.16.840.1.101.3.4.2.3': 'sha512',
+    }
+    message_digest_oid = '1.2.840.113549.1.9.4'
+
+    # The v1 signature files, eg: META-INF/CERT.RSA.
+    signature_block_pattern = re.compile(r'^META-INF/[^/]+\.(RSA|DSA|EC)$')
+    # The v1 files which are not signed.
+    unsigned_pattern = re.compile(r'^META-INF/([^/]+\.(SF|RSA|DSA|EC)|MANIFEST\.MF)$')
+
+    # Maps the APK digests to the verification results.
+    __results = None
+    __pool = None
+    lock = threading.Lock()
+
+    @staticmethod
+    def is_supported():
+        """
+        :return: Whether the signatures can be verified.
+        """
+        return x509 is not None
+
+    @classmethod
+    def verify(cls, apk_path):
+        """
+        Verify the v1 and v2 signatures of an APK.
+        :return: A dictionary with the verified schemes, the SHA-256
+          fingerprint of the signer certificates, whether the signatures were
+          verified and the verification time.
+        :raise MiaSignatureError: If the APK is not signed, or a signature is
+          not valid.
+        """
+        start_time = time.time()
+        with open(apk_path, 'rb') as fd:
+            data = fd.read()
+
+        try:
+            v2_certificates = cls.verify_v2(data)
+        except struct.error:
+            raise MiaSignatureError('Corrupted APK Signing Block')
+
+        try:
+            zf = zipfile.ZipFile(apk_path, mode='r')
+        except zipfile.BadZipfile as e:
+            raise MiaSignatureError('Not a valid APK: %s' % e)
+        try:
+            v1_certificates = cls.verify_v1(zf, v2_certificates is not None)
+        except struct.error:
+            raise MiaSignatureError('Corrupted v1 signature block')
+        finally:
+            zf.close()
+
+        schemes = []
+        signers = set()
+        for scheme, certificates in (('v1', v1_certificates), ('v2', v2_certificates)):
+            if certificates is not None:
+                schemes.append(scheme)
+                fingerprints = set(hashlib.sha256(certificate).hexdigest() for certificate in certificates)
+                if signers and fingerprints != signers:
+                    raise MiaSignatureError('The v1 and v2 signatures use different certificates')
+                signers = fingerprints
+
+        if not schemes:
+            raise MiaSignatureError('The APK is not signed')
+
+        return {
+            'schemes': schemes,
+            'signer': ','.join(sorted(signers)),
+            'verified': cls.is_supported(),
+            'duration': time.time() - start_time,
+        }
+
+    @classmethod
+    def verify_v2(cls, data):
+        """
+        Verify the APK Signature Scheme v2 block.
+        :return: The signer certificates, or None if not signed using v2.
+        """
+        eocd_offset, central_directory_size, central_directory_offset = cls.find_end_of_central_directory(data)
+
+        found = cls.find_v2_block(data, central_directory_offset)
+        if found is None:
+            return None
+        block, block_offset = found
+
+        signers = cls.read_sequence(cls.read_length_prefixed(block, 0)[0])
+        if not signers:
+            raise MiaSignatureError('No signers in the v2 signature')
+
+        certificates = []
+        content_digests = {}
+        for signer in signers:
+            signed_data, offset = cls.read_length_prefixed(signer, 0)
+            signatures, offset = cls.read_length_prefixed(signer, offset)
+            public_key = cls.read_length_prefixed(signer, offset)[0]
+
+            signatures = [
+                (struct.unpack_from('<I', item)[0], cls.read_length_prefixed(item, 4)[0])
+                for item in cls.read_sequence(signatures)
+            ]
+            supported = [(algorithm, signature) for algorithm, signature in signatures if algorithm in cls.v2_algorithms]
+            if not supported:
+                raise MiaSignatureError('No supported v2 signature algorithm')
+
+            # Use the strongest digest.
+            algorithm, signature = max(supported, key=lambda item: cls.v2_algorithms[item[0]][0])
+            digest_name, key_type, pss = cls.v2_algorithms[algorithm]
+            if cls.is_supported():
+                cls.verify_signature(
+                    serialization.load_der_public_key(public_key), key_type, digest_name, pss, signature, signed_data
+                )
+
+            digests, offset = cls.read_length_prefixed(signed_data, 0)
+            signer_certificates = cls.read_sequence(cls.read_length_prefixed(signed_data, offset)[0])
+            digests = dict(
+                (struct.unpack_from('<I', item)[0], cls.read_length_prefixed(item, 4)[0])
+                for item in cls.read_sequence(digests)
+            )
+            if set(digests) != set(algorithm for algorithm, signature in signatures):
+                raise MiaSignatureError('The v2 signature and digest algorithms do not match')
+            if not signer_certificates:
+                raise MiaSignatureError('No certificate in the v2 signature')
+            if cls.get_certificate_fields(signer_certificates[0])['public_key'] != public_key:
+                raise MiaSignatureError('The v2 public key does not match the certificate')
+
+            if digest_name not in content_digests:
+                content_digests[digest_name] = cls.get_content_digest(
+                    data, block_offset, central_directory_offset, central_directory_size, eocd_offset, digest_name
+                )
+            if content_digests[digest_name] != digests[algorithm]:
+                raise MiaSignatureError('The APK content does not match the v2 signature')
+
+            certificates.append(signer_certificates[0])
+
+        return certificates
+
+    @staticmethod
+    def find_end_of_central_directory(data):
+        """
+        :return: The offset of the end of central directory record, the size
+          and the offset of the central directory.
+        """
+        # The record is followed by a comment of up to 65535 bytes.
+        offset = data.rfind(b'PK\x05\x06', max(0, len(data) - 65557))
+        while offset >= 0:
+            if struct.unpack_from('<H', data, offset + 20)[0] == len(data) - offset - 22:
+                size, central_directory_offset = struct.unpack_from('<II', data, offset + 12)
+                return offset, size, central_directory_offset
+            offset = data.rfind(b'PK\x05\x06', max(0, len(data) - 65557), offset)
+
+        raise MiaSignatureError('Not a valid APK: missing the zip central directory')
+
+    @classmethod
+    def find_v2_block(cls, data, central_directory_offset):
+        """
+        :return: A (v2 signature block, APK Signing Block offset) tuple, or
+          None if not found.
+        """
+        if central_directory_offset < 32:
+            return None
+        if data[central_directory_offset - 16:central_directory_offset] != cls.signing_block_magic:
+            return None
+
+        block_size = struct.unpack_from('<Q', data, central_directory_offset - 24)[0]
+        block_offset = central_directory_offset - block_size - 8
+        if block_offset < 0 or struct.unpack_from('<Q', data, block_offset)[0] != block_size:
+            raise MiaSignatureError('Corrupted APK Signing Block')
+
+        # The ID-value pairs, prefixed by their 64 bits length.
+        offset = block_offset + 8
+        while offset < central_directory_offset - 24:
+            pair_size, block_id = struct.unpack_from('<QI', data, offset)
+            if block_id == cls.v2_block_id:
+                return data[offset + 12:offset + 8 + pair_size], block_offset
+            offset += 8 + pair_size
+
+        return None
+
+    @staticmethod
+    def read_length_prefixed(data, offset):
+        """
+        :return: A (value, next offset) tuple.
+        """
+        if offset + 4 > len(data):
+            raise MiaSignatureError('Corrupted APK Signing Block')
+
+        size = struct.unpack_from('<I', data, offset)[0]
+        if offset + 4 + size > len(data):
+            raise MiaSignatureError('Corrupted APK Signing Block')
+
+        return data[offset + 4:offset + 4 + size], offset + 4 + size
+
+    @classmethod
+    def read_sequence(cls, data):
+        items = []
+        offset = 0
+        while offset < len(data):
+            item, offset = cls.read_length_prefixed(data, offset)
+            items.append(item)
+
+        return items
+
+    @classmethod
+    def get_content_digest(cls, data, block_offset, central_directory_offset, central_directory_size,
+                           eocd_offset, digest_name):
+        """
+        Compute the v2 digest of the zip entries, central directory and end
+        of central directory record, by chunks of 1 MB.
+        """
+        # The end of central directory is digested as if the APK Signing Block
+        # was not there.
+        eocd = bytearray(data[eocd_offset:])
+        struct.pack_into('<I', eocd, 16, block_offset)
+
+        view = memoryview(data)
+        sections = [
+            view[:block_offset],
+            view[central_directory_offset:central_directory_offset + central_directory_size],
+            memoryview(bytes(eocd)),
+        ]
+
+        chunk_digests = []
+        for section in sections:
+            for offset in range(0, len(section), cls.chunk_size):
+                chunk = section[offset:offset + cls.chunk_size]
+                chunk_hash = hashlib.new(digest_name, b'\xa5' + struct.pack('<I', len(chunk)))
+                chunk_hash.update(chunk)
+                chunk_digests.append(chunk_hash.digest())
+
+        return hashlib.new(
+            digest_name, b'\x5a' + struct.pack('<I', len(chunk_digests)) + b''.join(chunk_digests)
+        ).digest()
+
+    @classmethod
+    def verify_v1(cls, zf, v2_signed):
+        """
+        Verify the JAR signature, and the digests of all the signed entries.
+        :return: The signer certificates, or None if not signed using v1.
+        """
+        names = zf.namelist()
+        blocks = [name for name in names if cls.signature_block_pattern.match(name)]
+        if 'META-INF/MANIFEST.MF' not in names or not blocks:
+            return None
+
+        manifest = zf.read('META-INF/MANIFEST.MF')
+        main_section, sections = cls.parse_manifest(manifest)
+
+        certificates = []
+        for block_name in blocks:
+            signature_file_name = block_name.rsplit('.', 1)[0] + '.SF'
+            try:
+                signature_file = zf.read(signature_file_name)
+            except KeyError:
+                raise MiaSignatureError('Missing the v1 signature file %s' % signature_file_name)
+
+            certificates.append(cls.verify_pkcs7(zf.read(block_name), signature_file))
+
+            signature_main_section, signature_sections = cls.parse_manifest(signature_file)
+            signature_attributes = signature_main_section[0]
+
+            # Refuse the APKs whose v2 signature was stripped.
+            if not v2_signed and '2' in signature_attributes.get('x-android-apk-signed', '').split(','):
+                raise MiaSignatureError('The v2 signature was removed from the APK')
+
+            if cls.is_digest_valid(signature_attributes, '-digest-manifest', manifest):
+                continue
+
+            # Otherwise, like jarsigner and apksigner, every section of the
+            # manifest must be signed, the unsigned sections can not be trusted.
+            suffix = '-digest-manifest-main-attributes'
+            if any(name.endswith(suffix) for name in signature_attributes) \
+                    and not cls.is_digest_valid(signature_attributes, suffix, main_section[1]):
+                raise MiaSignatureError('The v1 signature does not match the manifest main attributes')
+
+            for name in sections:
+                if name not in signature_sections:
+                    raise MiaSignatureError('The manifest entry %s is not in the v1 signature' % name)
+
+            for name, (attributes, raw) in signature_sections.items():
+                if name not in sections or not cls.is_digest_valid(attributes, '-digest', sections[name][1]):
+                    raise MiaSignatureError('The v1 signature does not match the manifest entry %s' % name)
+
+        # Every file of the APK must be signed.
+        for info in zf.infolist():
+            if info.filename.endswith('/') or cls.unsigned_pattern.match(info.filename):
+                continue
+
+            if info.filename not in sections:
+                raise MiaSignatureError('The file %s is not signed' % info.filename)
+
+            if not cls.is_digest_valid(sections[info.filename][0], '-digest', zf.read(info.filename)):
+                raise MiaSignatureError('The file %s does not match the v1 signature' % info.filename)
+
+        return certificates
+
+    @staticmethod
+    def parse_manifest(data):
+        """
+        Parse a JAR manifest or signature file.
+        :return: A (main section, sections) tuple, the main section is an
+          (attributes, raw section) tuple and the sections map the entry
+          names to (attributes, raw section) tuples. The attribute names are
+          lowercase.
+        """
+        raw_sections = []
+        raw = b''
+        for line in data.splitlines(True):
+            raw += line
+            if not line.strip():
+                raw_sections.append(raw)
+                raw = b''
+        if raw:
+            raw_sections.append(raw)
+
+        parsed = []
+        for raw in raw_sections:
+            attributes = {}
+            name = None
+            for line in raw.splitlines():
+                if line.startswith(b' ') and name is not None:
+                    # The long lines are split at 72 bytes.
+                    attributes[name] += line[1:].decode('utf-8')
+                elif b':' in line:
+                    name, value = line.split(b':', 1)
+                    name = name.decode('utf-8').lower()
+                    attributes[name] = value[1:].decode('utf-8') if value.startswith(b' ') else value.decode('utf-8')
+            parsed.append((attributes, raw))
+
+        if not parsed:
+            raise MiaSignatureError('Empty JAR manifest')
+
+        sections = dict(
+            (attributes['name'], (attributes, raw)) for attributes, raw in parsed[1:] if 'name' in attributes
+        )
+
+        return parsed[0], sections
+
+    @staticmethod
+    def is_digest_valid(attributes, suffix, content):
+        """
+        :return: Whether the content matches a digest attribute, eg:
+          SHA-256-Digest, using the strongest of the known digests.
+        """
+        digests = {}
+        for name, value in attributes.items():
+            if name.endswith(suffix):
+                digest_name = name[:-len(suffix)].replace('-', '')
+                if digest_name in ('sha1', 'sha256', 'sha384', 'sha512'):
+                    digests[digest_name] = value
+
+        if not digests:
+            return False
+
+        digest_name = max(digests, key=lambda name: (len(name), name))
+        return base64.b64decode(digests[digest_name]) == hashlib.new(digest_name, content).digest()
+
+    @classmethod
+    def verify_pkcs7(cls, block, signed_content):
+        """
+        Verify the PKCS#7 signature of a v1 signature file.
+        :return: The signer certificate.
+        """
+        try:
+            content_info = cls.get_der_children(block, *cls.read_der(block, 0)[1:])
+            signed_data = cls.read_der(block, content_info[1][2])
+            fields = cls.get_der_children(block, *signed_data[1:])
+
+            certificates = []
+            if fields[3][0] == 0xa0:
+                certificates = [block[start:end] for tag, start, content_start, end in cls.get_der_children(
+                    block, fields[3][2], fields[3][3]
+                )]
+
+            signer_infos = cls.get_der_children(block, fields[-1][2], fields[-1][3])
+            signer_info = cls.get_der_children(block, signer_infos[0][2], signer_infos[0][3])
+
+            issuer_and_serial = cls.get_der_children(block, signer_info[1][2], signer_info[1][3])
+            issuer = block[issuer_and_serial[0][1]:issuer_and_serial[0][3]]
+            serial = block[issuer_and_serial[1][2]:issuer_and_serial[1][3]]
+
+            digest_algorithm = cls.get_der_children(block, signer_info[2][2], signer_info[2][3])
+            digest_name = cls.digest_oids.get(cls.parse_oid(block[digest_algorithm[0][2]:digest_algorithm[0][3]]))
+
+            signed_attributes = None
+            if signer_info[3][0] == 0xa0:
+                signed_attributes = signer_info[3]
+            signature = block[signer_info[-1][2]:signer_info[-1][3]]
+            if signer_info[-1][0] != 0x04:
+                # Skip the unsigned attributes.
+                signature = block[signer_info[-2][2]:signer_info[-2][3]]
+        except (IndexError, struct.error):
+            raise MiaSignatureError('Corrupted v1 signature block')
+
+        if digest_name is None:
+            raise MiaSignatureError('Unsupported v1 digest algorithm')
+
+        certificate = None
+        for candidate in certificates:
+            candidate_fields = cls.get_certificate_fields(candidate)
+            if candidate_fields['serial'] == serial and candidate_fields['issuer'] == issuer:
+                certificate = candidate
+        if certificate is None:
+            raise MiaSignatureError('Missing the v1 signer certificate')
+
+        # The signature is computed over the signed attributes, which include
+        # the digest of the signature file.
+        content = signed_content
+        if signed_attributes is not None:
+            content = b'\x31' + block[signed_attributes[1] + 1:signed_attributes[3]]
+
+            message_digest = None
+            for tag, start, content_start, end in cls.get_der_children(block, signed_attributes[2], signed_attributes[3]):
+                attribute = cls.get_der_children(block, content_start, end)
+                if cls.parse_oid(block[attribute[0][2]:attribute[0][3]]) == cls.message_digest_oid:
+                    value = cls.get_der_children(block, attribute[1][2], attribute[1][3])[0]
+                    message_digest = block[value[2]:value[3]]
+
+            if message_digest != hashlib.new(digest_name, signed_content).digest():
+                raise MiaSignatureError('The v1 signature file does not match the signature block')
+
+        if cls.is_supported():
+            public_key = x509.load_der_x509_certificate(certificate).public_key()
+            key_type = 'rsa'
+            if isinstance(public_key, ec.EllipticCurvePublicKey):
+                key_type = 'ec'
+            elif isinstance(public_key, dsa.DSAPublicKey):
+                key_type = 'dsa'
+            cls.verify_signature(public_key, key_type, digest_name, False, signature, content)
+
+        return certificate
+
+    @staticmethod
+    def verify_signature(public_key, key_type, digest_name, pss, signature, data):
+        """
+        :raise MiaSignatureError: If the signature is not valid.
+        """
+        digest = getattr(hashes, digest_name.upper())()
+        try:
+            if key_type == 'rsa' and isinstance(public_key, rsa.RSAPublicKey):
+                if pss:
+                    signature_padding = padding.PSS(padding.MGF1(digest), digest.digest_size)
+                else:
+                    signature_padding = padding.PKCS1v15()
+                public_key.verify(signature, data, signature_padding, digest)
+            elif key_type == 'ec' and isinstance(public_key, ec.EllipticCurvePublicKey):
+                public_key.verify(signature, data, ec.ECDSA(digest))
+            elif key_type == 'dsa' and isinstance(public_key, dsa.DSAPublicKey):
+                public_key.verify(signature, data, digest)
+            else:
+                raise MiaSignatureError('The public key does not match the %s signature algorithm' % key_type)
+        except InvalidSignature:
+            raise MiaSignatureError('Invalid signature')
+
+    @staticmethod
+    def read_der(data, offset):
+        """
+        Read the header of a DER value.
+        :return: A (tag, content offset, end offset) tuple.
+        """
+        tag, length = struct.unpack_from('BB', data, offset)
+        offset += 2
+        if length & 0x80:
+            count = length & 0x7f
+            length = 0
+            for byte in struct.unpack_from('%dB' % count, data, offset):
+                length = (length << 8) | byte
+            offset += count
+
+        if offset + length > len(data):
+            raise MiaSignatureError('Corrupted DER value')
+
+        return tag, offset, offset + length
+
+    @classmethod
+    def get_der_children(cls, data, start, end):
+        """
+        :return: A list of (tag, offset, content offset, end offset) tuples.
+        """
+        children = []
+        offset = start
+        while offset < end:
+            tag, content_offset, child_end = cls.read_der(data, offset)
+            children.append((tag, offset, content_offset, child_end))
+            offset = child_end
+
+        return children
+
+    @staticmethod
+    def parse_oid(data):
+        values = struct.unpack('%dB' % len(data), data)
+        parts = [str(values[0] // 40), str(values[0] % 40)]
+        value = 0
+        for byte in values[1:]:
+            value = (value << 7) | (byte & 0x7f)
+            if not byte & 0x80:
+                parts.append(str(value))
+                value = 0
+
+        return '.'.join(parts)
+
+    @classmethod
+    def get_certificate_fields(cls, certificate):
+        """
+        :return: A dictionary with the serial number, and the DER encoded
+          issuer and public key of a X.509 certificate.
+        """
+        try:
+            tbs = cls.get_der_children(certificate, *cls.read_der(certificate, 0)[1:])[0]
+            fields = cls.get_der_children(certificate, tbs[2], tbs[3])
+            # Skip the optional version.
+            if fields[0][0] == 0xa0:
+                fields = fields[1:]
+
+            return {
+                'serial': certificate[fields[0][2]:fields[0][3]],
+                'issuer': certificate[fields[2][1]:fields[2][3]],
+                'public_key': certificate[fields[5][1]:fields[5][3]],
+            }
+        except (IndexError, struct.error):
+            raise MiaSignatureError('Corrupted certificate')
+
+    @staticmethod
+    def get_cache_file_path():
+        return os.path.join(MiaHandler.get_workspace_path(), 'resources', 'apk-signatures.json')
+
+    @classmethod
+    def load_cache(cls):
+        if cls.__results is not None:
+            return cls.__results
+
+        cls.__results = {}
+        file_path = cls.get_cache_file_path()
+        if os.path.isfile(file_path):
+            try:
+                with open(file_path, 'r') as fd:
+                    data = json.load(fd)
+                if data.get('version') == cls.format_version:
+                    cls.__results = data['apks']
+            except ValueError:
+                pass
+
+        return cls.__results
+
+    @classmethod
+    def save_cache(cls):
+        if cls.__results is None:
+            return
+
+        file_path = cls.get_cache_file_path()
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path), mode=0o755)
+
+        # Write the file atomically.
+        with cls.lock:
+            temp_path = file_path + '.tmp'
+            with open(temp_path, 'w') as fd:
+                json.dump({'version': cls.format_version, 'apks': cls.__results}, fd, indent=0, sort_keys=True)
+            os.rename(temp_path, file_path)
+
+    @classmethod
+    def clear_cache(cls):
+        cls.__results = {}
+
+    @classmethod
+    def get_pool(cls):
+        """
+        :return: The process pool, or None if not available on this system.
+        """
+        with cls.lock:
+            if cls.__pool is None:
+                try:
+                    cls.__pool = ProcessPoolExecutor(CPU_COUNT)
+                except (ImportError, NotImplementedError, OSError):
+                    # eg: Missing support for the semaphores.
+                    cls.__pool = False
+
+        return cls.__pool or None
+
+    @classmethod
+    def verify_cached(cls, apk_path):
+        """
+        Verify an APK in the process pool, unless an APK with the same digest
+        was already verified.
+        :return: A (result, cached) tuple.
+        """
+        key = 'sha256:%s' % MiaUtils.get_file_hash(apk_path, 'sha256')
+        with cls.lock:
+            result = cls.load_cache().get(key)
+
+        # Verify again when the signatures could not be verified before.
+        if result is not None and (result['verified'] or not cls.is_supported()):
+            return result, True
+
+        pool = cls.get_pool()
+        if pool is not None:
+            result = pool.submit(verify_apk, apk_path).result()
+        else:
+            result = cls.verify(apk_path)
+
+        with cls.lock:
+            cls.load_cache()[key] = result
+
+        return result, False
+
+    @classmethod
+    def verify_apks(cls, apks, pin=False):
+        """
+        Verify the signatures of APKs, and compare their signers with the
+        pinned signers of the lock file.
+        :param apks: A list of (lock entry, APK path) tuples, the missing APKs
+          are skipped.
+        :param pin: Whether to record the signers of the entries without a
+          pinned signer, in the lock entries. Only the verified signers are
+          pinned.
+        :return: A report dictionary, with the errors of each APK, including
+          the APKs whose signatures could not be verified.
+        """
+        start_time = time.time()
+        group = MiaTaskGroup(fail_fast=False)
+        entries = []
+        for apk_info, apk_path in apks:
+            if os.path.isfile(apk_path):
+                entries.append((apk_info, group.add(apk_info['package_name'], cls.verify_cached, (apk_path,), 'hash')))
+
+        with MiaProfiler.span('apk signatures'):
+            try:
+                group.run()
+            except MiaTaskError:
+                # The errors are reported with the other errors.
+                pass
+            finally:
+                cls.save_cache()
+
+        report = {
+            'count': len(entries),
+            'cached': 0,
+            'pinned': 0,
+            'cpu_time': 0.0,
+            'errors': [],
+        }
+        for apk_info, task in entries:
+            if task.state != 'done':
+                report['errors'].append((apk_info['package_name'], task.get_error_message()))
+                continue
+
+            result, cached = task.result
+            if cached:
+                report['cached'] += 1
+            else:
+                report['cpu_time'] += result['duration']
+
+            if not result['verified']:
+                # Anyone can attach the pinned certificate to a repackaged APK.
+                report['errors'].append((apk_info['package_name'], 'The signature could not be verified'))
+            elif apk_info.get('signer') and apk_info['signer'] != result['signer']:
+                report['errors'].append((apk_info['package_name'], 'Signed by %s instead of the pinned %s' % (
+                    result['signer'], apk_info['signer']
+                )))
+            elif not apk_info.get('signer') and pin:
+                apk_info['signer'] = result['signer']
+                report['pinned'] += 1
+
+        report['duration'] = time.time() - start_time
+
+        return report
+
+    @classmethod
+    def print_report(cls, report):
+        print('Verified the signatures of %d APKs in %.2fs, %d cached, %.2fs of CPU time.' % (
+            report['count'], report['duration'], report['cached'], report['cpu_time']
+        ))
+
+        if report['pinned']:
+            print(' - pinned the signer certificates of %d APKs in the lock file.' % report['pinned'])
+
+        if not cls.is_supported() and report['count']:
+            print('ERROR: The signatures can not be verified, the cryptography package is missing: '
+                  'pip install cryptography')
+
+        for package_name, error in report['errors']:
+            print('ERROR: %s: %s' % (package_name, error))
@@ -0,0 +1,228 @@
+"""
+Make-style stages, only run when their inputs changed since their last run.
+
+Each stage declares it's input and output files, and optional input values,
+eg: some settings. The inputs are fingerprinted by content, using the sha256
+hash of the files, and the fingerprints are saved after each successful run.
+A stage is stale when it never ran, when an output is missing, or when the
+fingerprint of an input changed.
+
+The file hashes are saved with the file size and modification time, so only
+the changed files are hashed again. The stages run in a task group, each one
+as soon as the stages it depends on are done.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from mia.tasks import MiaTaskGroup
+from mia.utils import MiaUtils
+
+
+class MiaStage(object):
+    def __init__(self, name, callback, inputs=None, outputs=None, values=None, dependencies=()):
+        """
+        :param callback: Runs the stage.
+        :param inputs: Returns the list of the input file paths.
+        :param outputs: Returns the list of the output file paths.
+        :param values: Returns a dictionary of the input values.
+        :param dependencies: The stages producing the inputs.
+        """
+        self.name = name
+        self.callback = callback
+        self.inputs = inputs
+        self.outputs = outputs
+        self.values = values
+        self.dependencies = dependencies
+
+        # One of: up to date, done or failed, once the graph ran.
+        self.state = None
+        self.reason = None
+        self.duration = None
+
+    def get_inputs(self):
+        return self.inputs() if self.inputs is not None else []
+
+    def get_outputs(self):
+        return self.outputs() if self.outputs is not None else []
+
+    def get_values(self):
+        return self.values() if self.values is not None else {}
+
+
+class MiaStageGraph(object):
+    format_version = 1
+
+    def __init__(self, state_path, root_path):
+        """
+        :param state_path: The file saving the state of the stages.
+        :param root_path: The input and output paths are saved relative to it.
+        """
+        self.state_path = state_path
+        self.root_path = root_path
+        self.stages = []
+        self.lock = threading.Lock()
+        self.state = self.load_state()
+
+    def add(self, stage):
+        self.stages.append(stage)
+
+        return stage
+
+    def load_state(self):
+        state = {'version': self.format_version, 'stages': {}, 'files': {}}
+        if not os.path.isfile(self.state_path):
+            return state
+
+        try:
+            with open(self.state_path, 'r') as fd:
+                data = json.load(fd)
+        except ValueError:
+            return state
+
+        return data if data.get('version') == self.format_version else state
+
+    def save_state(self):
+        # Write the file atomically.
+        with self.lock:
+            with open(self.state_path + '.tmp', 'w') as fd:
+                json.dump(self.state, fd, indent=1, sort_keys=True)
+            os.rename(self.state_path + '.tmp', self.state_path)
+
+    def get_relative_path(self, file_path):
+        return os.path.relpath(file_path, self.root_path).replace(os.sep, '/')
+
+    def get_file_fingerprint(self, file_path):
+        """
+        :return: The sha256 hash of a file, or None if it does not exist.
+        """
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            return None
+
+        relative_path = self.get_relative_path(file_path)
+        with self.lock:
+            cached = self.state['files'].get(relative_path)
+        if cached is not None and cached[:2] == [file_stat.st_size, file_stat.st_mtime]:
+            return cached[2]
+
+        hash_value = MiaUtils.get_file_hash(file_path, 'sha256')
+        with self.lock:
+            self.state['files'][relative_path] = [file_stat.st_size, file_stat.st_mtime, hash_value]
+
+        return hash_value
+
+    def get_fingerprints(self, stage):
+        """
+        :return: A dictionary mapping the inputs of a stage to their fingerprint.
+        """
+        fingerprints = {}
+        for file_path in stage.get_inputs():
+            fingerprints[self.get_relative_path(file_path)] = self.get_file_fingerprint(file_path)
+
+        for name, value in stage.get_values().items():
+            data = json.dumps(value, sort_keys=True).encode('utf-8')
+            fingerprints['value:%s' % name] = hashlib.sha256(data).hexdigest()
+
+        return fingerprints
+
+    def get_stale_reason(self, stage):
+        """
+        :return: Why the stage must run, or None if it is up to date.
+        """
+        recorded = self.state['stages'].get(stage.name)
+        if recorded is None:
+            return 'never ran'
+
+        for file_path in stage.get_outputs():
+            if not os.path.exists(file_path):
+                return 'missing %s' % self.get_relative_path(file_path)
+
+        fingerprints = self.get_fingerprints(stage)
+        for name in sorted(set(fingerprints) | set(recorded['inputs'])):
+            if name not in recorded['inputs']:
+                return 'new input %s' % name
+            if name not in fingerprints:
+                return 'removed input %s' % name
+            if fingerprints[name] != recorded['inputs'][name]:
+                return 'changed %s' % name
+
+        return None
+
+    def get_stages(self, target):
+        """
+        :return: The target stage and the stages it depends on, dependencies
+          first.
+        """
+        stages = []
+
+        def visit(stage):
+            if stage in stages:
+                return
+            for dependency in stage.dependencies:
+                visit(dependency)
+            stages.append(stage)
+
+        visit(target)
+
+        return stages
+
+    def run_stage(self, stage, force=False):
+        """
+        Run a stage if it is stale, once the stages it depends on are done.
+        """
+        stage.reason = 'forced' if force else self.get_stale_reason(stage)
+        if stage.reason is None:
+            stage.state = 'up to date'
+            MiaTaskGroup.log('Stage %s: up to date.' % stage.name)
+            return
+
+        MiaTaskGroup.log('Stage %s: running, %s.' % (stage.name, stage.reason))
+        start_time = time.time()
+        try:
+            stage.callback()
+        except BaseException:
+            stage.state = 'failed'
+            raise
+        finally:
+            stage.duration = time.time() - start_time
+
+        # The stages may create their inputs, eg: download the indexes.
+        fingerprints = self.get_fingerprints(stage)
+        with self.lock:
+            self.state['stages'][stage.name] = {
+                'inputs': fingerprints,
+                'time': time.time(),
+                'duration': stage.duration,
+            }
+        self.save_state()
+        stage.state = 'done'
+
+    def run(self, target, force=False):
+        """
+        Run the stale stages needed by the target, in parallel when possible.
+        :raise MiaTaskError: If a stage failed.
+        """
+        group = MiaTaskGroup()
+        tasks = {}
+        for stage in self.get_stages(target):
+            tasks[stage] = group.add(stage.name, self.run_stage, (stage, force), None, [
+                tasks[dependency] for dependency in stage.dependencies
+            ])
+
+        try:
+            group.run()
+        finally:
+            # Keep the hashes of the files fingerprinted in the meantime, and
+            # forget the removed files.
+            with self.lock:
+                for relative_path in list(self.state['files']):
+                    if not os.path.exists(os.path.join(self.root_path, relative_path)):
+                        del self.state['files'][relative_path]
+            self.save_state()
+
+        return self.get_stages(target)
@@ -0,0 +1,209 @@
+"""
+Concurrent execution of the independent I/O operations of a command.
+
+The network downloads, the hashing and the device (adb) operations are added
+to a task group, each task with the resource it uses and the tasks it depends
+on. The group starts every task as soon as it's dependencies are done, limits
+how many tasks use a resource at once, and reports the errors of all the
+failed tasks together.
+
+The tasks run in a thread pool, the blocking I/O, the external commands and
+the hashing release the GIL.
+"""
+
+import multiprocessing
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+try:
+    CPU_COUNT = multiprocessing.cpu_count()
+except NotImplementedError:
+    CPU_COUNT = 2
+
+
+class MiaTaskError(Exception):
+    """
+    Raised when some tasks of a group failed, with all the failed tasks.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        super(MiaTaskError, self).__init__('%d task(s) failed:\n%s' % (len(failures), '\n'.join(
+            ' - %s: %s' % (task.name, task.get_error_message()) for task in failures
+        )))
+
+
+class MiaTask(object):
+    def __init__(self, name, callback, args, resource, dependencies):
+        self.name = name
+        self.callback = callback
+        self.args = args
+        self.resource = resource
+        self.dependencies = dependencies
+
+        # One of: pending, running, done, failed, skipped or cancelled.
+        self.state = 'pending'
+        self.result = None
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+
+    def get_error_message(self):
+        # NOTE: Some helpers exit on errors, eg: sys.exit('Download aborted!').
+        if isinstance(self.error, SystemExit):
+            return 'exited with %s' % self.error.code
+
+        return str(self.error) or self.error.__class__.__name__
+
+
+class MiaTaskGroup(object):
+    # The default number of tasks using each resource at once.
+    default_limits = {
+        'network': 8,
+        'disk': 4,
+        'hash': CPU_COUNT,
+        # Pushing to the same device in parallel.
+        'adb': 2,
+        # Work holding the GIL, eg: parsing the repository indexes.
+        'cpu': 1,
+    }
+
+    # The maximum number of threads of a group.
+    max_workers = 32
+
+    # NOTE: print() writes the line ending separately, so the messages of
+    # concurrent tasks could end up on the same line.
+    output_lock = threading.Lock()
+
+    def __init__(self, limits=None, fail_fast=True):
+        """
+        :param limits: Overrides the default limits of the resources.
+        :param fail_fast: Do not start any other task after a task failed.
+        """
+        self.limits = dict(self.default_limits, **(limits or {}))
+        self.fail_fast = fail_fast
+        self.tasks = []
+        self.cancelled = threading.Event()
+
+    def add(self, name, callback, args=(), resource=None, after=()):
+        """
+        Add a task, started by run().
+        :param resource: The resource limiting the task, None for no limit.
+        :param after: The tasks which must be done before starting this task,
+          it is skipped if any of them does not succeed.
+        :return: The task.
+        """
+        if resource is not None and resource not in self.limits:
+            raise ValueError('Unknown task resource: %s' % resource)
+
+        task = MiaTask(name, callback, tuple(args), resource, list(after))
+        self.tasks.append(task)
+
+        return task
+
+    @classmethod
+    def log(cls, message):
+        """
+        Display a message from a task.
+        """
+        with cls.output_lock:
+            sys.stdout.write(message + '\n')
+            sys.stdout.flush()
+
+    def cancel(self):
+        """
+        Do not start any other task. Long running tasks may check the
+        `cancelled` event to stop early.
+        """
+        self.cancelled.set()
+
+    def run(self):
+        """
+        Run the tasks and wait for them to finish.
+        :return: The tasks.
+        :raise MiaTaskError: If any task failed.
+        """
+        running = {}
+        usage = dict.fromkeys(self.limits, 0)
+
+        executor = ThreadPoolExecutor(max(1, min(len(self.tasks), self.max_workers)))
+        try:
+            while True:
+                for task in self.get_ready_tasks():
+                    if task.resource is not None:
+                        if usage[task.resource] >= self.limits[task.resource]:
+                            continue
+                        usage[task.resource] += 1
+
+                    task.state = 'running'
+                    running[executor.submit(self.run_task, task)] = task
+
+                if not running:
+                    break
+
+                done = wait(list(running), return_when=FIRST_COMPLETED)[0]
+                for future in done:
+                    task = running.pop(future)
+                    if task.resource is not None:
+                        usage[task.resource] -= 1
+                    if task.state == 'failed' and self.fail_fast:
+                        self.cancel()
+        except KeyboardInterrupt:
+            # Let the running tasks finish, the threads can not be killed.
+            self.cancel()
+            raise
+        finally:
+            executor.shutdown(wait=True)
+
+            for task in self.tasks:
+                if task.state == 'pending':
+                    task.state = 'cancelled'
+
+        failures = [task for task in self.tasks if task.state == 'failed']
+        if failures:
+            raise MiaTaskError(failures)
+
+        return self.tasks
+
+    def get_ready_tasks(self):
+        """
+        :return: The pending tasks with all their dependencies done, in the
+          order they were added, skipping the tasks depending on unsuccessful
+          tasks.
+        """
+        if self.cancelled.is_set():
+            return []
+
+        ready = []
+        for task in self.tasks:
+            if task.state != 'pending':
+                continue
+
+            states = set(dependency.state for dependency in task.dependencies)
+            if states & set(['failed', 'skipped', 'cancelled']):
+                task.state = 'skipped'
+                continue
+
+            if not states - set(['done']):
+                ready.append(task)
+
+        return ready
+
+    @staticmethod
+    def run_task(task):
+        task.start_time = time.time()
+        try:
+            task.result = task.callback(*task.args)
+            task.state = 'done'
+        except BaseException as e:
+            task.error = e
+            task.state = 'failed'
+        finally:
+            task.end_time = time.time()
+
+    def get_failed_tasks(self):
+        """
+        :return: The tasks which failed, or were not run because of failures.
+        """
+        return [task for task in self.tasks if task.state in ('failed', 'skipped', 'cancelled')]
@@ -0,0 +1,124 @@
+"""
+Fast removal of workspace files, by moving them to a trash folder first.
+
+Renaming is atomic and instant, so the workspace can be used again right away,
+while the files are deleted by a pool of threads in the background. This is a
+lot faster than removing the files one by one on network file systems.
+"""
+
+import os
+import stat
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from mia.handler import MiaHandler
+from mia.profiler import MiaProfiler
+
+
+class MiaTrash(object):
+    # The number of threads deleting the files.
+    workers = 8
+
+    @staticmethod
+    def get_trash_path():
+        # NOTE: Keep the trash in the workspace, renaming across file systems
+        # is not possible.
+        return os.path.join(MiaHandler.get_workspace_path(), '.trash')
+
+    @classmethod
+    def move(cls, path):
+        """
+        Atomically move a file or a directory to the trash.
+        :return: The path in the trash.
+        """
+        trash_path = cls.get_trash_path()
+        if not os.path.isdir(trash_path):
+            os.makedirs(trash_path, mode=0o755)
+
+        destination = os.path.join(trash_path, '%s-%s' % (uuid.uuid4().hex, os.path.basename(path)))
+        os.rename(path, destination)
+
+        return destination
+
+    @classmethod
+    def empty_in_background(cls):
+        """
+        Delete the trash contents, including leftovers from interrupted runs.
+        :return: The started MiaTrashCollector thread.
+        """
+        collector = MiaTrashCollector(cls.get_trash_path(), cls.workers)
+        collector.start()
+
+        return collector
+
+
+class MiaTrashCollector(threading.Thread):
+    def __init__(self, trash_path, workers):
+        super(MiaTrashCollector, self).__init__()
+        self.trash_path = trash_path
+        self.workers = workers
+        self.files_count = 0
+        self.bytes_count = 0
+        self.duration = 0
+        self.errors = []
+
+    def run(self):
+        if not os.path.isdir(self.trash_path):
+            return
+
+        start_time = time.time()
+        with MiaProfiler.span('trash delete') as span:
+            directories = []
+            with ThreadPoolExecutor(self.workers) as executor:
+                pending = set([executor.submit(self.delete_files, self.trash_path)])
+
+                # Each directory is scanned by a worker, which also deletes
+                # it's files, and the subdirectories are scanned in parallel.
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future.exception() is not None:
+                            self.errors.append(future.exception())
+                            continue
+
+                        files_count, bytes_count, subdirectories = future.result()
+                        self.files_count += files_count
+                        self.bytes_count += bytes_count
+                        directories.extend(subdirectories)
+                        pending.update(executor.submit(self.delete_files, path) for path in subdirectories)
+
+            # The directories are empty now, remove the deepest first.
+            directories.sort(key=lambda path: path.count(os.sep), reverse=True)
+            for path in directories:
+                try:
+                    os.rmdir(path)
+                except OSError as e:
+                    self.errors.append(e)
+            span.add('bytes', self.bytes_count)
+
+        self.duration = time.time() - start_time
+
+    @staticmethod
+    def delete_files(directory_path):
+        """
+        Delete the files of a directory.
+        :return: A (files count, bytes count, subdirectories) tuple.
+        """
+        files_count = 0
+        bytes_count = 0
+        subdirectories = []
+
+        for name in os.listdir(directory_path):
+            path = os.path.join(directory_path, name)
+            file_stat = os.lstat(path)
+            if stat.S_ISDIR(file_stat.st_mode):
+                subdirectories.append(path)
+                continue
+
+            os.remove(path)
+            files_count += 1
+            bytes_count += file_stat.st_size
+
+        return files_count, bytes_count, subdirectories
@@ -8,12 +8,14 @@ import operator
 import os
 import re
 import shutil
-import subprocess
 import sys
 import yaml
 from distutils.version import StrictVersion
 
 from mia.handler import MiaHandler
+from mia.profiler import MiaProfiler
+from mia.runner import CommandTimeoutError, MiaRunner
+from mia.settings import MiaSettings
 
 # Replace the input() function in Python 2 with raw_input.
 try:
@@ -29,6 +31,9 @@ class DocParserError(Exception):
 
 
 class MiaUtils(object):
+    # Maps (file path, hash type) to (size, modification time, hash) tuples.
+    __hashes = {}
+
     @staticmethod
     def input_pause(display_text='Paused.'):
         input("%s\nPress enter to continue.\n" % display_text)
@@ -98,14 +103,31 @@ class MiaUtils(object):
 
             return value
 
-    @staticmethod
-    def get_file_hash(file_path, hash_type='sha256'):
+    @classmethod
+    def get_file_hash(cls, file_path, hash_type='sha256'):
         # Read the file and compute the it's hash.
         if hash_type not in hashlib.algorithms_available:
             raise ValueError('Unknown hash type: {}'.format(hash_type))
 
-        with open(file_path, 'rb') as file_object:
-            return hashlib.new(hash_type, file_object.read()).hexdigest()
+        # Reuse the hashes of unchanged files, eg: in the daemon.
+        file_stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), hash_type)
+        cached = cls.__hashes.get(key)
+        if cached is not None and cached[:2] == (file_stat.st_size, file_stat.st_mtime):
+            return cached[2]
+
+        with MiaProfiler.span('hash ' + hash_type) as span:
+            span.add('bytes', file_stat.st_size)
+            with open(file_path, 'rb') as file_object:
+                hash_value = hashlib.new(hash_type, file_object.read()).hexdigest()
+
+        cls.__hashes[key] = (file_stat.st_size, file_stat.st_mtime, hash_value)
+
+        return hash_value
+
+    @classmethod
+    def clear_cache(cls):
+        cls.__hashes = {}
 
     @classmethod
     def create_hash_file(cls, file_path, hash_type):
@@ -117,6 +139,10 @@ class MiaUtils(object):
         print(' - computing hash of {}'. format(file_size))
         zip_hash_value = cls.get_file_hash(file_path, hash_type)
 
+        cls.write_hash_file(file_path, hash_type, zip_hash_value)
+
+    @staticmethod
+    def write_hash_file(file_path, hash_type, hash_value):
         hash_file_path = '.'.join((file_path, hash_type))
         if os.path.exists(hash_file_path):
             os.remove(hash_file_path)
@@ -125,7 +151,7 @@ class MiaUtils(object):
         hf = open(hash_file_path, mode='w')
         # The '*' specifies that the file should be read in binary mode.
         hf.write(' *'.join((
-            zip_hash_value,
+            hash_value,
             os.path.basename(file_path),
         )))
         hf.write('')  # Add an extra empty line.
@@ -140,12 +166,8 @@ class MiaUtils(object):
             return None
 
         try:
-            fd = open(settings_file, 'r')
-
             # Load the YAML file and sort the top level entries.
-            settings = yaml.load(fd)
-
-            fd.close()
+            settings = MiaSettings.load(settings_file)
         except yaml.YAMLError:
             print('ERROR: Could not read configuration file!')
             return None
@@ -165,43 +187,28 @@ class MiaUtils(object):
         print("Updating settings file:\n - %s\n" % settings_file)
 
         try:
-            # Define a custom order of the sections
-            order = ['general', 'apps']
-            for section in settings.keys():
-                if section not in order:
-                    order.append(section)
-
-            # Open the file.
-            fd = open(settings_file, 'w')
-
-            # Save all the settings in oder.
-            for section in order:
-                if section in settings.keys():
-                    data = {section: settings[section]}
-                    fd.write(yaml.dump(data, default_flow_style=False))
-
-            fd.close()
+            # Save all the settings using a custom order of the sections.
+            MiaSettings.save(settings_file, settings, ['general', 'apps'])
         except yaml.YAMLError:
-            fd.close()
             print('ERROR: Could not save configuration file!')
             return None
 
-        # Load the settings in the main handler file.
-        MiaHandler.get_definition_settings(True)
+        # Use the updated settings in the main handler, without reading the file.
+        MiaHandler.set_definition_settings(settings)
 
     @staticmethod
     def format_file_size(file_size, precision=2):
         file_size = int(file_size)
 
-        if file_size is 0:
+        if file_size == 0:
             return '0 bytes'
 
         log = math.floor(math.log(file_size, 1024))
 
         return "%.*f %s" % (
             precision,
-            file_size / math.pow(1024, log),
-            ['bytes', 'Kb', 'Mb'][int(log)]
+            file_size / math.pow(1024, min(log, 4)),
+            ['bytes', 'Kb', 'Mb', 'Gb', 'Tb'][int(min(log, 4))]
         )
 
     @staticmethod
@@ -226,13 +233,10 @@ class MiaUtils(object):
         wget_arguments.append('--output-document=%s' % download_filepath)
         wget_arguments.append('%s' % url)
 
-        proc = subprocess.Popen(['wget'] + wget_arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
         try:
-            stdout, stderr = proc.communicate()
-        except subprocess.TimeoutExpired:
-            # TODO: Fix, subprocess.TimeoutExpired does not exist in PY2.
-            proc.kill()
+            with MiaProfiler.span('wget'):
+                returncode, stdout, stderr = MiaRunner.run(['wget'] + wget_arguments)
+        except CommandTimeoutError:
             print('ERROR: wget has timed out...')
             sys.exit(1)
 
@@ -262,7 +266,7 @@ class MiaUtils(object):
             if matches:
                 headers[matches.group('name')] = matches.group('value')
 
-        if proc.returncode != 0:
+        if returncode != 0:
             raise IOError(stderr)
 
         if cache_enabled:
@@ -0,0 +1,196 @@
+"""
+Watch a folder tree for changes, eg: the archive folder of a definition.
+
+Uses the Linux inotify API through ctypes, and falls back to polling the file
+modification times on the other platforms. The changes are collected until no
+other change happens during the debounce delay, so that saving many files at
+once, or editors writing temporary files, only trigger a single rebuild.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+
+class MiaWatcher(object):
+    # inotify event flags, from <sys/inotify.h>.
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+
+    watch_mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    # The header of the inotify events: wd, mask, cookie and name length.
+    event_header = struct.Struct('iIII')
+
+    # The delay between the checks, when polling.
+    poll_interval = 0.5
+
+    def __init__(self, root_path, debounce=0.2):
+        self.root_path = os.path.abspath(root_path)
+        self.debounce = debounce
+
+        self.libc = self.load_libc()
+        self.fd = None
+        # Maps the watch descriptors to the watched folders.
+        self.watches = {}
+        self.snapshot = None
+
+        if self.libc is not None:
+            self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+            if self.fd < 0:
+                self.fd = None
+
+        if self.fd is not None:
+            self.add_watches(self.root_path)
+        else:
+            self.snapshot = self.get_snapshot()
+
+    @staticmethod
+    def load_libc():
+        """
+        :return: The C library, or None if it does not provide inotify.
+        """
+        library_path = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(library_path, use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        except (OSError, AttributeError):
+            return None
+
+        return libc
+
+    def is_polling(self):
+        return self.fd is None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def add_watches(self, directory_path):
+        """
+        Watch a folder and all it's sub-folders.
+        """
+        for path, directories, files in os.walk(directory_path):
+            wd = self.libc.inotify_add_watch(self.fd, path.encode('utf-8'), self.watch_mask)
+            if wd < 0:
+                error = ctypes.get_errno()
+                # The folder was removed in the meantime.
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise OSError(error, 'Could not watch %s: %s' % (path, os.strerror(error)))
+
+            self.watches[wd] = path
+
+    def wait(self):
+        """
+        Wait for changes.
+        :return: A set with the changed, added or removed paths, relative to
+          the watched folder, or None if the changes are unknown and
+          everything should be considered as changed.
+        """
+        if self.is_polling():
+            return self.wait_polling()
+
+        changes = set()
+        # Block until the first change, then until the changes stop.
+        timeout = None
+        while True:
+            readable = select.select([self.fd], [], [], timeout)[0]
+            if not readable:
+                return changes
+
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            if not self.read_events(data, changes):
+                changes = None
+            timeout = self.debounce
+
+    def read_events(self, data, changes):
+        """
+        Add the paths of the inotify events to the changes.
+        :return: False if some events were lost.
+        """
+        complete = True
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = data[offset:offset + name_length].rstrip(b'\0').decode('utf-8')
+            offset += name_length
+
+            if mask & self.IN_Q_OVERFLOW:
+                complete = False
+                continue
+
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            directory_path = self.watches.get(wd)
+            if directory_path is None:
+                continue
+
+            path = os.path.join(directory_path, name) if name else directory_path
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self.add_watches(path)
+
+            if changes is not None and path != self.root_path:
+                changes.add(os.path.relpath(path, self.root_path))
+
+        return complete
+
+    def get_snapshot(self):
+        """
+        :return: A dictionary mapping the files to their size and modification
+          time.
+        """
+        snapshot = {}
+        for path, directories, files in os.walk(self.root_path):
+            for file_name in files:
+                file_path = os.path.join(path, file_name)
+                try:
+                    file_stat = os.stat(file_path)
+                except OSError:
+                    continue
+                snapshot[os.path.relpath(file_path, self.root_path)] = (file_stat.st_size, file_stat.st_mtime)
+
+        return snapshot
+
+    def wait_polling(self):
+        changes = set()
+        while True:
+            time.sleep(self.debounce if changes else self.poll_interval)
+
+            snapshot = self.get_snapshot()
+            changed = set(
+                path for path in set(snapshot) | set(self.snapshot)
+                if snapshot.get(path) != self.snapshot.get(path)
+            )
+            self.snapshot = snapshot
+
+            if not changed and changes:
+                return changes
+            changes |= changed
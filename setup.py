@@ -41,7 +41,10 @@ setup(
     },
     install_requires=[
         'docopt',
+        'futures; python_version < "3.0"',
         'PyYAML',
+        # Verify the APK signatures, not only their digests and certificates.
+        'cryptography',
     ],
     classifiers=[
         'Development Status :: 1 - Planning',
@@ -0,0 +1,539 @@
+"""
+Generators for synthetic F-Droid repository indexes, definitions and archive
+trees used by the benchmarks.
+"""
+
+import hashlib
+import io
+import json
+import os
+import random
+import struct
+import zipfile
+from xml.sax.saxutils import escape
+
+import yaml
+
+CATEGORIES = [
+    'Connectivity', 'Development', 'Games', 'Graphics', 'Internet', 'Money',
+    'Multimedia', 'Navigation', 'Phone & SMS', 'Reading', 'Science & Education',
+    'Security', 'Sports & Health', 'System', 'Theming', 'Time', 'Writing',
+]
+
+WORDS = [
+    'secure', 'private', 'open', 'fast', 'simple', 'offline', 'encrypted',
+    'client', 'browser', 'messenger', 'reader', 'player', 'manager', 'viewer',
+    'keyboard', 'launcher', 'notes', 'calendar', 'maps', 'wallet', 'mail',
+    'camera', 'gallery', 'music', 'video', 'podcast', 'weather', 'terminal',
+]
+
+
+def get_app_id(index):
+    return 'org.example.app%06d' % index
+
+
+def get_versioncode(app_index, package_index, packages_count):
+    """
+    Versioncodes are listed newest first, the same as in the F-Droid indexes.
+    """
+    return 1000 + (app_index % 97) * 10 + (packages_count - package_index) * 100
+
+
+def get_random_block(rng, size):
+    return bytes(bytearray(rng.getrandbits(8) for _ in range(size)))
+
+
+def generate_index(file_path, apps_count, packages_count, seed=0):
+    """
+    Write a synthetic F-Droid index.xml file.
+    :param file_path: The path of the generated index.xml file.
+    :param apps_count: The number of applications in the repository.
+    :param packages_count: The number of packages of each application.
+    :param seed: The seed of the pseudo-random generator.
+    """
+    rng = random.Random(seed)
+
+    with open(file_path, 'w') as fd:
+        fd.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        fd.write('<fdroid>\n')
+        fd.write('<repo icon="fdroid-icon.png" name="Synthetic" pubkey="00" '
+                 'timestamp="1450000000" url="http://127.0.0.1/repo" version="15">'
+                 '<description>Synthetic repository.</description></repo>\n')
+
+        for app_index in range(apps_count):
+            app_id = get_app_id(app_index)
+            words = rng.sample(WORDS, 3)
+            categories = rng.sample(CATEGORIES, 2)
+
+            fd.write('<application id="%s">' % app_id)
+            fd.write('<id>%s</id>' % app_id)
+            fd.write('<added>2015-01-01</added><lastupdated>2015-12-01</lastupdated>')
+            fd.write('<name>%s</name>' % ' '.join(w.title() for w in words[:2]))
+            fd.write('<summary>A %s %s %s</summary>' % tuple(words))
+            fd.write('<icon>%s.png</icon>' % app_id)
+            fd.write('<desc>&lt;p&gt;%s&lt;/p&gt;</desc>' % ' '.join(words * 10))
+            fd.write('<license>GPLv3</license>')
+            fd.write('<categories>%s</categories>' % escape(','.join(categories)))
+            fd.write('<category>%s</category>' % escape(categories[0]))
+            fd.write('<web>https://example.org/</web><source>https://example.org/src</source>')
+            fd.write('<marketversion>1.%d</marketversion>' % packages_count)
+            fd.write('<marketvercode>%d</marketvercode>' % get_versioncode(app_index, 0, packages_count))
+
+            for package_index in range(packages_count):
+                versioncode = get_versioncode(app_index, package_index, packages_count)
+                apk_name = '%s_%d.apk' % (app_id, versioncode)
+                fd.write('<package>')
+                fd.write('<version>1.%d</version>' % (packages_count - package_index))
+                fd.write('<versioncode>%d</versioncode>' % versioncode)
+                fd.write('<apkname>%s</apkname>' % apk_name)
+                fd.write('<hash type="sha256">%s</hash>' % hashlib.sha256(apk_name.encode('utf-8')).hexdigest())
+                fd.write('<sig>%s</sig>' % hashlib.md5(app_id.encode('utf-8')).hexdigest())
+                fd.write('<size>%d</size>' % rng.randint(100000, 20000000))
+                fd.write('<sdkver>9</sdkver><added>2015-06-01</added>')
+                fd.write('<permissions>INTERNET,ACCESS_NETWORK_STATE</permissions>')
+                fd.write('</package>')
+
+            fd.write('</application>\n')
+
+        fd.write('</fdroid>\n')
+
+
+def generate_index_v1(file_path, apps_count, packages_count, seed=0):
+    """
+    Write a synthetic F-Droid index-v1.jar file, with the same applications
+    and packages as the index.xml file generated from the same seed.
+    :param file_path: The path of the generated index-v1.jar file.
+    :param apps_count: The number of applications in the repository.
+    :param packages_count: The number of packages of each application.
+    :param seed: The seed of the pseudo-random generator.
+    """
+    rng = random.Random(seed)
+
+    apps = []
+    packages = {}
+    for app_index in range(apps_count):
+        app_id = get_app_id(app_index)
+        words = rng.sample(WORDS, 3)
+        categories = rng.sample(CATEGORIES, 2)
+
+        apps.append({
+            'added': 1420070400000,
+            'categories': categories,
+            'icon': '%s.png' % app_id,
+            'lastUpdated': 1448928000000,
+            'license': 'GPL-3.0-only',
+            'localized': {
+                'en-US': {
+                    'description': '<p>%s</p>' % ' '.join(words * 10),
+                    'name': ' '.join(w.title() for w in words[:2]),
+                    'summary': 'A %s %s %s' % tuple(words),
+                },
+            },
+            'packageName': app_id,
+            'sourceCode': 'https://example.org/src',
+            'suggestedVersionCode': str(get_versioncode(app_index, 0, packages_count)),
+            'suggestedVersionName': '1.%d' % packages_count,
+            'webSite': 'https://example.org/',
+        })
+
+        packages[app_id] = []
+        for package_index in range(packages_count):
+            versioncode = get_versioncode(app_index, package_index, packages_count)
+            apk_name = '%s_%d.apk' % (app_id, versioncode)
+            packages[app_id].append({
+                'added': 1433116800000,
+                'apkName': apk_name,
+                'hash': hashlib.sha256(apk_name.encode('utf-8')).hexdigest(),
+                'hashType': 'sha256',
+                'minSdkVersion': '9',
+                'packageName': app_id,
+                'sig': hashlib.md5(app_id.encode('utf-8')).hexdigest(),
+                'size': rng.randint(100000, 20000000),
+                'uses-permission': [['android.permission.INTERNET', None]],
+                'versionCode': versioncode,
+                'versionName': '1.%d' % (packages_count - package_index),
+            })
+
+    index = {
+        'repo': {
+            'timestamp': 1450000000000,
+            'version': 21,
+            'name': 'Synthetic',
+            'icon': 'fdroid-icon.png',
+            'address': 'http://127.0.0.1/repo',
+            'description': 'Synthetic repository.',
+        },
+        'requests': {'install': [], 'uninstall': []},
+        'apps': apps,
+        'packages': packages,
+    }
+
+    with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_DEFLATED) as jar:
+        jar.writestr('index-v1.json', json.dumps(index, indent=2, sort_keys=True))
+
+
+def generate_definition(definition_path, repositories, apps_count, packages_count, seed=0):
+    """
+    Create a synthetic definition, referencing apps from the synthetic indexes.
+    :param definition_path: The path of the definition directory.
+    :param repositories: A list of (repository id, applications count) tuples.
+    :param apps_count: The number of apps in the definition.
+    :param packages_count: The number of packages of each application.
+    :param seed: The seed of the pseudo-random generator.
+    """
+    rng = random.Random(seed)
+
+    apps = []
+    for index in range(apps_count):
+        repo_id, repo_apps_count = repositories[index % len(repositories)]
+        app_index = rng.randrange(repo_apps_count)
+        app_info = {
+            'id': get_app_id(app_index),
+            'repository': repo_id,
+        }
+
+        # Pin every other app to an older package.
+        if index % 2:
+            package_index = rng.randrange(packages_count)
+            app_info['versioncode'] = get_versioncode(app_index, package_index, packages_count)
+
+        apps.append(app_info)
+
+    settings = {
+        'config_version': 1,
+        'general': {
+            'device_codename': 'mako',
+            'os_name': 'cm',
+            'os_version': 11,
+            'template': 'mia-default',
+        },
+        'defaults': {
+            'repository': repositories[0][0],
+        },
+        'app_types': {
+            'system': 'system/app',
+            'privileged': 'system/priv-app',
+            'user': 'data/app',
+        },
+        'repositories': [{
+            'id': repo_id,
+            'name': 'Synthetic %s' % repo_id,
+            'url': 'http://127.0.0.1/%s' % repo_id,
+        } for repo_id, repo_apps_count in repositories],
+        'apps': apps,
+    }
+
+    if not os.path.isdir(definition_path):
+        os.makedirs(definition_path)
+
+    with open(os.path.join(definition_path, 'settings.yaml'), 'w') as fd:
+        fd.write(yaml.dump(settings, default_flow_style=False))
+
+    return settings
+
+
+def generate_lock_file(file_path, entries_count, seed=0):
+    """
+    Write a synthetic apps_lock.yaml file.
+    """
+    rng = random.Random(seed)
+
+    lock_data = []
+    for index in range(entries_count):
+        app_id = get_app_id(rng.randrange(entries_count * 10))
+        versioncode = get_versioncode(index, 0, 1)
+        package_name = '%s_%d.apk' % (app_id, versioncode)
+        lock_data.append({
+            'id': app_id,
+            'name': ' '.join(w.title() for w in rng.sample(WORDS, 2)),
+            'package_name': package_name,
+            'package_url': 'http://127.0.0.1/repo/%s' % package_name,
+            'package_versioncode': str(versioncode),
+            'hash': hashlib.sha256(package_name.encode('utf-8')).hexdigest(),
+            'hash_type': 'sha256',
+            'repository': 'synthetic',
+            'type': rng.choice(['user', 'system', 'privileged']),
+        })
+
+    with open(file_path, 'w') as fd:
+        fd.write(yaml.dump(lock_data, default_flow_style=False))
+
+
+def generate_archive(archive_path, files_count, total_size, seed=0):
+    """
+    Create a synthetic archive tree, half compressible and half random data.
+    :param archive_path: The path of the archive directory.
+    :param files_count: The number of files.
+    :param total_size: The total size of the files, in bytes.
+    :param seed: The seed of the pseudo-random generator.
+    """
+    rng = random.Random(seed)
+    file_size = max(1, total_size // max(1, files_count))
+    top_directories = ['data/app', 'system/app', 'system/priv-app', 'system/etc/init.d']
+
+    # Random data does not compress, like the APKs.
+    random_block = get_random_block(rng, max(file_size, 1024 * 1024))
+
+    for index in range(files_count):
+        directory = os.path.join(archive_path, top_directories[index % len(top_directories)])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        if index % 2:
+            offset = rng.randrange(len(random_block) - file_size + 1)
+            content = random_block[offset:offset + file_size]
+        else:
+            content = (' '.join(rng.sample(WORDS, 8)) + '\n').encode('utf-8')
+            content = content * (file_size // len(content) + 1)
+
+        with open(os.path.join(directory, 'file%05d.bin' % index), 'wb') as fd:
+            fd.write(content[:file_size])
+
+
+def generate_file(file_path, size, seed=0):
+    """
+    Create a file of pseudo-random data.
+    """
+    rng = random.Random(seed)
+    block = get_random_block(rng, 1024 * 1024)
+
+    with open(file_path, 'wb') as fd:
+        written = 0
+        while written < size:
+            chunk = block[:size - written]
+            fd.write(chunk)
+            written += len(chunk)
+
+
+def generate_binary_manifest(package, versioncode, versionname, utf8=False):
+    """
+    Create a minimal binary AndroidManifest.xml, the same as built by aapt.
+    """
+    android_uri = 'http://schemas.android.com/apk/res/android'
+    strings = ['versionCode', 'versionName', 'package', 'manifest', android_uri, package, versionname]
+
+    # The string pool.
+    data = b''
+    offsets = []
+    for string in strings:
+        offsets.append(len(data))
+        if utf8:
+            encoded = string.encode('utf-8')
+            data += struct.pack('<BB', len(string), len(encoded)) + encoded + b'\0'
+        else:
+            data += struct.pack('<H', len(string)) + string.encode('utf-16-le') + b'\0\0'
+    data += b'\0' * (-len(data) % 4)
+    strings_start = 28 + 4 * len(strings)
+    string_pool = struct.pack(
+        '<HHIIIIII', 0x0001, 28, strings_start + len(data), len(strings), 0, 0x100 if utf8 else 0, strings_start, 0
+    ) + struct.pack('<%dI' % len(offsets), *offsets) + data
+
+    # The android: attributes are identified by their resource ids.
+    resource_map = struct.pack('<HHIII', 0x0180, 8, 16, 0x0101021b, 0x0101021c)
+
+    attributes = [
+        (strings.index(android_uri), 0, 0xffffffff, 0x10, versioncode),
+        (strings.index(android_uri), 1, 6, 0x03, 6),
+        (0xffffffff, 2, 5, 0x03, 5),
+    ]
+    element = struct.pack('<IIHHHHHH', 0xffffffff, 3, 20, 20, len(attributes), 0, 0, 0)
+    for namespace, name, raw_value, data_type, value in attributes:
+        element += struct.pack('<IIIHBBI', namespace, name, raw_value, 8, 0, data_type, value)
+    start_element = struct.pack('<HHIII', 0x0102, 16, 16 + len(element), 1, 0xffffffff) + element
+
+    body = string_pool + resource_map + start_element
+    return struct.pack('<HHI', 0x0003, 8, 8 + len(body)) + body
+
+
+def generate_apk(file_path, package, versioncode, abis=(), seed=0):
+    """
+    Create an APK with a binary manifest, some resources and the native
+    libraries of the ABIs.
+    """
+    rng = random.Random(seed)
+    with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('AndroidManifest.xml', generate_binary_manifest(
+            package, versioncode, '1.%d' % versioncode, bool(seed % 2)
+        ))
+        zf.writestr('classes.dex', get_random_block(rng, 64 * 1024))
+        zf.writestr('resources.arsc', get_random_block(rng, 16 * 1024))
+        for abi in abis:
+            zf.writestr('lib/%s/libnative.so' % abi, get_random_block(rng, 32 * 1024))
+
+
+def generate_signing_key(name='mia benchmarks'):
+    """
+    Create a RSA key and it's self-signed certificate, using the
+    cryptography package.
+    :return: A (private key, DER encoded certificate) tuple.
+    """
+    import datetime
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+    now = datetime.datetime(2020, 1, 1)
+    certificate = x509.CertificateBuilder().subject_name(subject).issuer_name(subject).public_key(
+        key.public_key()
+    ).serial_number(1).not_valid_before(now).not_valid_after(now + datetime.timedelta(days=10000)).sign(
+        key, hashes.SHA256()
+    )
+
+    return key, certificate.public_bytes(serialization.Encoding.DER)
+
+
+def generate_signed_apk(file_path, package, versioncode, key, certificate, seed=0, v2=True):
+    """
+    Create an APK signed using the v1 (JAR) and v2 signature schemes.
+    :param v2: Whether to also sign it using the v2 scheme.
+    """
+    import base64
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives.serialization import pkcs7
+
+    rng = random.Random(seed)
+    members = [
+        ('AndroidManifest.xml', generate_binary_manifest(package, versioncode, '1.%d' % versioncode)),
+        ('classes.dex', get_random_block(rng, 64 * 1024)),
+        ('resources.arsc', get_random_block(rng, 16 * 1024)),
+    ]
+
+    def get_digest(data):
+        return base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')
+
+    # The v1 signature.
+    manifest = b'Manifest-Version: 1.0\r\nCreated-By: mia benchmarks\r\n\r\n'
+    sections = []
+    for name, data in members:
+        section = ('Name: %s\r\nSHA-256-Digest: %s\r\n\r\n' % (name, get_digest(data))).encode('utf-8')
+        sections.append((name, section))
+        manifest += section
+
+    signature_file = ('Signature-Version: 1.0\r\nCreated-By: mia benchmarks\r\n%s'
+                      'SHA-256-Digest-Manifest: %s\r\n\r\n' % (
+                          'X-Android-APK-Signed: 2\r\n' if v2 else '', get_digest(manifest)
+                      )).encode('utf-8')
+    for name, section in sections:
+        signature_file += ('Name: %s\r\nSHA-256-Digest: %s\r\n\r\n' % (name, get_digest(section))).encode('utf-8')
+
+    signature_block = pkcs7.PKCS7SignatureBuilder().set_data(signature_file).add_signer(
+        x509.load_der_x509_certificate(certificate), key, hashes.SHA256()
+    ).sign(serialization.Encoding.DER, [pkcs7.PKCS7Options.DetachedSignature, pkcs7.PKCS7Options.NoCapabilities])
+
+    members += [
+        ('META-INF/MANIFEST.MF', manifest),
+        ('META-INF/CERT.SF', signature_file),
+        ('META-INF/CERT.RSA', signature_block),
+    ]
+
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+    content = content.getvalue()
+
+    if not v2:
+        with open(file_path, 'wb') as fd:
+            fd.write(content)
+        return
+
+    # The v2 signature, of the zip entries, the central directory and the
+    # end of central directory record.
+    eocd_offset = content.rindex(b'PK\x05\x06')
+    central_directory_size, central_directory_offset = struct.unpack_from('<II', content, eocd_offset + 12)
+    chunk_digests = []
+    for section in (content[:central_directory_offset], content[central_directory_offset:eocd_offset],
+                    content[eocd_offset:]):
+        for offset in range(0, len(section), 1024 * 1024):
+            chunk = section[offset:offset + 1024 * 1024]
+            chunk_digests.append(hashlib.sha256(b'\xa5' + struct.pack('<I', len(chunk)) + chunk).digest())
+    content_digest = hashlib.sha256(
+        b'\x5a' + struct.pack('<I', len(chunk_digests)) + b''.join(chunk_digests)
+    ).digest()
+
+    def length_prefixed(*values):
+        data = b''.join(values)
+        return struct.pack('<I', len(data)) + data
+
+    # RSASSA-PKCS1-v1_5 with SHA2-256.
+    algorithm = struct.pack('<I', 0x0103)
+    signed_data = b''.join((
+        length_prefixed(length_prefixed(algorithm, length_prefixed(content_digest))),
+        length_prefixed(length_prefixed(certificate)),
+        length_prefixed(),
+    ))
+    signature = key.sign(signed_data, padding.PKCS1v15(), hashes.SHA256())
+    public_key = key.public_key().public_bytes(
+        serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    signer = b''.join((
+        length_prefixed(signed_data),
+        length_prefixed(length_prefixed(algorithm, length_prefixed(signature))),
+        length_prefixed(public_key),
+    ))
+    value = length_prefixed(length_prefixed(signer))
+
+    pairs = struct.pack('<QI', len(value) + 4, 0x7109871a) + value
+    block_size = len(pairs) + 8 + 16
+    block = struct.pack('<Q', block_size) + pairs + struct.pack('<Q', block_size) + b'APK Sig Block 42'
+
+    eocd = bytearray(content[eocd_offset:])
+    struct.pack_into('<I', eocd, 16, central_directory_offset + len(block))
+    with open(file_path, 'wb') as fd:
+        fd.write(content[:central_directory_offset] + block + content[central_directory_offset:eocd_offset])
+        fd.write(bytes(eocd))
+
+
+def generate_tampered_apk(file_path, signed_path, name, data):
+    """
+    Add a file to a v1 signed APK, with it's digest in the manifest but not in
+    the signature file, eg: to check that the signature is not trusted.
+    """
+    import base64
+
+    with zipfile.ZipFile(signed_path, 'r') as source:
+        members = [(info.filename, source.read(info.filename)) for info in source.infolist()]
+
+    digest = base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')
+    section = ('Name: %s\r\nSHA-256-Digest: %s\r\n\r\n' % (name, digest)).encode('utf-8')
+    members = [
+        (member_name, member_data + section if member_name == 'META-INF/MANIFEST.MF' else member_data)
+        for member_name, member_data in members
+    ] + [(name, data)]
+
+    with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for member_name, member_data in members:
+            zf.writestr(member_name, member_data)
+
+
+def generate_pack(file_path, entries):
+    """
+    Write a cache pack file, without checking the entries, eg: to check the
+    import of malicious packs.
+    :param entries: A list of (relative path, content) tuples.
+    """
+    toc = {'created': 1450000000, 'entries': []}
+    header = struct.Struct('<8sIQQ32s')
+
+    with open(file_path, 'wb') as fd:
+        fd.write(b'\0' * header.size)
+        for relative_path, content in entries:
+            toc['entries'].append({
+                'path': relative_path,
+                'offset': fd.tell(),
+                'size': len(content),
+                'mtime': 1450000000,
+                'sha256': hashlib.sha256(content).hexdigest(),
+            })
+            fd.write(content)
+
+        toc_data = json.dumps(toc, sort_keys=True).encode('utf-8')
+        toc_offset = fd.tell()
+        fd.write(toc_data)
+        fd.seek(0)
+        fd.write(header.pack(b'MIAPACK\n', 1, toc_offset, len(toc_data), hashlib.sha256(toc_data).digest()))
@@ -0,0 +1,126 @@
+"""
+A local HTTP server supporting Range requests, with injected latency and
+bandwidth limits, standing in for the remote repositories and mirrors.
+"""
+
+import os
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # Python 2.
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class StubHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root_path, latency=0.0, bandwidth=None, fail_after=None, ranges=True):
+        """
+        :param root_path: The directory with the served files.
+        :param latency: Delay, in seconds, before answering each request.
+        :param bandwidth: Limit the speed of each response, in bytes/second.
+        :param fail_after: Close the connection after sending this many bytes.
+        :param ranges: Whether to support the Range requests, or to ignore
+          them and send the whole files.
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHTTPRequestHandler)
+        self.root_path = root_path
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fail_after = fail_after
+        self.ranges = ranges
+        self.requests = []
+        self.thread = None
+
+    def get_url(self, path=''):
+        return 'http://127.0.0.1:%d/%s' % (self.server_address[1], path.lstrip('/'))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # The clients close the connections they do not need anymore.
+        pass
+
+
+class StubHTTPRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request(False)
+
+    def do_GET(self):
+        self.handle_request(True)
+
+    def handle_request(self, send_body):
+        server = self.server
+        server.requests.append((self.command, self.path, self.headers.get('Range')))
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        file_path = os.path.join(server.root_path, self.path.split('?')[0].lstrip('/'))
+        if not os.path.isfile(file_path):
+            self.send_error(404)
+            return
+
+        size = os.path.getsize(file_path)
+        start, end = 0, size - 1
+
+        match = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if match and server.ranges:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.end_headers()
+                return
+
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        if not send_body:
+            return
+
+        with open(file_path, 'rb') as fd:
+            fd.seek(start)
+            remaining = end - start + 1
+            sent = 0
+            while remaining > 0:
+                chunk = fd.read(min(64 * 1024, remaining))
+                if not chunk:
+                    break
+
+                if server.fail_after is not None and sent + len(chunk) > server.fail_after:
+                    # Simulate a dropped connection.
+                    self.wfile.write(chunk[:max(0, server.fail_after - sent)])
+                    self.close_connection = True
+                    return
+
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                remaining -= len(chunk)
+
+                if server.bandwidth:
+                    time.sleep(float(len(chunk)) / server.bandwidth)
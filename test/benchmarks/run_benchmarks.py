@@ -0,0 +1,1159 @@
+"""
+Benchmarks for the mia script, using synthetic repository indexes, definitions
+and archive trees.
+
+Usage:
+    run_benchmarks.py [options] [<benchmark>...]
+    run_benchmarks.py --list
+    run_benchmarks.py --help
+
+Options:
+    --scale=<scale>        The size of the synthetic data: tiny, small or large.
+                           [default: small]
+    --repeat=<count>       Run each benchmark multiple times. [default: 3]
+    --baseline=<file>      The JSON file with the baseline results.
+                           [default: test/benchmarks/baseline.json]
+    --threshold=<percent>  Fail if slower than the baseline by this much.
+                           [default: 25]
+    --save-baseline        Save the results as the new baseline.
+    --data-dir=<path>      Keep the generated data in this directory.
+    --no-memory            Skip measuring the memory usage.
+    --list                 List the available benchmarks.
+    --help                 Show this screen.
+
+
+"""
+
+import atexit
+import gc
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 does not have tracemalloc.
+    tracemalloc = None
+    import resource
+
+from docopt import docopt
+
+# Add the script root the the PYTHONPATH environment variable.
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(ROOT)
+
+import generators
+from httpstub import StubHTTPServer
+from mia.apk import MiaApk
+from mia.clone import MiaClone
+from mia.commands.build import Build
+from mia.commands.cache import Cache
+from mia.completion import MiaCompletion
+from mia.daemon import MiaDaemon
+from mia.commands.definition import Definition
+from mia.commands.plan import Plan
+from mia.download import DownloadError, MiaDownloader
+from mia.fdroid import MiaFDroid, MiaFDroidXmlRepository
+from mia.handler import MiaHandler
+from mia.mirrors import MiaMirrors
+from mia.pack import MiaPack, MiaPackError
+from mia.schema import MiaSchema
+from mia.search import MiaSearch
+from mia.settings import MiaSettings
+import mia.signature
+from mia.signature import MiaSignature, MiaSignatureError
+from mia.stages import MiaStage, MiaStageGraph
+from mia.tasks import MiaTaskGroup
+from mia.utils import MiaUtils
+
+SCALES = {
+    'tiny': {
+        'index_apps': 1000,
+        'index_packages': 3,
+        'definition_apps': 50,
+        'lock_entries': 1000,
+        'definitions': 50,
+        'archive_files': 100,
+        'archive_size': 5 * 1024 * 1024,
+        'hash_file_size': 10 * 1024 * 1024,
+        'os_zip_size': 8 * 1024 * 1024,
+    },
+    'small': {
+        'index_apps': 10000,
+        'index_packages': 5,
+        'definition_apps': 200,
+        'lock_entries': 10000,
+        'definitions': 300,
+        'archive_files': 500,
+        'archive_size': 50 * 1024 * 1024,
+        'hash_file_size': 100 * 1024 * 1024,
+        'os_zip_size': 32 * 1024 * 1024,
+    },
+    'large': {
+        'index_apps': 100000,
+        'index_packages': 8,
+        'definition_apps': 500,
+        'lock_entries': 50000,
+        'definitions': 1000,
+        'archive_files': 2000,
+        'archive_size': 200 * 1024 * 1024,
+        'hash_file_size': 500 * 1024 * 1024,
+        'os_zip_size': 128 * 1024 * 1024,
+    },
+}
+
+DEFINITION = 'synthetic'
+
+# The available benchmarks, populated using the @benchmark decorator.
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """
+    Register a benchmark. The decorated function receives the benchmark context
+    and returns the callable to be measured.
+    """
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return decorator
+
+
+class BenchmarkContext(object):
+    def __init__(self, data_path, scale):
+        self.data_path = data_path
+        self.scale = scale
+        self.params = SCALES[scale]
+
+    def get_workspace_path(self):
+        return os.path.join(self.data_path, self.scale)
+
+    def get_repositories(self):
+        """
+        A main repository and a smaller one, as a list of (id, apps count).
+        """
+        return [
+            ('synthetic', self.params['index_apps']),
+            ('synthetic_extra', max(1, self.params['index_apps'] // 10)),
+        ]
+
+    def prepare_workspace(self):
+        """
+        Generate the repository indexes and the definition, once per scale.
+        """
+        workspace_path = self.get_workspace_path()
+        resources_path = os.path.join(workspace_path, 'resources')
+        definition_path = os.path.join(workspace_path, 'definitions', DEFINITION)
+
+        if not os.path.isdir(resources_path):
+            os.makedirs(resources_path)
+
+        for repo_id, apps_count in self.get_repositories():
+            index_path = os.path.join(resources_path, repo_id + '.index.xml')
+            if not os.path.isfile(index_path):
+                generators.generate_index(index_path, apps_count, self.params['index_packages'])
+
+        if not os.path.isfile(os.path.join(definition_path, 'settings.yaml')):
+            generators.generate_definition(
+                definition_path,
+                self.get_repositories(),
+                self.params['definition_apps'],
+                self.params['index_packages']
+            )
+
+        # Set the MiaHandler class variables.
+        MiaHandler(ROOT, workspace_path, {})
+        MiaHandler.args = {
+            '<definition>': DEFINITION,
+            '--force-latest': False,
+            '--no-hash': False,
+            '--all': False,
+            '--watch': False,
+            '--emulator': False,
+            '--cpu': 'armeabi',
+        }
+
+        return workspace_path
+
+
+@benchmark('get_apps_lock_info')
+def benchmark_get_apps_lock_info(context):
+    context.prepare_workspace()
+
+    def run():
+        MiaHandler.get_definition_settings(True)
+        Definition.clear_cache()
+        return Definition.get_apps_lock_info()
+
+    return run
+
+
+@benchmark('fdroid_get_app_lock_info')
+def benchmark_fdroid_get_app_lock_info(context):
+    import xml.etree.ElementTree as ElementTree
+
+    workspace_path = context.prepare_workspace()
+    settings = MiaHandler.get_definition_settings(True)
+
+    repositories_data = {}
+    for repo_info in settings['repositories']:
+        index_path = os.path.join(workspace_path, 'resources', repo_info['id'] + '.index.xml')
+        repo_info['index'] = MiaFDroidXmlRepository(ElementTree.parse(index_path).getroot())
+        repositories_data[repo_info['id']] = repo_info
+
+    apps = []
+    for app_info in settings['apps']:
+        app_info = dict(app_info)
+        app_info.setdefault('versioncode', 'latest')
+        app_info.setdefault('type', 'user')
+        apps.append(app_info)
+
+    def run():
+        return [MiaFDroid.fdroid_get_app_lock_info(repositories_data, app_info) for app_info in apps]
+
+    return run
+
+
+@benchmark('fdroid_resolve_constraints')
+def benchmark_fdroid_resolve_constraints(context):
+    """
+    Resolve version constraints of apps with hundreds of archived releases.
+    """
+    import xml.etree.ElementTree as ElementTree
+
+    resources_path = os.path.join(context.prepare_workspace(), 'resources')
+    apps_count = max(1, context.params['definition_apps'])
+
+    repositories_data = {}
+    for repo_id, packages_count in (('constraints', 3), ('constraints_archive', 300)):
+        index_path = os.path.join(resources_path, repo_id + '.index.xml')
+        if not os.path.isfile(index_path):
+            generators.generate_index(index_path, apps_count, packages_count, 1)
+
+        repositories_data[repo_id] = {
+            'id': repo_id,
+            'url': 'http://127.0.0.1/%s' % repo_id,
+            'index': MiaFDroidXmlRepository(ElementTree.parse(index_path).getroot()),
+        }
+    repositories_data['constraints']['fallback'] = 'constraints_archive'
+
+    specs = ['latest', '>=5000', '<2000', '~=10000', '>=3000,<20000,!=4000', '1500']
+    apps = [{
+        'id': generators.get_app_id(index),
+        'repository': 'constraints',
+        'versioncode': specs[index % len(specs)],
+    } for index in range(apps_count)]
+
+    def run():
+        # Include building the sorted versioncodes arrays.
+        MiaFDroid.clear_cache()
+        return [MiaFDroid.fdroid_get_app_lock_info(repositories_data, app_info) for app_info in apps]
+
+    return run
+
+
+def get_index_v1_paths(context):
+    """
+    Generate the index-v1.jar files of the synthetic repositories, outside of
+    the resources folder so the other benchmarks keep using the index.xml files.
+    """
+    workspace_path = context.prepare_workspace()
+    jar_paths = {}
+    for repo_id, apps_count in context.get_repositories():
+        jar_paths[repo_id] = os.path.join(workspace_path, repo_id + '.index-v1.jar')
+        if not os.path.isfile(jar_paths[repo_id]):
+            generators.generate_index_v1(jar_paths[repo_id], apps_count, context.params['index_packages'])
+
+    return jar_paths
+
+
+@benchmark('index_parse_xml')
+def benchmark_index_parse_xml(context):
+    resources_path = os.path.join(context.prepare_workspace(), 'resources')
+    settings = MiaHandler.get_definition_settings(True)
+    index_path = os.path.join(resources_path, settings['defaults']['repository'] + '.index.xml')
+
+    def run():
+        Definition.clear_cache()
+        return Definition.parse_index(index_path).get_app(settings['apps'][0]['id'])
+
+    return run
+
+
+@benchmark('index_parse_v1')
+def benchmark_index_parse_v1(context):
+    """
+    Stream the index-v1.json file, only reading the apps of the definition.
+    """
+    jar_paths = get_index_v1_paths(context)
+    settings = MiaHandler.get_definition_settings(True)
+    app_ids = Definition.get_index_app_ids(settings)
+
+    # The locked apps do not depend on the format of the indexes.
+    repositories_data = {}
+    for repo_info in settings['repositories']:
+        repositories_data[repo_info['id']] = dict(repo_info)
+        repositories_data[repo_info['id']]['index'] = Definition.parse_index(jar_paths[repo_info['id']], app_ids)
+    expected = Definition.get_apps_lock_info()
+    assert Definition.resolve_apps(settings, repositories_data)[0] == expected
+
+    index_path = jar_paths[settings['defaults']['repository']]
+
+    def run():
+        Definition.clear_cache()
+        return Definition.parse_index(index_path, app_ids).get_app(settings['apps'][0]['id'])
+
+    return run
+
+
+@benchmark('search_index_build')
+def benchmark_search_index_build(context):
+    context.prepare_workspace()
+    index_xml_path = MiaFDroid.get_index_path('synthetic')
+
+    # Both index formats give the same search index.
+    jar_path = get_index_v1_paths(context)['synthetic']
+    assert MiaSearch.build(jar_path) == MiaSearch.build(index_xml_path)
+
+    def run():
+        return MiaSearch.build(index_xml_path)
+
+    return run
+
+
+@benchmark('search_query')
+def benchmark_search_query(context):
+    """
+    Query the saved search indexes, after they were built once.
+    """
+    context.prepare_workspace()
+    repo_ids = [repo_id for repo_id, apps_count in context.get_repositories()]
+    for repo_id in repo_ids:
+        MiaSearch.load(repo_id)
+
+    queries = [['secure', 'messenger'], ['music'], ['pla'], ['org.example.app0001'], ['open', 'maps', 'offline']]
+
+    def run():
+        return [MiaSearch.search(terms, repo_ids, 20) for terms in queries]
+
+    return run
+
+
+def prepare_completion(context):
+    """
+    Generate the completion cache once, in the benchmark data folder.
+    """
+    workspace_path = context.prepare_workspace()
+    os.environ['XDG_CACHE_HOME'] = os.path.join(context.data_path, 'cache')
+
+    # The app ids are completed once a search built the search indexes.
+    for repo_id, apps_count in context.get_repositories():
+        MiaSearch.load(repo_id)
+
+    import mia.__main__
+    MiaCompletion.load(workspace_path, mia.__main__.__doc__)
+
+    return workspace_path
+
+
+@benchmark('completion')
+def benchmark_completion(context):
+    workspace_path = prepare_completion(context)
+
+    import mia.__main__
+    words_list = [[''], ['definition', ''], ['definition', 'lock', ''], ['definition', 'search', 'org.example.app0001']]
+
+    # The definitions are completed once their settings file exists.
+    definition_path = os.path.join(workspace_path, 'definitions', 'completion-new')
+    shutil.rmtree(definition_path, True)
+    os.makedirs(definition_path)
+    assert 'completion-new' not in MiaCompletion.load(workspace_path, mia.__main__.__doc__)['definitions']
+    with open(os.path.join(definition_path, 'settings.yaml'), 'w') as fd:
+        fd.write('general: {}\n')
+    assert 'completion-new' in MiaCompletion.load(workspace_path, mia.__main__.__doc__)['definitions']
+    shutil.rmtree(definition_path)
+    assert 'org.example.app000001' in MiaCompletion.complete(
+        MiaCompletion.load(workspace_path, mia.__main__.__doc__), ['definition', 'search', 'org.example.app000001']
+    )
+
+    def run():
+        completions = MiaCompletion.load(workspace_path, mia.__main__.__doc__)
+        return [MiaCompletion.complete(completions, words) for words in words_list]
+
+    return run
+
+
+@benchmark('completion_process')
+def benchmark_completion_process(context):
+    """
+    The latency of a tab press, including the interpreter startup.
+    """
+    workspace_path = prepare_completion(context)
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    argv = [sys.executable, '-m', 'mia', '_complete', 'definition', 'lock', '']
+
+    def run():
+        return subprocess.check_output(argv, cwd=workspace_path, env=env)
+
+    return run
+
+
+def get_cli_callback(context, daemon):
+    """
+    Run a search command in a new mia process, like the automation scripts.
+    """
+    workspace_path = context.prepare_workspace()
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    argv = [sys.executable, '-m', 'mia']
+
+    if daemon:
+        daemon_process = subprocess.Popen(argv + ['daemon', 'start'], cwd=workspace_path, env=env,
+                                          stdout=subprocess.PIPE)
+        atexit.register(daemon_process.terminate)
+
+        # Wait until the daemon is listening.
+        daemon_process.stdout.readline()
+    else:
+        env[MiaDaemon.disable_variable] = '1'
+
+    def run():
+        return subprocess.check_output(argv + ['definition', 'search', 'secure', 'music'], cwd=workspace_path, env=env)
+
+    return run
+
+
+@benchmark('cli_search_process')
+def benchmark_cli_search_process(context):
+    return get_cli_callback(context, False)
+
+
+@benchmark('cli_search_daemon')
+def benchmark_cli_search_daemon(context):
+    return get_cli_callback(context, True)
+
+
+def get_lock_file_path(context):
+    file_path = os.path.join(context.get_workspace_path(), 'apps_lock.yaml')
+
+    if not os.path.isfile(file_path):
+        generators.generate_lock_file(file_path, context.params['lock_entries'])
+
+    return file_path
+
+
+@benchmark('lock_file_load_pure')
+def benchmark_lock_file_load_pure(context):
+    import yaml
+
+    file_path = get_lock_file_path(context)
+
+    def run():
+        with open(file_path, 'r') as fd:
+            return yaml.load(fd, Loader=yaml.SafeLoader)
+
+    return run
+
+
+@benchmark('lock_file_load')
+def benchmark_lock_file_load(context):
+    file_path = get_lock_file_path(context)
+
+    def run():
+        MiaSettings.clear_cache()
+        return MiaSettings.load(file_path)
+
+    return run
+
+
+@benchmark('lock_file_load_cached')
+def benchmark_lock_file_load_cached(context):
+    file_path = get_lock_file_path(context)
+    MiaSettings.load(file_path)
+
+    def run():
+        return MiaSettings.load(file_path)
+
+    return run
+
+
+@benchmark('schema_compile')
+def benchmark_schema_compile(context):
+    def run():
+        MiaSchema.clear_cache()
+        return MiaSchema.get_validator()
+
+    return run
+
+
+@benchmark('schema_validate_definitions')
+def benchmark_schema_validate_definitions(context):
+    """
+    Load and validate hundreds of definitions, like `mia build --all` does.
+    """
+    definitions_path = os.path.join(context.get_workspace_path(), 'many-definitions')
+
+    settings_files = []
+    for index in range(context.params['definitions']):
+        definition_path = os.path.join(definitions_path, 'definition-%04d' % index)
+        settings_files.append(os.path.join(definition_path, 'settings.yaml'))
+        if not os.path.isfile(settings_files[-1]):
+            generators.generate_definition(
+                definition_path,
+                context.get_repositories(),
+                context.params['definition_apps'],
+                context.params['index_packages'],
+                index
+            )
+
+    def run():
+        for settings_file in settings_files:
+            errors = MiaSchema.validate(MiaSettings.load(settings_file))
+            if errors:
+                raise ValueError(errors)
+
+    return run
+
+
+@benchmark('build')
+def benchmark_build(context):
+    workspace_path = context.prepare_workspace()
+    archive_path = os.path.join(workspace_path, 'definitions', DEFINITION, 'archive')
+
+    if not os.path.isdir(archive_path):
+        generators.generate_archive(
+            archive_path,
+            context.params['archive_files'],
+            context.params['archive_size']
+        )
+
+    return Build.main
+
+
+@benchmark('build_update')
+def benchmark_build_update(context):
+    benchmark_build(context)()
+    archive_path = os.path.join(MiaHandler.get_definition_path(), 'archive')
+
+    # Change a single file, as when editing the archive in watch mode.
+    file_path = os.path.join(archive_path, 'data', 'watched.xml')
+    changes = [os.path.relpath(file_path, archive_path)]
+
+    def run():
+        with open(file_path, 'w') as fd:
+            fd.write('<map><int name="time" value="%d" /></map>' % (time.time() * 1000))
+        Build.update_zip(Build.get_update_zip_path(), archive_path, changes)
+
+    return run
+
+
+@benchmark('plan')
+def benchmark_plan(context):
+    # Plan the update of an existing build, with a lock file.
+    benchmark_build(context)()
+    lock_file_path = os.path.join(MiaHandler.get_definition_path(), 'apps_lock.yaml')
+    if not os.path.isfile(lock_file_path):
+        generators.generate_lock_file(lock_file_path, context.params['definition_apps'])
+
+    # The OS is not downloaded yet, it is pushed after downloading it.
+    actions = []
+    Plan.plan_install(actions, Plan.plan_os(actions, MiaHandler.get_definition_settings()), None)
+    commands = [action['command'] for action in actions]
+    assert commands[0].startswith('mia definition dl-os') and '--skip-os' not in commands[-1], commands
+
+    def run():
+        Plan.main()
+
+    return run
+
+
+@benchmark('stages_up_to_date')
+def benchmark_stages_up_to_date(context):
+    benchmark_build(context)()
+    definition_path = MiaHandler.get_definition_path()
+    archive_path = os.path.join(definition_path, 'archive')
+    state_path = os.path.join(definition_path, 'stages.json')
+    if os.path.isfile(state_path):
+        os.remove(state_path)
+
+    def get_graph():
+        graph = MiaStageGraph(state_path, context.get_workspace_path())
+        stage = graph.add(MiaStage(
+            'build', Build.build_update_zip,
+            inputs=lambda: [os.path.join(archive_path, path) for path in Build.get_archive_snapshot(archive_path)],
+            outputs=lambda: [Build.get_update_zip_path()]
+        ))
+        return graph, stage
+
+    # Fingerprint the archive files once.
+    graph, stage = get_graph()
+    graph.run(stage)
+
+    def run():
+        # Check the stage again, as `mia make` without changes.
+        graph, stage = get_graph()
+        graph.run(stage)
+        assert stage.state == 'up to date'
+
+    return run
+
+
+@benchmark('apk_inspect')
+def benchmark_apk_inspect(context):
+    apks_path = os.path.join(context.get_workspace_path(), 'apks')
+    apk_paths = [os.path.join(apks_path, 'app%04d.apk' % index) for index in range(context.params['definition_apps'])]
+
+    if not os.path.isdir(apks_path):
+        os.makedirs(apks_path)
+        for index, apk_path in enumerate(apk_paths):
+            abis = ['armeabi-v7a', 'x86'] if index % 3 == 0 else []
+            generators.generate_apk(apk_path, generators.get_app_id(index), 1000 + index, abis, index)
+
+    # The apps downloaded from an URL are locked without a versioncode.
+    MiaApk.check({
+        'id': generators.get_app_id(1), 'package_name': os.path.basename(apk_paths[1]), 'hash_type': 'sha256'
+    }, apk_paths[1], 'armeabi')
+
+    def run():
+        MiaApk.clear_cache()
+        MiaUtils.clear_cache()
+
+        # Inspect the APKs in parallel, as `mia definition verify-apps`.
+        group = MiaTaskGroup()
+        for apk_path in apk_paths:
+            group.add('inspect', MiaApk.inspect, (apk_path,), 'hash')
+        group.run()
+
+    return run
+
+
+@benchmark('apk_signatures')
+def benchmark_apk_signatures(context):
+    # The results are cached in the workspace resources.
+    apks_path = os.path.join(context.prepare_workspace(), 'signed-apks')
+    apks = [
+        ({'package_name': 'app%04d.apk' % index}, os.path.join(apks_path, 'app%04d.apk' % index))
+        for index in range(50)
+    ]
+
+    if not os.path.isdir(apks_path):
+        os.makedirs(apks_path)
+        key, certificate = generators.generate_signing_key()
+        for index, (apk_info, apk_path) in enumerate(apks):
+            generators.generate_signed_apk(apk_path, generators.get_app_id(index), 1000 + index, key, certificate, index)
+
+    # The files added to the manifest, but not to the signature file.
+    v1_path = os.path.join(apks_path, 'v1-only.apk')
+    tampered_path = os.path.join(apks_path, 'tampered.apk')
+    if not os.path.isfile(tampered_path):
+        key, certificate = generators.generate_signing_key()
+        generators.generate_signed_apk(v1_path, generators.get_app_id(0), 1000, key, certificate, v2=False)
+        generators.generate_tampered_apk(tampered_path, v1_path, 'classes2.dex', b'dex\n035\0')
+    assert MiaSignature.verify(v1_path)['verified']
+    try:
+        MiaSignature.verify(tampered_path)
+        assert False, 'The tampered APK was verified'
+    except MiaSignatureError:
+        pass
+
+    # Without the cryptography package, the APKs are rejected and not pinned.
+    apk_info, apk_path = {'package_name': 'app0000.apk'}, apks[0][1]
+    x509, mia.signature.x509 = mia.signature.x509, None
+    try:
+        MiaSignature.clear_cache()
+        result = MiaSignature.verify(apk_path)
+        assert not result['verified']
+        MiaSignature.load_cache()['sha256:%s' % MiaUtils.get_file_hash(apk_path, 'sha256')] = result
+        report = MiaSignature.verify_apks([(apk_info, apk_path)], True)
+        assert report['errors'] and 'signer' not in apk_info, report
+    finally:
+        mia.signature.x509 = x509
+
+    def run():
+        MiaSignature.clear_cache()
+        MiaUtils.clear_cache()
+
+        # Verify the APKs in the process pool, as `mia definition dl-apps`.
+        report = MiaSignature.verify_apks(apks)
+        assert not report['errors'], report['errors']
+        return report
+
+    return run
+
+
+@benchmark('get_file_hash')
+def benchmark_get_file_hash(context):
+    file_path = os.path.join(context.get_workspace_path(), 'hash.bin')
+
+    if not os.path.isfile(file_path):
+        generators.generate_file(file_path, context.params['hash_file_size'])
+
+    def run():
+        MiaUtils.clear_cache()
+        return MiaUtils.get_file_hash(file_path, 'sha256')
+
+    return run
+
+
+def get_os_download_callback(context, segments):
+    """
+    Download a file from a local server limiting the bandwidth of each request.
+    """
+    server_path = os.path.join(context.get_workspace_path(), 'server')
+    if not os.path.isdir(server_path):
+        os.makedirs(server_path)
+
+    file_path = os.path.join(server_path, 'os.zip')
+    if not os.path.isfile(file_path):
+        generators.generate_file(file_path, context.params['os_zip_size'])
+
+    expected_md5 = MiaUtils.get_file_hash(file_path, 'md5')
+    download_path = os.path.join(context.get_workspace_path(), 'os-download.zip')
+
+    # NOTE: The server is kept running until the benchmarks finish.
+    server = StubHTTPServer(server_path, 0.01, 32 * 1024 * 1024).start()
+
+    def run():
+        if os.path.exists(download_path):
+            os.remove(download_path)
+
+        downloader = MiaDownloader(server.get_url('os.zip'), download_path, segments)
+        return downloader.download(expected_md5, False)
+
+    return run
+
+
+@benchmark('os_download_single')
+def benchmark_os_download_single(context):
+    return get_os_download_callback(context, 1)
+
+
+@benchmark('os_download_segmented')
+def benchmark_os_download_segmented(context):
+    return get_os_download_callback(context, 4)
+
+
+@benchmark('os_download_resume')
+def benchmark_os_download_resume(context):
+    """
+    Resume an interrupted download, with a mirror ignoring the Range requests.
+    """
+    server_path = os.path.join(context.get_workspace_path(), 'server')
+    file_path = os.path.join(server_path, 'os.zip')
+    get_os_download_callback(context, 1)
+
+    expected_md5 = MiaUtils.get_file_hash(file_path, 'md5')
+    size = os.path.getsize(file_path)
+    download_path = os.path.join(context.get_workspace_path(), 'os-resume.zip')
+
+    server = StubHTTPServer(server_path, 0.01).start()
+    mirror = StubHTTPServer(server_path, 0.01, ranges=False).start()
+
+    def run():
+        if os.path.exists(download_path):
+            os.remove(download_path)
+
+        # The connections are dropped midway through the segments, not on the
+        # boundaries of the repeated blocks of the generated file.
+        server.fail_after = size // 8 + 12345
+        try:
+            MiaDownloader(server.get_url('os.zip'), download_path, 4, retries=0).download(expected_md5, False)
+            assert False, 'The download was not interrupted'
+        except DownloadError:
+            pass
+        assert os.path.isfile(download_path + '.part.json')
+
+        server.fail_after = None
+        downloader = MiaDownloader([server.get_url('os.zip'), mirror.get_url('os.zip')], download_path, 4)
+        assert downloader.download(expected_md5, False) == expected_md5
+        assert downloader.downloaded_bytes < size
+
+    return run
+
+
+def get_mirrors_repository(context, servers_options):
+    """
+    Serve the same repository from multiple local mirrors.
+    :param servers_options: A list of StubHTTPServer keyword arguments.
+    :return: A (repository settings, package name, package hash) tuple.
+    """
+    context.prepare_workspace()
+
+    mirror_path = os.path.join(context.get_workspace_path(), 'mirror')
+    if not os.path.isdir(mirror_path):
+        os.makedirs(mirror_path)
+
+    index_path = os.path.join(mirror_path, 'index.xml')
+    if not os.path.isfile(index_path):
+        generators.generate_index(index_path, max(1, context.params['index_apps'] // 10), 1)
+
+    package_path = os.path.join(mirror_path, 'package.apk')
+    if not os.path.isfile(package_path):
+        generators.generate_file(package_path, context.params['os_zip_size'] // 4)
+
+    # NOTE: The servers are kept running until the benchmarks finish.
+    servers = [StubHTTPServer(mirror_path, **options).start() for options in servers_options]
+    repo_info = {
+        'id': 'mirrored',
+        'name': 'Mirrored',
+        'url': servers[0].get_url(),
+        'mirrors': [server.get_url() for server in servers[1:]],
+    }
+
+    return repo_info, 'package.apk', MiaUtils.get_file_hash(package_path, 'sha256')
+
+
+@benchmark('mirror_ranking')
+def benchmark_mirror_ranking(context):
+    repo_info = get_mirrors_repository(context, [
+        {'latency': 0.2},
+        {'latency': 0.05, 'bandwidth': 4 * 1024 * 1024},
+        {'latency': 0.01},
+    ])[0]
+
+    def run():
+        return MiaMirrors.rank(repo_info, True)
+
+    return run
+
+
+@benchmark('mirror_failover')
+def benchmark_mirror_failover(context):
+    """
+    The best ranked mirror drops the connections midway through the downloads.
+    """
+    repo_info, package_name, package_hash = get_mirrors_repository(context, [
+        {'latency': 0.01, 'fail_after': context.params['os_zip_size'] // 16},
+        {'latency': 0.02},
+        {'latency': 0.05},
+    ])
+    download_path = os.path.join(context.get_workspace_path(), 'mirror-download.apk')
+
+    def run():
+        # Rank the mirrors again, the failing mirror is demoted while downloading.
+        MiaMirrors.reset()
+        MiaMirrors.rank(repo_info, True)
+
+        if os.path.exists(download_path):
+            os.remove(download_path)
+
+        return MiaMirrors.download(repo_info, package_name, download_path, 'sha256', package_hash, 2)
+
+    return run
+
+
+def get_disk_usage(*paths):
+    """
+    :return: The allocated size of the files, counting hard links once.
+    """
+    inodes = set()
+    usage = 0
+    for path in paths:
+        for root, directories, files in os.walk(path):
+            for file_name in files:
+                stat = os.lstat(os.path.join(root, file_name))
+                if (stat.st_dev, stat.st_ino) not in inodes:
+                    inodes.add((stat.st_dev, stat.st_ino))
+                    usage += stat.st_blocks * 512
+
+    return usage
+
+
+def get_definitions_create_callback(context, clone):
+    """
+    Create 100 definitions from a template with a large archive.
+    """
+    workspace_path = context.prepare_workspace()
+    template_path = os.path.join(workspace_path, 'templates', 'synthetic')
+    definitions_path = os.path.join(workspace_path, 'definitions-clones' if clone else 'definitions-copies')
+
+    if not os.path.isdir(template_path):
+        generators.generate_archive(
+            os.path.join(template_path, 'archive'),
+            context.params['archive_files'] // 5,
+            context.params['archive_size'] // 5
+        )
+        shutil.copy(os.path.join(ROOT, 'mia', 'templates', 'mia-default', 'settings.yaml'), template_path)
+
+    def prepare():
+        shutil.rmtree(definitions_path, True)
+        shutil.rmtree(MiaClone.get_store_path(), True)
+
+    if clone:
+        # The clones can be modified in place, and keep the executable files.
+        prepare()
+        relative_path = os.path.join('archive', next(MiaClone.walk_files(os.path.join(template_path, 'archive'))))
+        os.chmod(os.path.join(template_path, relative_path), 0o755)
+        MiaClone.clone_tree(template_path, definitions_path)
+        template_size = os.path.getsize(os.path.join(template_path, relative_path))
+        with open(os.path.join(definitions_path, relative_path), 'ab') as fd:
+            fd.write(b'modified')
+        assert os.path.getsize(os.path.join(template_path, relative_path)) == template_size
+        assert os.access(os.path.join(definitions_path, relative_path), os.X_OK)
+
+    def run():
+        for index in range(100):
+            definition_path = os.path.join(definitions_path, 'device-%03d' % index)
+            if clone:
+                MiaClone.clone_tree(template_path, definition_path)
+            else:
+                shutil.copytree(template_path, definition_path)
+
+        return {'disk': get_disk_usage(definitions_path, MiaClone.get_store_path())}
+
+    run.prepare = prepare
+
+    return run
+
+
+@benchmark('definitions_create_copytree')
+def benchmark_definitions_create_copytree(context):
+    return get_definitions_create_callback(context, False)
+
+
+@benchmark('definitions_create_clone')
+def benchmark_definitions_create_clone(context):
+    return get_definitions_create_callback(context, True)
+
+
+def get_pack_path(context):
+    workspace_path = context.prepare_workspace()
+    return os.path.join(workspace_path, 'workspace.miapack')
+
+
+@benchmark('cache_pack_export')
+def benchmark_cache_pack_export(context):
+    pack_path = get_pack_path(context)
+
+    def run():
+        MiaPack.create(pack_path, MiaPack.get_workspace_files())
+        return {'disk': os.path.getsize(pack_path)}
+
+    return run
+
+
+@benchmark('cache_pack_import')
+def benchmark_cache_pack_import(context):
+    pack_path = get_pack_path(context)
+    if not os.path.isfile(pack_path):
+        MiaPack.create(pack_path, MiaPack.get_workspace_files())
+    import_path = os.path.join(context.data_path, 'pack-import')
+
+    def run():
+        shutil.rmtree(import_path, True)
+
+        # Verify and extract the entries in parallel, as `mia cache import`.
+        pack = MiaPack(pack_path)
+        group = MiaTaskGroup()
+        for entry in pack.toc['entries']:
+            verify = group.add('verify', pack.verify, (entry,), 'hash')
+            group.add('extract', pack.extract, (entry, os.path.join(import_path, entry['path'])), 'disk', [verify])
+        group.run()
+
+    return run
+
+
+@benchmark('cache_pack_import_malicious')
+def benchmark_cache_pack_import_malicious(context):
+    """
+    The packs writing outside of the resources folder, or the generated and
+    metadata files, are rejected.
+    """
+    workspace_path = context.prepare_workspace()
+    pack_path = os.path.join(context.data_path, 'malicious.miapack')
+    outside_path = os.path.join(context.data_path, 'pwned')
+
+    paths = [
+        '../pwned', 'resources/../../pwned', '/tmp/pwned', 'resources/x86-apps/../../../pwned',
+        'resources/synthetic.index.xml.search', 'resources/apk-info.json', 'definitions/x/settings.yaml',
+        'resources//pwned', 'resources\\..\\..\\pwned',
+    ]
+
+    def run():
+        for relative_path in paths:
+            generators.generate_pack(pack_path, [
+                ('resources/synthetic.index.xml', b'<fdroid/>'), (relative_path, b'pwned')
+            ])
+            try:
+                MiaPack(pack_path).close()
+            except MiaPackError:
+                pass
+            else:
+                raise AssertionError('Accepted the pack entry: %s' % relative_path)
+
+            # As `mia cache import`.
+            MiaHandler.args.update({'<pack>': pack_path, '--mount': False, '--force': True})
+            try:
+                with SilentOutput():
+                    Cache.import_pack()
+            except SystemExit:
+                pass
+            else:
+                raise AssertionError('Imported the pack entry: %s' % relative_path)
+            assert not os.path.exists(outside_path)
+
+        # A symbolic link of the resources folder does not lead outside either.
+        link_path = os.path.join(workspace_path, 'resources', 'link')
+        if not os.path.lexists(link_path):
+            os.symlink(context.data_path, link_path)
+        try:
+            MiaPack.get_file_path('resources/link/pwned')
+        except MiaPackError:
+            pass
+        else:
+            raise AssertionError('Accepted a path through a symbolic link.')
+        finally:
+            os.remove(link_path)
+
+    return run
+
+
+class SilentOutput(object):
+    """
+    Hide the output of the mia helpers while measuring.
+    """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = io.StringIO() if sys.version_info.major > 2 else io.BytesIO()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sys.stdout = self.stdout
+        return False
+
+
+def measure(callback, repeat, measure_memory):
+    durations = []
+    # Benchmarks can reset their data before each run, outside of the timing.
+    prepare = getattr(callback, 'prepare', None)
+
+    for _ in range(repeat):
+        gc.collect()
+        with SilentOutput():
+            if prepare is not None:
+                prepare()
+            start_time = time.time()
+            value = callback()
+            durations.append(time.time() - start_time)
+
+    result = {
+        'time': min(durations),
+        'mean': sum(durations) / len(durations),
+    }
+
+    # Benchmarks can also report the used disk space.
+    if isinstance(value, dict) and 'disk' in value:
+        result['disk'] = value['disk']
+
+    if measure_memory:
+        gc.collect()
+        with SilentOutput():
+            if prepare is not None:
+                prepare()
+            if tracemalloc is not None:
+                tracemalloc.start()
+                callback()
+                result['memory'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            else:
+                # The maximum resident set size, in kilobytes on Linux.
+                callback()
+                result['memory'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return result
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: A list of regressions, as (benchmark, metric, ratio) tuples.
+    """
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        for metric in ('time', 'memory', 'disk'):
+            if not baseline[name].get(metric) or metric not in result:
+                continue
+
+            ratio = float(result[metric]) / baseline[name][metric]
+            if ratio > 1 + threshold / 100.0:
+                regressions.append((name, metric, ratio))
+
+    return regressions
+
+
+def main():
+    args = docopt(__doc__)
+
+    if args['--list']:
+        print('\n'.join(BENCHMARKS.keys()))
+        return 0
+
+    scale = args['--scale']
+    if scale not in SCALES:
+        print('ERROR: Unknown scale "%s"!' % scale)
+        return 1
+
+    names = args['<benchmark>'] or list(BENCHMARKS.keys())
+    for name in names:
+        if name not in BENCHMARKS:
+            print('ERROR: Unknown benchmark "%s"!' % name)
+            return 1
+
+    data_path = args['--data-dir'] or tempfile.mkdtemp(prefix='mia-benchmarks-')
+    context = BenchmarkContext(data_path, scale)
+
+    results = OrderedDict()
+    try:
+        print('Running the benchmarks using the "%s" scale:' % scale)
+        for name in names:
+            with SilentOutput():
+                callback = BENCHMARKS[name](context)
+
+            results[name] = measure(callback, int(args['--repeat']), not args['--no-memory'])
+            print(' - {:<32} {:>9.3f}s {:>12} {:>12}'.format(
+                name,
+                results[name]['time'],
+                MiaUtils.format_file_size(results[name]['memory']) if 'memory' in results[name] else '-',
+                MiaUtils.format_file_size(results[name]['disk']) if 'disk' in results[name] else ''
+            ))
+    finally:
+        if not args['--data-dir']:
+            shutil.rmtree(data_path)
+
+    # Read the baseline results.
+    baseline_path = args['--baseline']
+    baselines = {}
+    if os.path.isfile(baseline_path):
+        with open(baseline_path, 'r') as fd:
+            baselines = json.load(fd)
+
+    if args['--save-baseline']:
+        baselines.setdefault(scale, {}).update(results)
+        with open(baseline_path, 'w') as fd:
+            json.dump(baselines, fd, indent=2, sort_keys=True)
+        print('Saved the baseline results to:\n - %s' % baseline_path)
+        return 0
+
+    if scale not in baselines:
+        print('No baseline results for the "%s" scale.' % scale)
+        return 0
+
+    regressions = compare(results, baselines[scale], float(args['--threshold']))
+    for name, metric, ratio in regressions:
+        print('REGRESSION: %s %s is %.0f%% of the baseline.' % (name, metric, ratio * 100))
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,7 +2,7 @@ from glob import glob
 import sys
 import yamale
 
-schema = yamale.make_schema('./docs/schema.yaml')
+schema = yamale.make_schema('./mia/schema.yaml')
 
 data = yamale.make_data('./docs/current.settings.yaml')
 yamale.validate(schema, data)